@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measure the start-up time of the most common command line invocations
+
+Every invocation is run several times in a fresh interpreter with ``python -X importtime``
+using the test backend (so that nothing is sent anywhere) and a temporary configuration.
+For each invocation the median wall time, the time spent importing pybliotecario
+and the number of modules imported are reported.
+
+    python benchmarks/import_time.py --repeat 10 --max-ms 150
+
+With ``--max-ms`` the script exits with an error if the median wall time of any
+invocation is above the threshold, so that it can be used to catch regressions.
+"""
+
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+INVOCATIONS = {
+    "message": ["This is a benchmark"],
+    "file": ["-f", "{config}"],
+    "image": ["-i", "{config}"],
+    "help": ["--help"],
+}
+
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def run_once(arguments, env):
+    """Run pybliotecario once, return the wall time (s), the time spent
+    importing pybliotecario (s) and the number of modules imported"""
+    command = [sys.executable, "-X", "importtime", "-m", "pybliotecario.pybliotecario"]
+    start = time.perf_counter()
+    result = subprocess.run(command + arguments, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(arguments)} failed:\n{result.stderr}")
+
+    modules = 0
+    import_us = 0
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        modules += 1
+        # Only top-level imports, their cumulative time includes everything below
+        if len(match.group(3)) == 1 and match.group(4).startswith("pybliotecario"):
+            import_us += int(match.group(2))
+    return wall, import_us / 1e6, modules
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Runs per invocation")
+    parser.add_argument("--max-ms", type=float, help="Fail if the median wall time is above")
+    parser.add_argument("invocations", nargs="*", help=f"Any of {', '.join(INVOCATIONS)}")
+    args = parser.parse_args()
+    invocations = args.invocations or list(INVOCATIONS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        config = tmp / "pybliotecario.ini"
+        config.write_text(f"[DEFAULT]\nmain_folder = {tmp}\nchat_id = 0\ntoken = none\n")
+        env = dict(os.environ, XDG_CONFIG_HOME=str(tmp), XDG_DATA_HOME=str(tmp))
+
+        failed = False
+        print(f"{'invocation':<12}{'wall (ms)':>12}{'import (ms)':>14}{'modules':>10}")
+        for name in invocations:
+            arguments = [i.format(config=config) for i in INVOCATIONS[name]]
+            arguments += ["--backend", "test", "--config_file", str(config)]
+            runs = [run_once(arguments, env) for _ in range(args.repeat)]
+            wall = statistics.median(i[0] for i in runs) * 1e3
+            imports = statistics.median(i[1] for i in runs) * 1e3
+            print(f"{name:<12}{wall:>12.1f}{imports:>14.1f}{runs[-1][2]:>10}")
+            if args.max_ms is not None and wall > args.max_ms:
+                failed = True
+
+    if failed:
+        sys.exit(f"At least one invocation is slower than {args.max_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
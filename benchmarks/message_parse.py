@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Measure how fast the updates are parsed into messages and how much memory every message keeps
+
+For every message class (Telegram, Facebook and the Test backend) ``--count`` updates are
+parsed into messages as the daemon does by default: releasing the update (``release_updates``)
+and with a handler which emits the INFO log (to ``os.devnull``).
+The parse throughput (of already decoded updates) is reported together with the memory retained
+per message, measured with ``tracemalloc`` while the updates are decoded from json (as they come
+from the backend) and parsed into messages which are kept alive: releasing the update and,
+for comparison, keeping it in the message.
+
+    python benchmarks/message_parse.py --count 50000
+    python benchmarks/message_parse.py --quiet    # without the INFO log
+"""
+
+from argparse import ArgumentParser
+import gc
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+from pybliotecario.backend.backend_test import TestMessage
+from pybliotecario.backend.facebook_util import FacebookMessage
+from pybliotecario.backend.telegram_util import TelegramMessage
+
+_USER = {"id": 1234, "first_name": "hiro", "last_name": "hiro", "username": "hiro"}
+_TELEGRAM = {
+    "update_id": 0,
+    "message": {
+        "message_id": 0,
+        "from": dict(_USER, is_bot=False, language_code="en"),
+        "chat": dict(_USER, type="private"),
+        "date": 1700000000,
+        "text": "/arxiv-get 1234.5678 and some more text to make it look like a message",
+    },
+}
+_FACEBOOK = {
+    "object": "page",
+    "entry": [
+        {
+            "id": "1234",
+            "time": 1700000000,
+            "messaging": [
+                {
+                    "sender": {"id": "1234"},
+                    "recipient": {"id": "5678"},
+                    "timestamp": 1700000000,
+                    "message": {"mid": "m_0", "text": "some text to make it look like a message"},
+                }
+            ],
+        }
+    ],
+}
+MESSAGES = {
+    "TelegramMessage": (TelegramMessage, _TELEGRAM),
+    "FacebookMessage": (FacebookMessage, _FACEBOOK),
+    "TestMessage": (TestMessage, _TELEGRAM),
+}
+
+
+def parse_time(message_class, updates):
+    """Time it takes to parse (and release) all updates"""
+    start = time.perf_counter()
+    for update in updates:
+        message_class(update, release=True)
+    return time.perf_counter() - start
+
+
+def retained_memory(message_class, raw_updates, release):
+    """Bytes retained by every message (and whatever it keeps alive)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [message_class(json.loads(raw), release=release) for raw in raw_updates]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the messages is not part of the message
+    return (after - before - len(messages) * 8) / len(messages)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=20000, help="updates per message class")
+    parser.add_argument("--quiet", action="store_true", help="do not emit the INFO log")
+    args = parser.parse_args()
+
+    if not args.quiet:
+        handler = logging.StreamHandler(open(os.devnull, "w"))
+        logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(logging.INFO)
+
+    print(f"{'':>16} {'':>12} {'bytes/message':^25}")
+    print(f"{'message':>16} {'messages/s':>12} {'released':>12} {'kept':>12}")
+    for name, (message_class, update) in MESSAGES.items():
+        raw_updates = [json.dumps(update)] * args.count
+        updates = [json.loads(raw) for raw in raw_updates]
+        # Warm up
+        parse_time(message_class, updates[:1000])
+        elapsed = parse_time(message_class, updates)
+        released = retained_memory(message_class, raw_updates, release=True)
+        kept = retained_memory(message_class, raw_updates, release=False)
+        print(f"{name:>16} {args.count / elapsed:>12.0f} {released:>12.0f} {kept:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Measure the peak memory (RSS) of uploading files of increasing size
+
+For every size a file of random content is created and sent as a document with the
+Telegram backend to a local server which reads and discards the request body.
+Every upload is done in a fresh interpreter and its peak RSS is reported,
+together with the increase with respect to the smallest file.
+
+    python benchmarks/upload_memory.py --sizes 16 256 1024 --max-growth-mb 20
+
+With ``--max-growth-mb`` the script exits with an error if the peak RSS of the largest upload
+is more than that above the peak RSS of the smallest one, i.e., if the memory used by
+an upload depends on the size of the file.
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+_UPLOAD = """
+from configparser import ConfigParser
+import resource
+import sys
+
+from pybliotecario.backend import telegram_util
+
+telegram_util.TELEGRAM_URL = sys.argv[1]
+config = ConfigParser()
+config["DEFAULT"] = {"send_queue": "false", "file_id_cache": "false"}
+backend = telegram_util.TelegramUtil(config, token="benchmark")
+backend.send_file(sys.argv[2], 1234)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+class DiscardHandler(BaseHTTPRequestHandler):
+    """Read the whole body in chunks and answer ok"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1 << 20)))
+        content = b'{"ok": true, "result": {}}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def create_file(folder, size_mb):
+    path = os.path.join(folder, f"upload_{size_mb}MB.bin")
+    block = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+    return path
+
+
+def peak_rss_mb(url, path):
+    """Upload the file in a fresh interpreter and return its peak RSS in MB"""
+    result = subprocess.run(
+        [sys.executable, "-c", _UPLOAD, url, path], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"The upload failed:\n{result.stderr}")
+    # ru_maxrss is given in kB in Linux
+    return int(result.stdout.split()[-1]) / 1024
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 128, 512], help="in MB")
+    parser.add_argument("--max-growth-mb", type=float, help="fail above this RSS growth")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DiscardHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    peaks = []
+    with tempfile.TemporaryDirectory() as folder:
+        print(f"{'file size':>10} {'peak RSS':>10} {'growth':>10}")
+        for size_mb in sorted(args.sizes):
+            path = create_file(folder, size_mb)
+            peaks.append(peak_rss_mb(url, path))
+            os.remove(path)
+            growth = peaks[-1] - peaks[0]
+            print(f"{size_mb:>7} MB {peaks[-1]:>7.1f} MB {growth:>7.1f} MB")
+    server.shutdown()
+
+    if args.max_growth_mb is not None and peaks[-1] - peaks[0] > args.max_growth_mb:
+        sys.exit(f"The peak RSS grew by {peaks[-1] - peaks[0]:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
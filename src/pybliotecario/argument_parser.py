@@ -1,5 +1,8 @@
 """
 Wrapper for the argument parser and the initialization
+
+The modules needed for the initialization (components, backends) are imported only
+when ``--init`` is used, so that parsing the arguments is as fast as possible
 """
 
 from argparse import Action, ArgumentParser, ArgumentTypeError
@@ -9,10 +12,6 @@ import importlib
 import os
 from pathlib import Path
 
-from . import components
-from .backend import TelegramUtil
-from .backend.telegram_util import TelegramMessage
-from .components.component_core import Component
 from .customconf import default_config_path, default_data_path
 
 
@@ -45,6 +44,8 @@ def check_attr(attr):
     Checks whether the attr is a class and whether
     it does inherit from Component and whether
     """
+    from .components.component_core import Component
+
     if not isinstance(attr, type):
         return False
     if attr == Component:
@@ -82,6 +83,8 @@ def configure_telegram():
     This function walks the user through the process of creating a new bot
     and storing the token and the chat_id of the user in the configuration file
     """
+    from .backend.telegram_util import TelegramMessage, TelegramUtil
+
     # Initialize the bot in telegram
     print(
         """Welcome to The Wizard!
@@ -132,6 +135,8 @@ def configure_all():
     """Import everything inside the components folder that
     inherint from Component and run config_module
     on it"""
+    from . import components
+
     config_dict = {}
     missing_dependencies = False
 
@@ -242,7 +247,29 @@ def parse_args(args):
     parser_cmd.add_argument("message", help="Message to send to Telegram", nargs="*")
     parser_cmd.add_argument("-i", "--image", help="Send image to Telegram")
     parser_cmd.add_argument("-f", "--file", help="Send file to Telegram", type=validpath)
+    parser_cmd.add_argument(
+        "--split",
+        help="With -f, send files above the upload limit of the backend in parts",
+        action="store_true",
+    )
+    parser_cmd.add_argument(
+        "--join",
+        help="Join the parts of a file sent with --split (give the first part, <name>.001)",
+        type=validpath,
+    )
     parser_cmd.add_argument("--chat_id", help="Chat id to send the message to", default="")
+    parser_cmd.add_argument(
+        "--stdin",
+        "--batch",
+        help="Send every line read from stdin as a message (file:<path> and image:<path> send files)",
+        action="store_true",
+    )
+    parser_cmd.add_argument(
+        "-0",
+        "--null",
+        help="With --stdin, the messages are separated by NUL characters instead of newlines",
+        action="store_true",
+    )
 
     parser_dae = parser.add_argument_group("Pybliotecario daemon")
     parser_dae.add_argument("-d", "--daemon", help="Activate the librarian", action="store_true")
@@ -261,6 +288,22 @@ def parse_args(args):
         help="Exit after receiving the first batch of messages",
         action="store_true",
     )
+    parser_dae.add_argument(
+        "--webhook",
+        help="Receive the Telegram updates through a webhook instead of polling (see webhook_url)",
+        action="store_true",
+    )
+    parser_dae.add_argument(
+        "--profile",
+        help="Profile the first N messages with cProfile (results in main_folder/profiles)",
+        type=int,
+        metavar="N",
+    )
+    parser_dae.add_argument(
+        "--workers",
+        help="Number of messages from different chats that can be processed at the same time",
+        type=int,
+    )
 
     parser_com = parser.add_argument_group("Pybliotecario's components")
     parser_com.add_argument(
@@ -294,4 +337,17 @@ def parse_args(args):
         help="Looks at json file (can be given in config) to watch a number of stocks",
         nargs="*",
     )
+    parser_com.add_argument(
+        "--search", help="Search the saved messages containing all the given terms", nargs="+"
+    )
+    parser_com.add_argument(
+        "--search_backfill",
+        help="Add the messages of the existing daily logs to the search index",
+        action="store_true",
+    )
+    parser_com.add_argument(
+        "--files",
+        help="Search the received files whose name or caption contain all the given terms",
+        nargs="+",
+    )
     return parser.parse_args(args)
@@ -1,3 +1,21 @@
-from .backend_test import TestUtil
-from .facebook_util import FacebookUtil
-from .telegram_util import TelegramUtil
+"""
+The backends are only imported when they are first accessed
+so that using one of them does not require importing (or installing) the others
+"""
+
+import importlib
+
+_BACKENDS = {
+    "TestUtil": "backend_test",
+    "FacebookUtil": "facebook_util",
+    "TelegramUtil": "telegram_util",
+}
+
+__all__ = list(_BACKENDS)
+
+
+def __getattr__(name):
+    if name in _BACKENDS:
+        module = importlib.import_module(f"{__name__}.{_BACKENDS[name]}")
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
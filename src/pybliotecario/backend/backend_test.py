@@ -15,6 +15,7 @@ _TESTUSER = "hiro"
 class TestMessage(TelegramMessage):
     """Copy of the TelegramMessage class"""
 
+    __slots__ = ()
     _type = "Test"
 
 
@@ -100,6 +101,9 @@ class TestUtil:
             msg = TestMessage(update)
             action_function(msg)
 
+    def close(self):
+        """Nothing to close for the test backend"""
+
     def send_message(self, text, chat, **keywords):
         """
         Sends a message to the communication_file this class has been
@@ -111,13 +115,15 @@ class TestUtil:
             return None
         return text
 
-    def send_image(self, *args):
-        """Writes the img_path to the comm file"""
-        return self.send_message(*args)
+    def send_image(self, img_path, chat, **kwargs):
+        """Writes the img_path to the comm file
+        The options of the other backends (priority, progress) are accepted and ignored"""
+        return self.send_message(img_path, chat)
 
-    def send_file(self, *args):
-        """Writes the file_path to the comm file"""
-        return self.send_message(*args)
+    def send_file(self, filepath, chat, **kwargs):
+        """Writes the file_path to the comm file
+        The options of the other backends (priority, progress, split) are accepted and ignored"""
+        return self.send_message(filepath, chat)
 
     # Auxiliary
     def is_msg_in_file(self, msg):
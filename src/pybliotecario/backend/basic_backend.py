@@ -8,13 +8,46 @@ Each backend should implement its own message type and inherit from backend
 """
 
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
 from configparser import ConfigParser
+from functools import partial
 import json
 import logging
-import urllib
+import os
+from pathlib import Path
+import threading
+
+from pybliotecario.backend.chunker import CODEPOINT, chunk_message, message_size
+from pybliotecario.backend.coalescing import MessageCoalescer
+from pybliotecario.backend.downloads import DEFAULT_WORKERS as DEFAULT_DOWNLOAD_WORKERS
+from pybliotecario.backend.downloads import DownloadManager
+from pybliotecario.backend.journal import UpdateJournal
+from pybliotecario.backend.polling import BLOCK, OffsetTracker, UpdatePipeline
+from pybliotecario.backend.scheduler import (
+    DEFAULT_CHAT_RATE,
+    DEFAULT_GLOBAL_RATE,
+    SendScheduler,
+    current_priority,
+)
+from pybliotecario.backend.splitting import split_file
+from pybliotecario.backend.transport import shared_transport
+from pybliotecario.metrics import REGISTRY
 
 logger = logging.getLogger(__name__)
 
+REQUEST_SECONDS = REGISTRY.histogram(
+    "pybliotecario_backend_request_seconds",
+    "Latency of the requests to the API of the backend",
+    ("backend", "method"),
+)
+POLLS = REGISTRY.counter(
+    "pybliotecario_polls_total", "Requests for updates by outcome", ("backend", "outcome")
+)
+
+
+# Value of the lazy fields of a message which have not been parsed yet
+_UNPARSED = object()
+
 
 class Message(ABC):
     """
@@ -29,23 +62,87 @@ class Message(ABC):
      - file id (if any)
      - ignore (if the msg is to be ignored)
     through the ``_parse_update`` method.
+
+    Fields which are rarely needed can be listed in ``_lazy_fields``, then they are only
+    parsed (by ``_parse_<field>``) the first time they are read, from the part of the update
+    that ``_parse_update`` stores in ``_source`` (by default, the whole update).
+    With ``release=True`` the update is dropped as soon as the message has been parsed,
+    only the parts of ``_source`` given by ``_lazy_source`` are kept for the lazy fields.
+
+    Messages have ``__slots__``, implementations must declare the attributes they add.
     """
 
+    __slots__ = (
+        "_chat_id",
+        "_username",
+        "_command",
+        "_file_id",
+        "_text",
+        "_ignore",
+        "_original",
+        "_source",
+        "_on_start",
+    )
     _type = "Abstract"
-    _original = None
+    _lazy_fields = ()
 
-    def __init__(self, update):
+    def __init__(self, update, release=False):
         self._chat_id = None
         self._username = None
         self._command = None
         self._file_id = None
         self._text = None
         self._ignore = False
-        self._raw = None
         self._original = update
+        self._source = None
+        self._on_start = None
+        for field in self._lazy_fields:
+            setattr(self, f"_{field}", _UNPARSED)
         self._parse_update(update)
+        if self._source is None and self._lazy_fields:
+            self._source = update
         # After the information is parsed, log the message!
-        logger.info("New message: %s", self)
+        # the lazy fields are not logged so that they are only parsed when they are used
+        if logger.isEnabledFor(logging.INFO):
+            ignored = " (ignored)" if self._ignore else ""
+            logger.info("New message from %s%s: %s", self._chat_id, ignored, self.raw)
+        if release:
+            self.release()
+
+    def _lazy(self, field):
+        """Return the value of the field, parsing it if it has not been yet"""
+        value = getattr(self, f"_{field}")
+        if value is _UNPARSED:
+            value = None
+            if self._source is not None and not self._ignore:
+                value = getattr(self, f"_parse_{field}")(self._source)
+            setattr(self, f"_{field}", value)
+        return value
+
+    def _lazy_source(self, source):
+        """Return the part of ``source`` needed to parse the lazy fields"""
+        return source
+
+    def release(self):
+        """Drop the update, keeping only what the lazy fields not parsed yet need"""
+        unparsed = any(getattr(self, f"_{field}") is _UNPARSED for field in self._lazy_fields)
+        if unparsed and self._source is not None and not self._ignore:
+            self._source = self._lazy_source(self._source)
+        else:
+            self._source = None
+        self._original = None
+
+    def started(self):
+        """Tell the backend that the message is being acted upon, to be called by
+        the action before doing anything with side effects, only the first call counts"""
+        on_start, self._on_start = self._on_start, None
+        if on_start is not None:
+            on_start()
+
+    @property
+    def update(self):
+        """Returns the update the message was parsed from, None if it has been released"""
+        return self._original
 
     def __str__(self):
         rep = ["chat_id", "username", "command", "file_id", "text", "ignore"]
@@ -100,7 +197,7 @@ class Message(ABC):
     @property
     def username(self):
         """Returns the username"""
-        return self._username
+        return self._lazy("username")
 
     @property
     def text(self):
@@ -152,23 +249,77 @@ class Backend(ABC):
 
     _message_class: a reference to the Message class of the backend
     _get_updates: a method that should return a list of updates to act upon
-    send_message: a method to communicate messages
+    _send_message: a method to communicate messages
 
     Others:
-        - send_image
-        - send_file
+        - _send_image
+        - _send_file
         - download_file
 
+    ``send_message``, ``send_image`` and ``send_file`` don't send anything by themselves
+    but queue the send in a ``SendScheduler`` which respects the flood limits of the backend
+    (``_chat_rate`` sends per second to a chat, ``_global_rate`` overall) and return a Future.
+    The limits can be changed with the options ``send_rate_chat`` and ``send_rate_global``
+    and the queue can be disabled (so that the sends happen immediately) with ``send_queue = false``.
+
+    If the backend sets ``_prefetch`` to True the updates will be
+    fetched in the background (while the previous ones are processed) by setting
+    in the DEFAULT section of the configuration the options:
+        - update_queue_size: maximum number of updates to keep in memory (0 to disable)
+        - update_queue_policy: what to do when the queue is full (block, drop_oldest)
+
+    Backends which identify their updates (``_update_id``) and set ``_journaled`` keep a journal of the updates
+    in ``main_folder/journal`` so that no update is lost or repeated between restarts.
+    It can be disabled with ``journal = false``, the number of processed update ids
+    to remember is given by ``journal_retention`` and ``journal_fsync = false`` trades
+    the safety against power cuts for speed by not forcing the writes to disk.
+
+    The messages drop the update they were parsed from unless ``release_updates = false``.
     """
 
+    _prefetch = False
+    _journaled = False
+    _chat_rate = DEFAULT_CHAT_RATE
+    _global_rate = DEFAULT_GLOBAL_RATE
+    # Maximum length of a message, measured in _size_unit (see chunker.UNITS)
+    _max_size = 99999
+    _size_unit = CODEPOINT
+    # Maximum size (in bytes) of the files that can be uploaded, None if unknown
+    _max_upload = None
+
     def __init__(self, config=None, debug=False, **kwargs):
         if config is None:
             # If no config is passed, generate and empty one
             config = ConfigParser()
-        self._max_size = 99999
         self._quiet = config.getboolean("DEFAULT", "quiet", fallback=False)
         self._config = config
         self._debug = debug
+        self._queue_size = config.getint("DEFAULT", "update_queue_size", fallback=100)
+        self._queue_policy = config.get("DEFAULT", "update_queue_policy", fallback=BLOCK)
+        self._pipeline = None
+        self._offsets = OffsetTracker()
+        self._journal = None
+        self._receiving = False
+        self._transport = None
+        self._send_queue = None
+        self._send_queue_lock = threading.Lock()
+        self._coalescer = None
+        self._downloads = None
+        self._coalesce_window = config.getfloat("DEFAULT", "coalesce_window", fallback=0)
+        self._release_updates = config.getboolean("DEFAULT", "release_updates", fallback=True)
+        # Exception of an action which failed in the background, raised by act_on_updates
+        self._failure = None
+
+    @property
+    def transport(self):
+        """HTTP transport used for all requests of the backend, shared by default"""
+        if self._transport is None:
+            self._transport = shared_transport(self._config)
+        return self._transport
+
+    @transport.setter
+    def transport(self, transport):
+        self._transport = transport
 
     @abstractmethod
     def _get_updates(self, not_empty=False):
@@ -179,8 +330,86 @@ class Backend(ABC):
         """Returns a raw version of the updates as implemented by the child class"""
         return self._get_updates(not_empty=True)
 
+    def _scheduler(self):
+        """Return the send queue, creating it the first time, or None if disabled"""
+        if not self._config.getboolean("DEFAULT", "send_queue", fallback=True):
+            return None
+        with self._send_queue_lock:
+            if self._send_queue is None:
+                self._send_queue = SendScheduler(
+                    chat_rate=self._config.getfloat(
+                        "DEFAULT", "send_rate_chat", fallback=self._chat_rate
+                    ),
+                    global_rate=self._config.getfloat(
+                        "DEFAULT", "send_rate_global", fallback=self._global_rate
+                    ),
+                )
+            return self._send_queue
+
+    def _schedule(self, chat, function, *args, priority=None, **kwargs):
+        """Queue the send in the scheduler, or do it now if the queue is disabled"""
+        send_queue = self._scheduler()
+        if send_queue is None:
+            return function(*args, **kwargs)
+        return send_queue.submit(chat, function, *args, priority=priority, **kwargs)
+
+    def _get_coalescer(self):
+        """Return the coalescer of text messages, or None if ``coalesce_window`` is not set"""
+        if self._coalesce_window <= 0:
+            return None
+        with self._send_queue_lock:
+            if self._coalescer is None:
+                self._coalescer = MessageCoalescer(
+                    self._send_coalesced,
+                    window=self._coalesce_window,
+                    max_size=self._max_size,
+                    size=lambda text: message_size(text, self._size_unit),
+                )
+            return self._coalescer
+
+    def _send_coalesced(self, chat, text, priority):
+        return self._schedule_message(text, chat, priority=priority)
+
+    def _schedule_message(self, text, chat, priority=None, **kwargs):
+        """Break the message in chunks that fit in the backend and queue them
+        Returns the result of the last chunk"""
+        result = None
+        chunks = chunk_message(
+            text, self._max_size, unit=self._size_unit, markdown=kwargs.get("markdown", False)
+        )
+        for chunk in chunks:
+            result = self._schedule(
+                chat, self._send_message, chunk, chat, priority=priority, **kwargs
+            )
+        return result
+
+    def _flush_coalesced(self, chat):
+        """Send the text messages waiting for the chat, so that they go before anything else"""
+        if self._coalescer is not None:
+            self._coalescer.flush(chat)
+
+    def flush(self, timeout=None):
+        """Wait until all queued sends are done"""
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        if self._send_queue is not None:
+            self._send_queue.flush(timeout)
+
+    def send_message(self, text, chat, priority=None, **kwargs):
+        """Queue a message to the chat, long messages are sent in several chunks
+        If ``coalesce_window`` is set, plain text messages sent to the same chat within
+        the window are merged into a single message"""
+        coalescer = self._get_coalescer()
+        if coalescer is not None:
+            if not any(kwargs.values()):
+                if priority is None:
+                    priority = current_priority()
+                return coalescer.add(chat, text, priority)
+            self._flush_coalesced(chat)
+        return self._schedule_message(text, chat, priority=priority, **kwargs)
+
     @abstractmethod
-    def send_message(self, text, chat, **kwargs):
+    def _send_message(self, text, chat, **kwargs):
         """Sends a message to the chat"""
 
     def send_quiet_message(self, text, chat, **kwargs):
@@ -194,40 +423,226 @@ class Backend(ABC):
     def _message_class(self):
         pass
 
-    def _break_msg(self, msg):
-        """Find the position of the closest whitespace to size in order to break a given msg
-        It prioritizes newlines, then spaces, then just returns size
-        (but only from half the msg onwards)
+    def _update_id(self, update):
+        """Return the (increasing) identifier of the update
+        or None if the backend does not identify its updates"""
+        return None
+
+    def _is_droppable(self, update):
+        """Whether the update can be dropped when the update queue is full"""
+        return False
+
+    def _receive_updates(self, not_empty=False):
+        """Get the updates from the backend and write them down to the journal"""
+        updates = self._get_updates(not_empty=not_empty)
+        if self._journal is not None:
+            self._journal.received_many([(self._update_id(update), update) for update in updates])
+        return updates
+
+    def _start_pipeline(self):
+        """Start fetching updates in the background"""
+        self._pipeline = UpdatePipeline(
+            lambda: self._receive_updates(not_empty=False),
+            capacity=self._queue_size,
+            policy=self._queue_policy,
+            is_droppable=self._is_droppable,
+        )
+        self._pipeline.start()
+
+    def _journal_folder(self):
+        """Return the folder for the journal of updates, None if no journal is to be used"""
+        if not self._journaled:
+            return None
+        if not self._config.getboolean("DEFAULT", "journal", fallback=True):
+            return None
+        main_folder = self._config.defaults().get("main_folder")
+        if not main_folder:
+            return None
+        return Path(main_folder) / "journal"
+
+    def _resume_from(self, update_id):
+        """Make sure updates older than ``update_id`` (included) are not requested again"""
+
+    def _start_receiving(self):
+        """Prepare the backend for receiving updates.
+        Opens the journal, resuming from the last committed update, and starts
+        fetching updates in the background if possible.
+        Returns the updates recovered from the journal
         """
-        if len(msg) < self._max_size:
-            return self._max_size
-        available_msg = msg[: self._max_size]
-        for break_char in ["\n", " "]:
-            last_break = available_msg.rindex(break_char)
-            if last_break > int(self._max_size / 2):
-                return last_break
-        return self._max_size
+        self._receiving = True
+        recovered = []
+        journal_folder = self._journal_folder()
+        if journal_folder is not None:
+            retention = self._config.getint("DEFAULT", "journal_retention", fallback=1000)
+            fsync = self._config.getboolean("DEFAULT", "journal_fsync", fallback=True)
+            self._journal = UpdateJournal(journal_folder, retention=retention, fsync=fsync)
+            recovered = self._journal.recover()
+            self._offsets = OffsetTracker(self._journal.committed_offset)
+            if self._journal.last_received is not None:
+                self._resume_from(self._journal.last_received)
+
+        if self._can_prefetch():
+            self._start_pipeline()
+        return recovered
+
+    def _can_prefetch(self):
+        """Whether the updates can be fetched in the background"""
+        return self._prefetch and self._queue_size > 0
+
+    @property
+    def committed_offset(self):
+        """Identifier of the first update which has not been fully processed"""
+        return self._offsets.committed
+
+    def _finish_update(self, update_id):
+        """Mark the update as processed"""
+        self._offsets.processed(update_id)
+        if self._journal is not None:
+            self._journal.processed(update_id, self.committed_offset)
 
     def act_on_updates(self, action_function, not_empty=False):
         """
         Receive the input using _get_updates, parse it with
         the message class and act in consequence
+
+        If ``action_function`` returns a ``concurrent.futures.Future``
+        the update is considered processed only once the future is done.
+        If the future fails, its exception is raised (by this call or by the next one)
+        before any other update is started, so that the updates which were not
+        acted upon are received again when the program is restarted
+
+        With a journal, the update is written down as started when the action calls
+        ``message.started()``: updates which were waiting (e.g., in a dispatcher) when
+        the program stopped are acted upon after the restart, while updates which had started
+        are not repeated. If the action never calls it, a crash repeats the update.
         """
-        all_updates = self._get_updates(not_empty=not_empty)
-        for update in all_updates:
-            msg = self._message_class(update)
-            action_function(msg)
+        self._raise_failure()
+        all_updates = []
+        if not self._receiving:
+            # The first batch is made of the updates recovered from the journal (if any)
+            all_updates = self._start_receiving()
+
+        if not all_updates:
+            if self._pipeline is not None:
+                all_updates = self._pipeline.get_batch(block=not_empty)
+            else:
+                all_updates = self._receive_updates(not_empty=not_empty)
 
-    def send_image(self, img_path, chat):
+        for update in all_updates:
+            self._raise_failure()
+            update_id = self._update_id(update)
+            if update_id is not None:
+                if self._journal is not None:
+                    if self._journal.is_processed(update_id):
+                        logger.info("Update %s already processed, skipping", update_id)
+                        continue
+                self._offsets.received(update_id)
+
+            msg = self._message_class(update, release=self._release_updates)
+            if self._journal is not None and update_id is not None:
+                msg._on_start = partial(self._journal.started, update_id)
+            result = action_function(msg)
+
+            if isinstance(result, Future):
+                result.add_done_callback(lambda r, i=update_id: self._action_done(i, r))
+            elif update_id is not None:
+                self._finish_update(update_id)
+        self._raise_failure()
+
+    def _action_done(self, update_id, result):
+        """Called (possibly in a different thread) when the action on an update has finished
+        The update is processed even if the action failed, but no other update will be started"""
+        if not result.cancelled() and result.exception() is not None:
+            if self._failure is None:
+                self._failure = result.exception()
+            self._interrupt()
+        if update_id is not None:
+            self._finish_update(update_id)
+
+    def _interrupt(self):
+        """Stop waiting for updates, so that ``act_on_updates`` can return"""
+        if self._pipeline is not None:
+            self._pipeline.interrupt()
+
+    def _raise_failure(self):
+        """Raise the exception of the action which failed, if any"""
+        if self._failure is not None:
+            failure, self._failure = self._failure, None
+            raise failure
+
+    def close(self):
+        """Stop all background activity of the backend
+        Sends still in the queue are done before returning"""
+        if self._coalescer is not None:
+            self._coalescer.close()
+            self._coalescer = None
+        if self._send_queue is not None:
+            self._send_queue.close()
+            self._send_queue = None
+        if self._downloads is not None:
+            self._downloads.close()
+            self._downloads = None
+        if self._pipeline is not None:
+            self._pipeline.stop()
+            self._pipeline = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._receiving = False
+
+    def send_image(self, img_path, chat, priority=None, progress=None):
+        """Queue an image to the chat
+        ``progress(bytes_sent, total_bytes)`` is called as the upload advances"""
+        self._flush_coalesced(chat)
+        kwargs = {} if progress is None else {"progress": progress}
+        return self._schedule(chat, self._send_image, img_path, chat, priority=priority, **kwargs)
+
+    def send_file(self, filepath, chat, priority=None, progress=None, split=None):
+        """Queue a file to the chat
+        ``progress(bytes_sent, total_bytes)`` is called as the upload advances
+        If ``split`` (by default the ``split_uploads`` option) is true, files larger than
+        the upload limit of the backend are sent in parts, see ``splitting``"""
+        self._flush_coalesced(chat)
+        kwargs = {} if progress is None else {"progress": progress}
+        if split is None:
+            split = self._config.getboolean("DEFAULT", "split_uploads", fallback=False)
+        part_size = self._config.getint("DEFAULT", "upload_part_size", fallback=self._max_upload)
+        if split and part_size and os.path.getsize(filepath) > part_size:
+            return self._send_parts(filepath, chat, part_size, priority, **kwargs)
+        return self._schedule(chat, self._send_file, filepath, chat, priority=priority, **kwargs)
+
+    def _send_parts(self, filepath, chat, part_size, priority, **kwargs):
+        """Send the file in parts followed by the manifest with their checksums
+        Returns the result of sending the manifest"""
+        parts, manifest = split_file(filepath, part_size)
+        logger.info("Sending %s in %d parts", filepath, len(parts))
+        for part in parts:
+            self._schedule(chat, self._send_file, part, chat, priority=priority, **kwargs)
+        return self._schedule_message(manifest, chat, priority=priority)
+
+    def _send_image(self, img_path, chat, progress=None):
         """Sends an image"""
         logger.error("This backend does not implement sending images")
 
-    def send_file(self, filepath, chat):
+    def _send_file(self, filepath, chat, progress=None):
         """Sends a file"""
         logger.error("This backend does not implement sending files")
 
-    def download_file(self, file_id, file_path):
-        """Downloads a file using urllib.
-        Understands file_id as the url
+    @property
+    def downloads(self):
+        """Manager of the downloads of the backend, the number of simultaneous
+        downloads is given by ``download_workers``"""
+        with self._send_queue_lock:
+            if self._downloads is None:
+                workers = self._config.getint(
+                    "DEFAULT", "download_workers", fallback=DEFAULT_DOWNLOAD_WORKERS
+                )
+                self._downloads = DownloadManager(self.transport, workers=workers)
+            return self._downloads
+
+    def download_file(self, file_id, file_path, finalize=None):
+        """Downloads a file in the background, understands file_id as the url
+        Returns a Future with the path of the file (which can differ from ``file_path``
+        if it already exists), see ``DownloadManager.submit`` for ``finalize``
         """
-        return urllib.request.urlretrieve(file_id, file_path)
+        return self.downloads.submit(file_id, file_path, finalize=finalize)
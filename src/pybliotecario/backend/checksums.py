@@ -0,0 +1,34 @@
+"""
+sha256 checksums of files, read in chunks so that the memory used does not depend on their size
+
+Used by the file id cache, the downloads and the splitting of large uploads.
+"""
+
+import hashlib
+
+CHUNK_SIZE = 1 << 20
+
+
+def hash_stream(f, *digests, size=None, out=None, chunk_size=CHUNK_SIZE):
+    """Read ``size`` bytes (by default, until the end) of the binary file ``f``
+    and update all ``digests`` with them, writing them also to ``out`` if given
+    Returns the number of bytes read"""
+    read = 0
+    while size is None or read < size:
+        block = f.read(chunk_size if size is None else min(chunk_size, size - read))
+        if not block:
+            break
+        for digest in digests:
+            digest.update(block)
+        if out is not None:
+            out.write(block)
+        read += len(block)
+    return read
+
+
+def sha256_file(path):
+    """Return a sha256 object updated with the content of the file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        hash_stream(f, digest)
+    return digest
@@ -0,0 +1,101 @@
+"""
+Break long messages into chunks that the backends can send
+
+The chunks are yielded lazily. Each chunk is at most ``max_size`` long, measured in the units
+of the platform: Unicode code points or, as Telegram does, UTF-16 code units
+(characters outside the Basic Multilingual Plane, such as most emoji, count twice).
+
+Messages are broken preferably at the end of a paragraph, then of a line, then of a word,
+as long as that does not make the chunk shorter than half the maximum size.
+With ``markdown=True`` the entities open at the end of a chunk (*bold*, _italic_, `code`
+and ```pre```) are closed and opened again at the start of the next chunk.
+"""
+
+CODEPOINT = "codepoint"
+UTF16 = "utf16"
+UNITS = (CODEPOINT, UTF16)
+
+_BOUNDARIES = ("\n\n", "\n", " ")
+# Markdown markers in the order in which they need to be checked
+_MARKERS = ("```", "`", "*", "_")
+# Room left in every chunk to close the markdown entities
+_MARKDOWN_RESERVE = len("".join(_MARKERS))
+
+
+def _char_size(char, unit):
+    if unit == UTF16 and ord(char) > 0xFFFF:
+        return 2
+    return 1
+
+
+def message_size(text, unit=CODEPOINT):
+    """Length of the text in the given unit"""
+    if unit == UTF16:
+        return len(text.encode("utf-16-le")) // 2
+    return len(text)
+
+
+def _prefix_end(text, start, max_size, unit):
+    """Return the largest index ``end`` such that text[start:end] is at most max_size long"""
+    if unit == CODEPOINT:
+        return min(len(text), start + max_size)
+    size = 0
+    end = start
+    while end < len(text):
+        size += _char_size(text[end], unit)
+        if size > max_size:
+            break
+        end += 1
+    return end
+
+
+def _open_entities(chunk):
+    """Return the markdown markers which are left open at the end of the chunk"""
+    open_markers = []
+    i = 0
+    while i < len(chunk):
+        for marker in _MARKERS:
+            if not chunk.startswith(marker, i):
+                continue
+            in_code = open_markers and open_markers[-1] in ("```", "`")
+            if open_markers and open_markers[-1] == marker:
+                open_markers.pop()
+            elif not in_code:
+                open_markers.append(marker)
+            i += len(marker) - 1
+            break
+        i += 1
+    return open_markers
+
+
+def chunk_message(text, max_size, unit=CODEPOINT, markdown=False):
+    """Yield the chunks of text, see the module documentation"""
+    if unit not in UNITS:
+        raise ValueError(f"Unit {unit} not understood, options are: {UNITS}")
+    if markdown:
+        if max_size <= 2 * _MARKDOWN_RESERVE:
+            raise ValueError(f"max_size must be larger than {2 * _MARKDOWN_RESERVE} for markdown")
+        max_size -= 2 * _MARKDOWN_RESERVE
+
+    prefix = ""
+    start = 0
+    while start < len(text):
+        end = _prefix_end(text, start, max_size, unit)
+        next_start = end
+        if end < len(text):
+            for boundary in _BOUNDARIES:
+                position = text.rfind(boundary, start, end)
+                if position - start > (end - start) // 2:
+                    end = position
+                    next_start = position + len(boundary)
+                    break
+        chunk = prefix + text[start:end]
+        start = next_start
+        prefix = ""
+        if markdown:
+            open_markers = _open_entities(chunk)
+            if open_markers and start < len(text):
+                chunk += "".join(reversed(open_markers))
+                prefix = "".join(open_markers)
+        if chunk.strip():
+            yield chunk
@@ -0,0 +1,161 @@
+"""
+Merge consecutive text messages to the same chat into a single message
+
+When a component sends many small messages in a short time (alerts, one message per stock...)
+the ``MessageCoalescer`` holds them for ``window`` seconds and sends them together
+(separated by newlines) as long as the result does not exceed the size limit of the backend.
+This reduces the number of requests and of notifications received by the user.
+"""
+
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+from pybliotecario.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n"
+
+COALESCED = REGISTRY.counter(
+    "pybliotecario_coalesced_messages_total", "Messages merged into a previous message"
+)
+
+
+class _Batch:
+    """Messages waiting to be sent together"""
+
+    def __init__(self, priority, deadline):
+        self.priority = priority
+        self.deadline = deadline
+        self.texts = []
+        self.futures = []
+        self.length = 0
+
+    def fits(self, length, priority, max_size):
+        if priority != self.priority:
+            return False
+        return self.length + len(SEPARATOR) + length <= max_size
+
+    def add(self, text, length):
+        future = Future()
+        if self.texts:
+            self.length += len(SEPARATOR)
+        self.texts.append(text)
+        self.futures.append(future)
+        self.length += length
+        return future
+
+
+def _chain(source, futures):
+    """Propagate the result of the ``source`` future to ``futures``"""
+
+    def propagate(done):
+        error = done.exception()
+        for future in futures:
+            if error is None:
+                future.set_result(done.result())
+            else:
+                future.set_exception(error)
+
+    source.add_done_callback(propagate)
+
+
+class MessageCoalescer:
+    """
+    Hold the text messages sent to a chat for ``window`` seconds and send them as one
+
+    Parameters
+    ----------
+        send_function: callable
+            called as ``send_function(chat, text, priority)`` to send the merged message,
+            it can return a Future
+        window: float
+            seconds to wait, counted from the first message of the batch
+        max_size: int
+            maximum length of a merged message
+        size: callable
+            function returning the length of a message
+    """
+
+    def __init__(self, send_function, window=0.25, max_size=4096, size=len):
+        self._send = send_function
+        self._size = size
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}
+        self._closed = False
+        self._condition = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def add(self, chat, text, priority):
+        """Add a message to the batch of the chat, returns a Future with the result of the send"""
+        length = self._size(text)
+        with self._send_lock:
+            with self._condition:
+                if self._closed:
+                    raise RuntimeError("The coalescer has been closed")
+                batch = self._batches.get(chat)
+                if batch is not None and batch.fits(length, priority, self.max_size):
+                    COALESCED.inc()
+                    return batch.add(text, length)
+                full_batch = self._batches.pop(chat, None)
+                batch = _Batch(priority, time.monotonic() + self.window)
+                self._batches[chat] = batch
+                future = batch.add(text, length)
+                self._condition.notify_all()
+            if full_batch is not None:
+                self._send_batch(chat, full_batch)
+        return future
+
+    def _send_batch(self, chat, batch):
+        try:
+            result = self._send(chat, SEPARATOR.join(batch.texts), batch.priority)
+        except Exception as e:
+            for future in batch.futures:
+                future.set_exception(e)
+            return
+        if isinstance(result, Future):
+            _chain(result, batch.futures)
+        else:
+            for future in batch.futures:
+                future.set_result(result)
+
+    def _pop(self, chats):
+        with self._condition:
+            return [(chat, self._batches.pop(chat)) for chat in chats if chat in self._batches]
+
+    def flush(self, chat=None):
+        """Send now the messages waiting for ``chat`` (or for all chats)"""
+        with self._send_lock:
+            chats = list(self._batches) if chat is None else [chat]
+            for batch_chat, batch in self._pop(chats):
+                self._send_batch(batch_chat, batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                deadlines = [b.deadline for b in self._batches.values()]
+                if not deadlines or min(deadlines) > now:
+                    self._condition.wait(min(deadlines) - now if deadlines else None)
+                    continue
+                expired = [chat for chat, b in self._batches.items() if b.deadline <= now]
+            # Batches are popped and sent under the send lock so that
+            # a batch is never overtaken by a later batch of the same chat
+            with self._send_lock:
+                for chat, batch in self._pop(expired):
+                    self._send_batch(chat, batch)
+
+    def close(self):
+        """Send everything still waiting and stop the background thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self.flush()
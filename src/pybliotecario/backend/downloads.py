@@ -0,0 +1,152 @@
+"""
+Background downloads of the files received by the backends
+
+The ``DownloadManager`` downloads files in a pool of ``workers`` threads so that the
+message handler can acknowledge a file while a large download finishes in the background.
+Every download:
+    - is streamed in chunks of ``chunk_size`` bytes to a partial file next to the target
+    - is resumed with an HTTP Range request if the connection drops (or if a partial
+      file is left by a previous run)
+    - is hashed (sha256) while it is written
+    - is moved atomically into place once complete, so a file with the target name
+      is never half-written. If the name is taken, a random suffix is added to it.
+      Instead, a ``finalize`` function can be given to decide what to do with the file
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import logging
+import os
+from pathlib import Path
+import uuid
+
+import requests
+
+from pybliotecario.backend.checksums import sha256_file
+from pybliotecario.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+CHUNK_SIZE = 256 * 1024
+PART_SUFFIX = ".part"
+
+# Errors after which the download is resumed
+_INTERRUPTED = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+DOWNLOADED_BYTES = REGISTRY.counter(
+    "pybliotecario_downloaded_bytes_total", "Bytes written by the download manager"
+)
+
+
+def claim_path(file_path):
+    """Create an empty file at ``file_path`` and return its path
+    If the name is taken, a random suffix is added instead of looking for a free name"""
+    file_path = Path(file_path)
+    while True:
+        try:
+            os.close(os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return file_path
+        except FileExistsError:
+            token = uuid.uuid4().hex[:8]
+            file_path = file_path.with_name(f"{file_path.stem}-{token}{file_path.suffix}")
+
+
+def part_path(url, file_path):
+    """Partial file for the download of ``url`` into ``file_path``
+    The name is stable so that an interrupted download can be resumed"""
+    file_path = Path(file_path)
+    key = hashlib.sha1(url.encode()).hexdigest()[:12]
+    return file_path.with_name(f".{file_path.name}.{key}{PART_SUFFIX}")
+
+
+class DownloadManager:
+    """
+    Download files in the background
+
+    Parameters
+    ----------
+        transport: pybliotecario.backend.transport.Transport
+            transport used for the requests
+        workers: int
+            maximum number of simultaneous downloads
+        chunk_size: int
+            size of the chunks written to disk
+        retries: int
+            number of times a download is resumed after a connection error
+    """
+
+    def __init__(self, transport, workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE, retries=3):
+        self.transport = transport
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+
+    def submit(self, url, file_path, finalize=None):
+        """Download ``url`` into ``file_path``
+        ``url`` can be a callable which returns the url, called in the background
+        If given, ``finalize(partial_path, sha256, file_path)`` is called with the complete
+        download instead of moving it to ``file_path`` and its return value is the result.
+        Returns a Future with the final path of the file, or None if there was no url"""
+        return self._executor.submit(self._download, url, Path(file_path), finalize)
+
+    def _download(self, url, file_path, finalize=None):
+        if callable(url):
+            url = url()
+        if not url:
+            return None
+        partial = part_path(url, file_path)
+        for attempt in range(self.retries + 1):
+            try:
+                digest = self._fetch(url, partial)
+                break
+            except _INTERRUPTED as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Download of %s interrupted (%s), resuming", file_path.name, e)
+        if finalize is not None:
+            return finalize(partial, digest.hexdigest(), file_path)
+        final_path = claim_path(file_path)
+        os.replace(partial, final_path)
+        logger.info("Downloaded %s", final_path)
+        return final_path
+
+    def _fetch(self, url, partial):
+        """Write the content of ``url`` into ``partial``, continuing from its current size
+        Returns the sha256 of the whole file"""
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        response = self.transport.get(url, endpoint="download", stream=True, headers=headers)
+        with response:
+            if response.status_code == 416:
+                # The partial file is already complete
+                return sha256_file(partial)
+            response.raise_for_status()
+            # If the server ignores the range, start from the beginning
+            if response.status_code == 206:
+                mode, digest = "ab", sha256_file(partial)
+            else:
+                mode, digest = "wb", hashlib.sha256()
+            with open(partial, mode) as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    DOWNLOADED_BYTES.inc(amount=len(chunk))
+        return digest
+
+    def close(self, wait=True):
+        """Stop accepting downloads, by default wait for the ones in progress"""
+        self._executor.shutdown(wait=wait)
+
+
+def as_future(result):
+    """Wrap a result which is not a Future (backends without background downloads) in one"""
+    if isinstance(result, Future):
+        return result
+    future = Future()
+    future.set_result(result)
+    return future
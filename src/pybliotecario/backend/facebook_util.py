@@ -2,7 +2,7 @@
 """
 Facebook backend
 
-Using this backend will stat a flask server in the selected port.
+Using this backend will start a server for the webhook in the selected port.
 Testing this backend is a bit of a pain as one has to be in a server
 which facebook should be able to access with a valid SSL certificate.
 
@@ -10,41 +10,67 @@ For quick testing, I am using the following setup:
 ~$ iptables -A INPUT -p tcp --dport 3000  -j ACCEPT
 ~$ ngrok http <my_personal_server>:3000
 
-And then I open the flask server in the port 3000 and give facebook
+And then I open the server in the port 3000 and give facebook
 the ngrok url.
 For actual deployment one would want to set up some actual server.
+
+The webhook (``FacebookUtil.wsgi_app``) only puts the updates in a queue and acknowledges them,
+so that facebook does not retry while a slow command runs: the updates are acted upon
+by ``act_on_updates`` (in the daemon, by the workers of the dispatcher).
+By default it is served by a threaded server of the standard library,
+with ``wsgi_server = waitress`` in the FACEBOOK section it is served with ``waitress``.
 """
 
 import json
 import logging
 import pathlib
+from urllib.parse import parse_qs
 
-import requests
-
-from pybliotecario.backend.basic_backend import Backend, Message
-
-_HAS_FLASK = True
-try:
-    from flask import Flask, request
-except ModuleNotFoundError:
-    # Don't raise the error until this is not actually used
-    _HAS_FLASK = False
+from pybliotecario.backend.basic_backend import REQUEST_SECONDS, Backend, Message
+from pybliotecario.backend.multipart import FileRange, MultipartBody
+from pybliotecario.backend.polling import UpdatePipeline
+from pybliotecario.backend.webhook import MAX_BODY, WEBHOOK_REQUESTS, make_wsgi_server
 
 logger = logging.getLogger(__name__)
 
 FB_API = "https://graph.facebook.com/v2.12/me/messages"
 MAX_SIZE = 2000
+WEBHOOK_PATH = "/webhook"
 
 
 class FacebookMessage(Message):
     """Facebook implementation's of the Message class"""
 
+    __slots__ = ()
     _type = "facebook"
-    _group_info = None
+
+    @staticmethod
+    def split_update(update):
+        """Facebook batches in a single request several entries, each of them with several
+        messaging events which can carry several attachments.
+        Break the update into a list of updates with one event and at most one attachment each,
+        i.e., one update per message, keeping the structure of the original update
+        """
+        if update.get("object") != "page":
+            return [update]
+        updates = []
+        for entry in update.get("entry", []):
+            for event in entry.get("messaging", []):
+                msg = event.get("message", {})
+                attachments = msg.get("attachments")
+                if attachments:
+                    events = [
+                        {**event, "message": {**msg, "attachments": [at]}} for at in attachments
+                    ]
+                else:
+                    events = [event]
+                updates += [{**update, "entry": [{**entry, "messaging": [e]}]} for e in events]
+        return updates
 
     def _parse_update(self, update):
         """Receives an update in the form of a dictionary (that came from a json)
         and fills the message attributes
+        Only the first event (and attachment) is read, see ``split_update``
         """
         # Check whether it is the correct object, otherwise out
         if update.get("object") != "page":
@@ -52,24 +78,26 @@ class FacebookMessage(Message):
             logger.warning(update)
             self.ignore = True
             return
-        print(update)
+        logger.debug(update)
         msg_info = update["entry"][0]["messaging"][0]
         # Check who sent it
         sender_id = msg_info["sender"]["id"]
         self._chat_id = sender_id
-        # Get the msg
-        msg = msg_info["message"]
+        # Get the msg, other events (deliveries, reads, postbacks...) are ignored
+        msg = msg_info.get("message")
+        if msg is None:
+            self.ignore = True
+            return
         # get the text and parse it if necessary
-        self._parse_command(msg.get("text"))
-        # In facebook we have either text or image
-        # TODO: in facebook you can pass more than one img at once...
+        self._parse_command(msg.get("text", ""))
+        # In facebook we have either text or attachments
         attachment = msg.get("attachments")
-        if attachment is not None:
-            at_info = attachment[0]
+        if attachment:
             # Checked for images and files and seems to work
-            url = at_info["payload"]["url"]
-            self._file_id = url
-            self._text = url.split("?")[0].split("/")[-1]
+            url = attachment[0].get("payload", {}).get("url")
+            if url is not None:
+                self._file_id = url
+                self._text = url.split("?")[0].split("/")[-1]
 
 
 class FacebookUtil(Backend):
@@ -78,6 +106,8 @@ class FacebookUtil(Backend):
 
     _message_class = FacebookMessage
     _max_size = MAX_SIZE
+    # Attachments can be of up to 25 MB
+    _max_upload = 25 * 1000 * 1000
 
     def __init__(self, config=None, host="0.0.0.0", port=3000, **kwargs):
         super().__init__(config, **kwargs)
@@ -89,10 +119,6 @@ class FacebookUtil(Backend):
         except KeyError:
             raise ValueError("No facebook section found for facebook in pybliotecario.ini")
 
-        if not _HAS_FLASK:
-            # Raise the error now
-            raise ModuleNotFoundError("No module named 'flask', needed for Facebook backend")
-
         verify_token = fb_config.get("verify")
         page_token = fb_config.get("app_token")
 
@@ -100,98 +126,131 @@ class FacebookUtil(Backend):
         self.verify_token = verify_token
         self.port = port
         self.host = host
-        app = Flask(__name__)
-        # Load the listener into the webhook endpoint
-        app.add_url_rule("/webhook", "webhook", self.listener, methods=["POST", "GET"])
-        self.flask_app = app
-        self.action_function = None
+        self.wsgi_server = fb_config.get("wsgi_server", "threaded")
+        self.wsgi_threads = fb_config.getint("wsgi_threads", fallback=None)
+        self.server = None
+        capacity = self._queue_size if self._queue_size > 0 else 100
+        self._updates = UpdatePipeline(
+            None, capacity=capacity, policy=self._queue_policy, is_droppable=self._is_droppable
+        )
         self.auth = {"access_token": self.page_access_token}
 
-    def validate_hook(self):
+    def validate_hook(self, query):
         """Facebook needs to validate the webhook
-        This is a small utility to do so
+        This is a small utility to do so, returns the challenge if the token is correct
         """
-
-    def listener(self):
-        """Main function flask will use to listen at the webhook endpoint"""
-        if request.method == "GET":
-            if request.args.get("hub.verify_token") == self.verify_token:
-                return request.args.get("hub.challenge")
-            else:
-                return "incorrect"
-
-        if request.method == "POST":
-            msg = self._message_class(request.json)
-            self.action_function(msg)
-            logger.info(msg)
-            # After we have finished return a 200 Ok
-            return "All ok"
-
-    def act_on_updates(self, action_function, not_empty=False):
-        """Sets the action function to be used by the listener and then
-        opens the webhook to wait ofr updates and act on them
+        query = parse_qs(query)
+        if query.get("hub.verify_token", [None])[0] == self.verify_token:
+            return query.get("hub.challenge", [""])[0]
+        return "incorrect"
+
+    def listener(self, method, body=b"", query=""):
+        """Act on a request to the webhook, returns the status and the content of the answer
+        The updates are queued (one per message) and acknowledged immediately,
+        they are acted upon by ``act_on_updates``
+        and the attachments are downloaded in the background, ``download_workers`` at a time
         """
-        self.action_function = action_function
-        self.flask_app.run(host=self.host, port=self.port, debug=self._debug)
+        if method == "GET":
+            return "200 OK", self.validate_hook(query)
+        if method != "POST":
+            return "405 Method Not Allowed", ""
+        try:
+            update = json.loads(body)
+        except ValueError:
+            WEBHOOK_REQUESTS.inc("bad_request")
+            return "400 Bad Request", ""
+        for single_update in self._message_class.split_update(update):
+            self._updates.put(single_update)
+        WEBHOOK_REQUESTS.inc("ok")
+        return "200 OK", "All ok"
+
+    def wsgi_app(self, environ, start_response):
+        """WSGI application of the webhook"""
+        if environ.get("PATH_INFO") != WEBHOOK_PATH:
+            status, content = "404 Not Found", ""
+        else:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            if length > MAX_BODY:
+                status, content = "413 Payload Too Large", ""
+            else:
+                body = environ["wsgi.input"].read(length) if length else b""
+                status, content = self.listener(
+                    environ["REQUEST_METHOD"], body, environ.get("QUERY_STRING", "")
+                )
+        content = content.encode()
+        headers = [("Content-Type", "text/plain"), ("Content-Length", str(len(content)))]
+        start_response(status, headers)
+        return [content]
+
+    def _start_receiving(self):
+        """Start serving the webhook in the background"""
+        if self.server is None:
+            self.server = make_wsgi_server(
+                (self.host, self.port), self.wsgi_app, self.wsgi_server, threads=self.wsgi_threads
+            )
+            self.server.start()
+        return super()._start_receiving()
 
     def _get_updates(self, not_empty=False):
-        """This class skips get_updates and uses act_on_updates directly"""
-        pass
+        """Return the updates received by the webhook"""
+        return self._updates.get_batch(block=not_empty)
+
+    def _interrupt(self):
+        self._updates.interrupt()
+
+    def close(self):
+        """Stop the webhook and close the backend"""
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        self._updates.stop()
+        super().close()
 
-    def send_message(self, text, chat, **kwargs):
+    def _send_message(self, text, chat, **kwargs):
         """Sends a message response to facebook
-        If the message is greater than MAX_SIZE characters it gets broken into several msgs
+        Messages greater than MAX_SIZE characters are broken into several msgs by ``send_message``
         """
-        break_char = self._break_msg(text)
-        payload = {"message": {"text": text[:break_char]}, "recipient": {"id": chat}}
-        response = requests.post(FB_API, params=self.auth, json=payload)
-        if len(text) > break_char:
-            return self.send_message(text[break_char:], chat, **kwargs)
+        payload = {"message": {"text": text}, "recipient": {"id": chat}}
+        with REQUEST_SECONDS.time("facebook", "message"):
+            response = self.transport.post(
+                FB_API, endpoint="message", params=self.auth, json=payload
+            )
         return response.json()
 
-    def send_data(self, payload):
+    def send_data(self, fields, files, progress=None):
         """Sends data to facebook messenger.
-        This method uses MultipartEncoder: https://toolbelt.readthedocs.io/
-        to stream multipart form-data
+        The files are streamed from disk as multipart form-data, see ``multipart.MultipartBody``
         """
-        try:
-            from requests_toolbelt import MultipartEncoder
-        except ModuleNotFoundError as e:
-            raise ModuleNotFoundError(
-                "Install 'requests-toolbelt' to send images and files to facebook"
-            ) from e
-
-        encoded_payload = MultipartEncoder(payload)
-        header = {"Content-Type": encoded_payload.content_type}
-        response = requests.post(FB_API, params=self.auth, data=encoded_payload, headers=header)
+        with MultipartBody(fields, files, progress=progress) as body:
+            header = {"Content-Type": body.content_type}
+            with REQUEST_SECONDS.time("facebook", "attachment"):
+                response = self.transport.post(
+                    FB_API, endpoint="attachment", params=self.auth, data=body, headers=header
+                )
         return response.json()
 
-    def send_image(self, img_path, chat):
+    def _attachment(self, chat, attachment_type):
+        return {
+            "recipient": json.dumps({"id": chat}),
+            "message": json.dumps(
+                {"attachment": {"type": attachment_type, "payload": {"is_reusable": True}}}
+            ),
+        }
+
+    def _send_image(self, img_path, chat, progress=None):
         """Sends an image to facebook
         Basically the requests form of the curl command here:
         https://developers.facebook.com/docs/messenger-platform/send-messages#url
         """
         img = pathlib.Path(img_path)
-        payload = {
-            "recipient": json.dumps({"id": chat}),
-            "message": json.dumps(
-                {"attachment": {"type": "image", "payload": {"is_reusable": True}}}
-            ),
-            "filedata": (img.stem, img.read_bytes(), f"image/{img.suffix[1:]}"),
-        }
-        return self.send_data(payload)
+        files = {"filedata": (img.stem, img, f"image/{img.suffix[1:]}")}
+        return self.send_data(self._attachment(chat, "image"), files, progress=progress)
 
-    def send_file(self, filepath, chat):
+    def _send_file(self, filepath, chat, progress=None):
         """Sends a file to fb, similar to send_image"""
-        fff = pathlib.Path(filepath)
-        payload = {
-            "recipient": json.dumps({"id": chat}),
-            "message": json.dumps(
-                {"attachment": {"type": "file", "payload": {"is_reusable": True}}}
-            ),
-            "filedata": (fff.name, fff.read_bytes()),
-        }
-        return self.send_data(payload)
+        fff = filepath if isinstance(filepath, FileRange) else pathlib.Path(filepath)
+        files = {"filedata": (fff.name, fff)}
+        return self.send_data(self._attachment(chat, "file"), files, progress=progress)
 
 
 if __name__ == "__main__":
@@ -203,4 +262,5 @@ if __name__ == "__main__":
     config = ConfigParser()
     config["FACEBOOK"] = {"verify": verify, "app_token": app_token}
     fb_util = FacebookUtil(config, debug=True)
-    fb_util.act_on_updates(lambda x: print(x))
+    while True:
+        fb_util.act_on_updates(print, not_empty=True)
@@ -0,0 +1,103 @@
+"""
+On-disk cache of the ids given by the platform to the files already uploaded
+
+Telegram answers every upload with a ``file_id`` which can be used to send the same file again
+without uploading its content. The cache maps the hash of the content of a file (and the kind
+of upload, as a photo and a document get different ids) to that ``file_id`` so that sending
+the same picture or report again is a request of a few bytes.
+
+The cache is a json file (by default ``main_folder/file_ids.json``) which is replaced
+atomically on every change. Only the ``max_entries`` most recently used ids are kept.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+from pybliotecario.backend.checksums import sha256_file
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = "file_ids.json"
+
+
+class FileIdCache:
+    """
+    Map from (content hash, kind) to the file_id of an uploaded file
+
+    Parameters
+    ----------
+        path: str or Path
+            json file in which the cache is stored
+        max_entries: int
+            maximum number of ids to remember
+    """
+
+    def __init__(self, path, max_entries=1000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._ids = {}
+        # Digests of the files already hashed, keyed by (path, size, mtime),
+        # at most max_entries of them (the most recently used)
+        self._digests = {}
+        self._read()
+
+    def _read(self):
+        if not self.path.exists():
+            return
+        try:
+            self._ids = json.loads(self.path.read_text(encoding="utf-8"))
+        except ValueError:
+            logger.error("The file id cache at %s is corrupted, ignoring it", self.path)
+
+    def _write(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._ids), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+    def digest(self, filepath):
+        """Hash of the content of the file, files not modified since the last call
+        are not read again"""
+        stat = os.stat(filepath)
+        key = (str(Path(filepath).resolve()), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.pop(key, None)
+            if digest is not None:
+                self._digests[key] = digest
+                return digest
+        # The file is read without holding the lock
+        digest = sha256_file(filepath).hexdigest()
+        with self._lock:
+            self._digests[key] = digest
+            while len(self._digests) > self.max_entries:
+                del self._digests[next(iter(self._digests))]
+        return digest
+
+    def get(self, digest, kind):
+        """Return the file_id stored for the digest and kind of upload, None if unknown"""
+        key = f"{kind}:{digest}"
+        with self._lock:
+            file_id = self._ids.pop(key, None)
+            if file_id is not None:
+                # Move it to the end, as the most recently used
+                self._ids[key] = file_id
+            return file_id
+
+    def put(self, digest, kind, file_id):
+        """Store the file_id of an upload"""
+        key = f"{kind}:{digest}"
+        with self._lock:
+            self._ids.pop(key, None)
+            self._ids[key] = file_id
+            while len(self._ids) > self.max_entries:
+                del self._ids[next(iter(self._ids))]
+            self._write()
+
+    def discard(self, digest, kind):
+        """Forget a file_id, for instance when the server no longer accepts it"""
+        with self._lock:
+            if self._ids.pop(f"{kind}:{digest}", None) is not None:
+                self._write()
@@ -0,0 +1,219 @@
+"""
+On-disk journal of the updates received by a backend
+
+The journal allows the pybliotecario to be restarted (or to crash) without
+losing updates and without acting twice on the same update.
+It lives in a folder (by default ``main_folder/journal``) with two files:
+
+    - updates.jsonl: append-only log with one line per event:
+            {"id": update_id, "update": {...}}  when the update is received
+            {"id": update_id, "started": true}  when the update starts being processed
+            {"id": update_id, "processed": true, "offset": committed_offset}  once done
+    - state.json: the committed offset and the ids of the last processed updates,
+      written when the log is compacted (once it grows over twice the retention)
+
+The updates received together are written (and forced to disk) at once.
+Processed entries are only flushed, not forced to disk: if one is lost (e.g., on a power cut)
+the update is found started after the restart and it is not repeated either.
+
+Upon recovery, updates which were received but never started are processed again,
+while updates which were started but never finished are considered done,
+so that commands with side effects (``/kill_pid``, ``/script``, downloads...) are never repeated.
+"""
+
+from collections import deque
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+logger = logging.getLogger(__name__)
+
+LOG_NAME = "updates.jsonl"
+STATE_NAME = "state.json"
+
+
+class UpdateJournal:
+    """
+    Journal of received and processed updates
+
+    Parameters
+    ----------
+        folder: str or Path
+            folder in which to store the journal
+        retention: int
+            number of processed update ids to remember
+        fsync: bool
+            whether to force every write to disk
+    """
+
+    def __init__(self, folder, retention=1000, fsync=True):
+        self.folder = Path(folder)
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.retention = retention
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._log_path = self.folder / LOG_NAME
+        self._state_path = self.folder / STATE_NAME
+        self._processed = deque(maxlen=retention)
+        self._processed_set = set()
+        self.committed_offset = None
+        self.last_received = None
+        self._log_lines = 0
+        self._read_state()
+        self._log = self._log_path.open("a", encoding="utf-8")
+
+    def _read_state(self):
+        if not self._state_path.exists():
+            return
+        try:
+            state = json.loads(self._state_path.read_text(encoding="utf-8"))
+        except ValueError:
+            logger.error("The journal state at %s is corrupted, ignoring it", self._state_path)
+            return
+        self.committed_offset = state.get("committed_offset")
+        self.last_received = state.get("last_received")
+        for update_id in state.get("processed", []):
+            self._remember(update_id)
+
+    def _remember(self, update_id):
+        """Add an id to the bounded set of processed updates"""
+        if update_id in self._processed_set:
+            return
+        if len(self._processed) == self._processed.maxlen:
+            self._processed_set.discard(self._processed[0])
+        self._processed.append(update_id)
+        self._processed_set.add(update_id)
+
+    def _write_state(self):
+        """Atomically replace the state file"""
+        state = {
+            "committed_offset": self.committed_offset,
+            "last_received": self.last_received,
+            "processed": list(self._processed),
+        }
+        tmp_path = self._state_path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(state, f)
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self._state_path)
+
+    def _append(self, *entries, fsync=True):
+        for entry in entries:
+            self._log.write(json.dumps(entry))
+            self._log.write("\n")
+        self._log.flush()
+        if fsync and self._fsync:
+            os.fsync(self._log.fileno())
+        self._log_lines += len(entries)
+
+    def _read_log(self):
+        """Read all entries of the log, a truncated last line is ignored"""
+        if not self._log_path.exists():
+            return
+        with self._log_path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring corrupted journal entry")
+
+    def is_processed(self, update_id):
+        """Whether the update has already been processed"""
+        with self._lock:
+            if self.committed_offset is not None and update_id < self.committed_offset:
+                return True
+            return update_id in self._processed_set
+
+    def received(self, update_id, update):
+        """Write the update to the journal before processing it"""
+        self.received_many([(update_id, update)])
+
+    def received_many(self, updates):
+        """Write a batch of ``(update_id, update)`` to the journal at once"""
+        if not updates:
+            return
+        with self._lock:
+            self._append(*({"id": update_id, "update": update} for update_id, update in updates))
+            last_received = max(update_id for update_id, _ in updates)
+            if self.last_received is None or last_received > self.last_received:
+                self.last_received = last_received
+
+    def started(self, update_id):
+        """Register that the update is being acted upon"""
+        with self._lock:
+            self._append({"id": update_id, "started": True})
+
+    def processed(self, update_id, committed_offset=None):
+        """Register that the update has been processed"""
+        with self._lock:
+            self._remember(update_id)
+            if committed_offset is not None:
+                self.committed_offset = committed_offset
+            entry = {"id": update_id, "processed": True, "offset": committed_offset}
+            self._append(entry, fsync=False)
+            if self._log_lines > 2 * self.retention:
+                self._compact()
+
+    def _compact(self):
+        """Save the state and rewrite the log keeping only the updates not processed"""
+        self._write_state()
+        entries = [
+            entry
+            for entry in self._read_log()
+            if entry["id"] not in self._processed_set
+            and (self.committed_offset is None or entry["id"] >= self.committed_offset)
+        ]
+        self._log.close()
+        tmp_path = self._log_path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry))
+                f.write("\n")
+        os.replace(tmp_path, self._log_path)
+        self._log = self._log_path.open("a", encoding="utf-8")
+        self._log_lines = len(entries)
+
+    def recover(self):
+        """Read the journal and return the list of updates that were received
+        but never processed. Updates which started being processed before a crash
+        are marked as processed and not returned."""
+        received = {}
+        started = set()
+        with self._lock:
+            self._log_lines = 0
+            for entry in self._read_log():
+                self._log_lines += 1
+                update_id = entry["id"]
+                if entry.get("processed"):
+                    self._remember(update_id)
+                    if entry.get("offset") is not None:
+                        self.committed_offset = entry["offset"]
+                    continue
+                if entry.get("started"):
+                    started.add(update_id)
+                elif "update" in entry:
+                    received[update_id] = entry["update"]
+                if self.last_received is None or update_id > self.last_received:
+                    self.last_received = update_id
+
+        for update_id in list(received):
+            if self.is_processed(update_id):
+                received.pop(update_id)
+        started = [update_id for update_id in started if not self.is_processed(update_id)]
+        for update_id in sorted(started):
+            logger.warning("Update %s was interrupted, it will not be processed again", update_id)
+            received.pop(update_id, None)
+            self.processed(update_id)
+
+        if received:
+            logger.info("Recovered %d updates from the journal", len(received))
+        return [received[i] for i in sorted(received)]
+
+    def close(self):
+        """Close the log file"""
+        with self._lock:
+            self._log.close()
@@ -0,0 +1,159 @@
+"""
+Streaming multipart/form-data bodies for the uploads of the backends
+
+``requests`` builds the whole body of a request with ``files=`` in memory, so sending a file
+of some GB needs some GB of memory. A ``MultipartBody`` is instead a file-like object with a
+known length which reads the files from disk only as the body is sent, ``chunk_size`` bytes
+at a time, so the memory used by an upload does not depend on the size of the file.
+
+    with MultipartBody({"chat_id": 1234}, {"document": ("report.tar.gz", path)}) as body:
+        transport.post(url, data=body, headers={"Content-Type": body.content_type})
+
+The files are opened when the body reaches them and closed as soon as they have been read
+(or when the body is closed). The body can be rewound with ``seek(0)`` to send it again.
+Instead of a path, a ``FileRange`` uploads only part of a file, without copying it.
+"""
+
+import mimetypes
+import os
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+_CRLF = b"\r\n"
+
+
+class FileRange:
+    """``size`` bytes of the file at ``path`` starting at ``offset``, uploaded as a file called ``name``"""
+
+    def __init__(self, path, offset, size, name):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.name = name
+
+    def __repr__(self):
+        return f"FileRange({self.path}, {self.offset}, {self.size}, {self.name})"
+
+
+def _quote(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class MultipartBody:
+    """
+    Body of a multipart/form-data request read lazily from disk
+
+    Parameters
+    ----------
+        fields: dict
+            form fields, ``{name: value}``
+        files: dict
+            files to upload, ``{name: (filename, path)}`` or ``{name: (filename, path, mime)}``
+            where path can be a ``FileRange``
+        progress: callable
+            called as ``progress(bytes_read, total_bytes)`` every time a chunk is read
+        chunk_size: int
+            maximum number of bytes read from the files at once
+    """
+
+    def __init__(self, fields=None, files=None, progress=None, chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.chunk_size = chunk_size
+        # The body is a list of segments, either bytes or (path, size, offset) for the files
+        self._segments = []
+        for name, value in (fields or {}).items():
+            header = f'Content-Disposition: form-data; name="{_quote(name)}"'
+            self._add_part(header, None)
+            self._segments.append(str(value).encode())
+        for name, (filename, path, *mime) in (files or {}).items():
+            mime = mime[0] if mime else None
+            mime = mime or mimetypes.guess_type(str(filename))[0] or "application/octet-stream"
+            header = (
+                f'Content-Disposition: form-data; name="{_quote(name)}"; '
+                f'filename="{_quote(filename)}"'
+            )
+            self._add_part(header, mime)
+            if isinstance(path, FileRange):
+                self._segments.append((path.path, path.size, path.offset))
+            else:
+                self._segments.append((path, os.path.getsize(path), 0))
+        self._segments.append(_CRLF + f"--{self.boundary}--".encode() + _CRLF)
+        self._length = sum(len(s) if isinstance(s, bytes) else s[1] for s in self._segments)
+        self._index = 0
+        self._offset = 0
+        self._position = 0
+        self._file = None
+        self._remaining = 0
+
+    def _add_part(self, header, mime):
+        start = b"" if not self._segments else _CRLF
+        part = f"--{self.boundary}\r\n{header}\r\n"
+        if mime is not None:
+            part += f"Content-Type: {mime}\r\n"
+        self._segments.append(start + (part + "\r\n").encode())
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def _read_segment(self, size):
+        """Read up to ``size`` bytes of the current segment, b"" if it is exhausted"""
+        segment = self._segments[self._index]
+        if isinstance(segment, bytes):
+            chunk = segment[self._offset : self._offset + size]
+            self._offset += len(chunk)
+            return chunk
+        path, length, offset = segment
+        if self._file is None:
+            self._file = open(path, "rb")
+            self._file.seek(offset)
+            self._remaining = length
+        chunk = self._file.read(min(size, self.chunk_size, self._remaining))
+        self._remaining -= len(chunk)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def read(self, size=-1):
+        """Read up to ``size`` bytes of the body (at most ``chunk_size`` of a file at once)"""
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self._index < len(self._segments):
+            chunk = self._read_segment(size)
+            if chunk:
+                self._position += len(chunk)
+                if self.progress is not None:
+                    self.progress(self._position, self._length)
+                return chunk
+            self._index += 1
+            self._offset = 0
+        return b""
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Only rewinding to the start of the body is supported"""
+        if offset != 0 or whence != os.SEEK_SET:
+            raise OSError("MultipartBody can only be rewound to the start")
+        self.close()
+        self._index = 0
+        self._position = 0
+        self._offset = 0
+        return 0
+
+    def close(self):
+        """Close the file being read, if any"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
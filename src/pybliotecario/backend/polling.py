@@ -0,0 +1,268 @@
+"""
+Utilities to receive updates from the backends
+
+- UpdatePipeline: polls the backend in a background thread and stores the updates in a bounded queue
+- OffsetTracker: keeps track of which updates have been fully processed
+- Backoff: exponential backoff with jitter to wait after a failed poll
+- PollStats: counters for the outcome and latency of the polls
+"""
+
+from collections import deque
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+POLICIES = (BLOCK, DROP_OLDEST)
+
+
+class UpdatePipeline:
+    """
+    Fetch updates in a background thread so that the polling of the backend
+    and the processing of the updates can happen at the same time.
+
+    The updates are stored in a queue of limited capacity, when the queue
+    is full the policy decides what to do:
+        - block: stop polling until the consumer makes some room
+        - drop_oldest: drop the oldest update for which ``is_droppable`` is True,
+                       if there are none, block
+
+    Parameters
+    ----------
+        fetch_function: callable
+            function returning a list of updates, can block
+        capacity: int
+            maximum number of updates to keep in memory
+        policy: str
+            one of "block" or "drop_oldest"
+        is_droppable: callable
+            receives an update and returns True if the update can be dropped
+    """
+
+    def __init__(self, fetch_function, capacity=100, policy=BLOCK, is_droppable=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Policy {policy} not understood, options are: {POLICIES}")
+        if capacity < 1:
+            raise ValueError("The capacity of the update queue must be at least 1")
+        self._fetch = fetch_function
+        self.capacity = capacity
+        self.policy = policy
+        if is_droppable is None:
+            is_droppable = lambda update: True
+        self._is_droppable = is_droppable
+        self._buffer = deque()
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._interrupted = False
+        self._thread = None
+        self.dropped = 0
+
+    @property
+    def running(self):
+        """Returns true if the poller thread is alive"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the poller thread"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="update-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Signal the poller to stop. Since the poller might be waiting for
+        a long-poll request, it is not always possible to join it immediately"""
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None and timeout is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                updates = self._fetch()
+            except Exception as e:
+                logger.error("The update poller failed: %s", e)
+                self._stop.wait(1)
+                continue
+            for update in updates:
+                if not self._put(update):
+                    return
+
+    def _make_room(self):
+        """Remove the oldest droppable update, return False if none was found"""
+        for update in self._buffer:
+            if self._is_droppable(update):
+                self._buffer.remove(update)
+                self.dropped += 1
+                logger.warning("Update queue full, dropping an update")
+                return True
+        return False
+
+    def _put(self, update):
+        """Add an update to the queue applying the backpressure policy
+        Returns False if the pipeline has been stopped while waiting"""
+        with self._condition:
+            while len(self._buffer) >= self.capacity:
+                if self._stop.is_set():
+                    return False
+                if self.policy == DROP_OLDEST and self._make_room():
+                    break
+                self._condition.wait()
+            self._buffer.append(update)
+            self._condition.notify_all()
+        return True
+
+    def put(self, update):
+        """Add an update pushed by the backend (e.g., through a webhook) instead of polled,
+        the caller waits if the queue is full (see the policy)
+        Returns False if the pipeline has been stopped"""
+        return self._put(update)
+
+    def interrupt(self):
+        """Make the consumer waiting in ``get_batch`` (or the next one to call it) return"""
+        with self._condition:
+            self._interrupted = True
+            self._condition.notify_all()
+
+    def get_batch(self, block=True, timeout=None):
+        """Return all updates currently in the queue
+        If ``block`` is True, wait until there is at least one update (or an interrupt)
+        """
+        with self._condition:
+            if block:
+                self._condition.wait_for(
+                    lambda: self._buffer or self._stop.is_set() or self._interrupted,
+                    timeout=timeout,
+                )
+            self._interrupted = False
+            batch = list(self._buffer)
+            self._buffer.clear()
+            self._condition.notify_all()
+        return batch
+
+
+class OffsetTracker:
+    """
+    Keep track of the updates which are being processed in order to know
+    up to which update everything has been dealt with.
+
+    The committed offset is the identifier of the first update which has not
+    been fully processed yet, i.e., all updates with an id smaller than the
+    committed offset are done.
+    """
+
+    def __init__(self, offset=None):
+        self._lock = threading.Condition()
+        self._pending = set()
+        self._offset = offset
+
+    def received(self, update_id):
+        """Register an update which is about to be processed"""
+        with self._lock:
+            self._pending.add(update_id)
+
+    def processed(self, update_id):
+        """Mark an update as processed and advance the offset if possible"""
+        with self._lock:
+            self._pending.discard(update_id)
+            if self._offset is None or update_id >= self._offset:
+                self._offset = update_id + 1
+            self._lock.notify_all()
+
+    def wait_processed(self, timeout=None):
+        """Wait until all received updates have been processed
+        Returns False if the timeout expired before"""
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._pending, timeout=timeout)
+
+    @property
+    def committed(self):
+        """Return the committed offset"""
+        with self._lock:
+            if self._pending:
+                return min(self._pending)
+            return self._offset
+
+
+# Possible outcomes of a poll
+OK = "ok"
+EMPTY = "empty"
+TIMEOUT = "timeout"
+CONNECTION_ERROR = "connection_error"
+BAD_RESPONSE = "bad_response"
+OUTCOMES = (OK, EMPTY, TIMEOUT, CONNECTION_ERROR, BAD_RESPONSE)
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter
+
+    The n-th consecutive delay is ``base*factor**n`` (up to ``maximum``)
+    randomly reduced by up to a fraction ``jitter`` so that many clients
+    failing at the same time do not retry at the same time.
+    """
+
+    def __init__(self, base=1.0, factor=2.0, maximum=60.0, jitter=0.5):
+        self.base = base
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        """Return the time to wait before the next attempt"""
+        delay = min(self.maximum, self.base * self.factor**self.attempts)
+        if delay < self.maximum:
+            # Don't keep growing the exponent once the maximum has been reached
+            self.attempts += 1
+        return delay * (1.0 - self.jitter * random.random())
+
+    def wait(self):
+        """Sleep for the next delay, returns the time slept"""
+        delay = self.next_delay()
+        time.sleep(delay)
+        return delay
+
+    def reset(self):
+        """Reset the backoff after a successful attempt"""
+        self.attempts = 0
+
+
+class PollStats:
+    """Count the outcome of every poll and keep track of their latency"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(OUTCOMES, 0)
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def record(self, outcome, latency):
+        """Record the outcome and latency (in seconds) of a poll"""
+        with self._lock:
+            self.counts[outcome] += 1
+            self.total_latency += latency
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+
+    @property
+    def polls(self):
+        """Total number of polls"""
+        return sum(self.counts.values())
+
+    def as_dict(self):
+        """Return a copy of the statistics as a dictionary"""
+        with self._lock:
+            ret = dict(self.counts)
+            ret["total_latency"] = self.total_latency
+            ret["max_latency"] = self.max_latency
+            ret["last_latency"] = self.last_latency
+        return ret
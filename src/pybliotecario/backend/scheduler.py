@@ -0,0 +1,265 @@
+"""
+Outbound send queue respecting the flood limits of the backends
+
+Telegram answers with 429 (Too Many Requests) when a bot sends more than about
+one message per second to the same chat or about 30 messages per second overall.
+The ``SendScheduler`` queues the sends and runs them in background workers
+at the maximum rate allowed by two token buckets: one per chat and a global one.
+
+Sends are queued by priority so that replies to the user (``INTERACTIVE``)
+jump ahead of long outputs such as digests (``BULK``). Within a chat the sends
+of a given priority keep their order. The priority of the sends done while acting
+on a message is set with the ``send_priority`` context manager.
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from pybliotecario.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 10
+
+DEFAULT_CHAT_RATE = 1.0
+DEFAULT_CHAT_BURST = 3
+DEFAULT_GLOBAL_RATE = 30.0
+DEFAULT_WORKERS = 4
+
+QUEUED = REGISTRY.gauge("pybliotecario_send_queue", "Sends waiting in the outbound queue")
+
+_priority = contextvars.ContextVar("send_priority", default=BULK)
+
+
+@contextmanager
+def send_priority(priority):
+    """Sends scheduled inside this context get the given priority"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    """Priority of the sends scheduled in the current context"""
+    return _priority.get()
+
+
+class TokenBucket:
+    """
+    Allow ``rate`` events per second on average, with bursts of up to ``capacity`` events
+    Not thread-safe, the scheduler takes care of the locking
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Seconds until a token is available (0 if there is one now)"""
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        """Consume one token"""
+        self._refill()
+        self._tokens -= 1
+
+
+class SendScheduler:
+    """
+    Priority queue of sends drained by background workers within the rate limits
+
+    Every chat has a FIFO of sends per priority. The chats which can send are kept
+    in a heap ordered by their first send (by priority and then by order of arrival),
+    while the chats that have run out of tokens wait in a heap ordered by the time
+    they get one back, so that picking the next send does not go through the whole queue.
+
+    Parameters
+    ----------
+        chat_rate: float
+            sends per second allowed to a single chat
+        chat_burst: int
+            number of sends to a chat that can be done at once before being limited
+        global_rate: float
+            sends per second allowed overall
+        workers: int
+            number of sends that can be in flight at the same time (to different chats)
+    """
+
+    def __init__(
+        self,
+        chat_rate=DEFAULT_CHAT_RATE,
+        chat_burst=DEFAULT_CHAT_BURST,
+        global_rate=DEFAULT_GLOBAL_RATE,
+        workers=DEFAULT_WORKERS,
+        clock=time.monotonic,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._clock = clock
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)), clock=clock)
+        self._chats = {}
+        # For every chat with sends waiting, a FIFO of sends for each priority
+        self._queues = {}
+        # Heap of (priority, order, chat) with the first send of the chats that can send
+        # entries left behind when the first send changes are skipped
+        self._ready = []
+        # Heap of (time, chat) with the chats waiting for a token of their bucket
+        self._throttled = []
+        self._throttled_chats = set()
+        self._waiting = 0
+        self._counter = itertools.count()
+        # Chats with a send in flight, so that sends to a chat are never reordered
+        self._busy = set()
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._run, name=f"sender-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, chat, function, *args, priority=None, **kwargs):
+        """Queue ``function(*args, **kwargs)`` as a send to ``chat``, returns a Future
+        If no priority is given, the one of the current context is used"""
+        if priority is None:
+            priority = current_priority()
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The send queue has been closed")
+            item = (priority, next(self._counter), chat, function, args, kwargs, future)
+            queues = self._queues.setdefault(chat, {})
+            queues.setdefault(priority, deque()).append(item)
+            self._waiting += 1
+            self._pending += 1
+            if self._first(chat) is item:
+                self._make_ready(chat)
+            self._condition.notify_all()
+        QUEUED.inc()
+        return future
+
+    def _bucket(self, chat):
+        bucket = self._chats.get(chat)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst, clock=self._clock)
+            self._chats[chat] = bucket
+        return bucket
+
+    def _first(self, chat):
+        """First send waiting for the chat, None if there are none"""
+        queues = self._queues.get(chat)
+        if not queues:
+            return None
+        return queues[min(queues)][0]
+
+    def _make_ready(self, chat):
+        """Add the chat to the heap of chats that can send, if it has something to send"""
+        first = self._first(chat)
+        if first is not None and chat not in self._busy and chat not in self._throttled_chats:
+            heapq.heappush(self._ready, (first[0], first[1], chat))
+
+    def _pop_first(self, chat):
+        """Remove the first send of the chat from its queue"""
+        queues = self._queues[chat]
+        priority = min(queues)
+        item = queues[priority].popleft()
+        if not queues[priority]:
+            del queues[priority]
+            if not queues:
+                del self._queues[chat]
+        self._waiting -= 1
+        return item
+
+    def _next_ready(self):
+        """Return the first item (by priority) that can be sent now and remove it from the queue
+        otherwise return None and the time to wait"""
+        global_delay = self._global.delay()
+        if global_delay > 0:
+            return None, global_delay
+        now = self._clock()
+        while self._throttled and self._throttled[0][0] <= now:
+            _, chat = heapq.heappop(self._throttled)
+            self._throttled_chats.discard(chat)
+            self._make_ready(chat)
+        while self._ready:
+            priority, order, chat = heapq.heappop(self._ready)
+            first = self._first(chat)
+            if first is None or first[:2] != (priority, order) or chat in self._busy:
+                # The chat has changed since it was added to the heap
+                continue
+            if chat in self._throttled_chats:
+                continue
+            delay = self._bucket(chat).delay()
+            if delay > 0:
+                heapq.heappush(self._throttled, (now + delay, chat))
+                self._throttled_chats.add(chat)
+                continue
+            return self._pop_first(chat), 0
+        if self._throttled:
+            return None, max(self._throttled[0][0] - now, 0)
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed and not self._waiting:
+                        return
+                    item, wait = self._next_ready() if self._waiting else (None, None)
+                    if item is not None:
+                        break
+                    self._condition.wait(wait)
+                _, _, chat, function, args, kwargs, future = item
+                self._global.take()
+                self._bucket(chat).take()
+                self._busy.add(chat)
+            QUEUED.dec()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except Exception as e:
+                    logger.error("Failed to send to %s: %s", chat, e)
+                    future.set_exception(e)
+
+            with self._condition:
+                self._busy.discard(chat)
+                self._make_ready(chat)
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all queued sends are done, returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def close(self, timeout=None):
+        """Send everything left in the queue and stop the workers"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
@@ -0,0 +1,120 @@
+"""
+Send files larger than the upload limit of the backend in parts
+
+The file is not copied: every part is a ``multipart.FileRange`` read from the original file
+as it is uploaded. The parts are called ``<name>.001``, ``<name>.002``... and, after them,
+a manifest message with the sha256 of every part and of the whole file is sent, e.g.:
+
+    big.tar.gz was sent in 3 parts, join them with: pybliotecario --join big.tar.gz.001
+    9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08  big.tar.gz.001
+    ...
+    2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae  big.tar.gz
+
+The checksum lines follow the format of ``sha256sum``. Once downloaded, ``join_parts``
+(``pybliotecario --join``) puts the file back together and, if the manifest has been saved
+next to the parts as ``<name>.sha256``, checks every part and the result against it.
+"""
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+from pybliotecario.backend.checksums import hash_stream
+from pybliotecario.backend.multipart import FileRange
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = ".sha256"
+
+
+def part_name(name, index):
+    """Name of the part ``index`` (starting at 1) of the file ``name``"""
+    return f"{name}.{index:03d}"
+
+
+def split_file(filepath, part_size):
+    """Break the file in parts of at most ``part_size`` bytes
+    The file is read once to compute the checksums of the parts and of the whole file
+    Returns the list of parts (as ``FileRange``) and the text of the manifest"""
+    filepath = Path(filepath)
+    total = hashlib.sha256()
+    parts = []
+    lines = []
+    with open(filepath, "rb") as f:
+        while True:
+            offset = f.tell()
+            digest = hashlib.sha256()
+            size = hash_stream(f, digest, total, size=part_size)
+            if size == 0:
+                break
+            name = part_name(filepath.name, len(parts) + 1)
+            parts.append(FileRange(filepath, offset, size, name))
+            lines.append(f"{digest.hexdigest()}  {name}")
+    lines.append(f"{total.hexdigest()}  {filepath.name}")
+    header = (
+        f"{filepath.name} was sent in {len(parts)} parts, "
+        f"join them with: pybliotecario --join {parts[0].name if parts else filepath.name}"
+    )
+    return parts, "\n".join([header] + lines)
+
+
+def _read_manifest(manifest_path):
+    """Read the checksums of a manifest (lines which are not checksums are ignored)"""
+    checksums = {}
+    for line in Path(manifest_path).read_text().splitlines():
+        digest, _, name = line.partition("  ")
+        if len(digest) == 64 and name:
+            checksums[name.strip()] = digest
+    return checksums
+
+
+def find_parts(first_part):
+    """Return the name of the original file and the list of parts found next to ``first_part``"""
+    first_part = Path(first_part)
+    base, _, number = first_part.name.rpartition(".")
+    if not base or not number.isdigit():
+        raise ValueError(f"{first_part} is not a part, the name should end in .001, .002...")
+    parts = []
+    index = 1
+    while True:
+        part = first_part.with_name(part_name(base, index))
+        if not part.exists():
+            break
+        parts.append(part)
+        index += 1
+    if not parts:
+        raise ValueError(f"{first_part.with_name(part_name(base, 1))} not found")
+    return base, parts
+
+
+def join_parts(first_part, output=None):
+    """Concatenate the parts of a file into ``output`` (by default the original name)
+    If a manifest ``<name>.sha256`` is found next to the parts, the checksums are verified
+    Returns the path of the joined file and its sha256"""
+    base, parts = find_parts(first_part)
+    folder = parts[0].parent
+    output = folder / base if output is None else Path(output)
+    manifest = folder / (base + MANIFEST_SUFFIX)
+    checksums = _read_manifest(manifest) if manifest.exists() else {}
+
+    total = hashlib.sha256()
+    tmp_output = output.with_name(f".{output.name}.joining")
+    try:
+        with open(tmp_output, "wb") as out:
+            for part in parts:
+                digest = hashlib.sha256()
+                with open(part, "rb") as f:
+                    hash_stream(f, digest, total, out=out)
+                expected = checksums.get(part.name)
+                if expected is not None and expected != digest.hexdigest():
+                    raise ValueError(f"The checksum of {part.name} does not match the manifest")
+        expected = checksums.get(base)
+        if expected is not None and expected != total.hexdigest():
+            raise ValueError(f"The checksum of {base} does not match the manifest")
+        os.replace(tmp_output, output)
+    finally:
+        if tmp_output.exists():
+            tmp_output.unlink()
+    logger.info("Joined %d parts into %s", len(parts), output)
+    return output, total.hexdigest()
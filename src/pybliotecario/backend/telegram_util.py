@@ -5,19 +5,52 @@ Telegram backend
 
 import json
 import logging
-from time import sleep
+from pathlib import Path
+import secrets
+import threading
+from time import monotonic
 import urllib
 
 import requests
 
-from pybliotecario.backend.basic_backend import Backend, Message
+from pybliotecario.backend import polling
+from pybliotecario.backend.basic_backend import POLLS, REQUEST_SECONDS, Backend, Message
+from pybliotecario.backend.chunker import UTF16
+from pybliotecario.backend.file_cache import CACHE_NAME, FileIdCache
+from pybliotecario.backend.multipart import FileRange, MultipartBody
 
 TELEGRAM_URL = "https://api.telegram.org/"
+EMPTY_RESPONSE = '{ "ok": true, "result": [] }'
+# Maximum number of updates that Telegram returns at once
+MAX_UPDATES_LIMIT = 100
+# Extra seconds given to a long-poll request before considering it timed out
+_POLL_MARGIN = 10
 
 logger = logging.getLogger(__name__)
 
+# Method and field of the upload requests for each kind of file
+_UPLOADS = {"photo": ("sendPhoto", "photo"), "document": ("sendDocument", "document")}
+
 # Keys included in telegram chats that basically are telling you to ignore it
 IGNOREKEYS = {"new_chat_participant", "left_chat_participant", "sticker", "game", "contact"}
+# Keys from which the username is taken (in the list, last has more priority)
+USER_NAMING = ("last_name", "first_name", "username")
+
+
+def _uploaded_file_id(response):
+    """Return the file_id given by Telegram to an uploaded file, None if not found"""
+    try:
+        result = response.json()["result"]
+        for key in ("photo", "document", "animation", "video", "audio"):
+            if key in result:
+                uploaded = result[key]
+                # Photos come in several sizes, all of them with the same content
+                if isinstance(uploaded, list):
+                    uploaded = uploaded[-1]
+                return uploaded["file_id"]
+    except (ValueError, KeyError, TypeError, IndexError):
+        pass
+    return None
 
 
 def log_request(status_code, reason, content):
@@ -27,45 +60,42 @@ def log_request(status_code, reason, content):
 
 
 class TelegramMessage(Message):
-    """Telegram implementation of the Message class"""
+    """Telegram implementation of the Message class
+    The username and the group information are only parsed when needed"""
 
+    __slots__ = ("_group_info",)
     _type = "Telegram"
-    _group_info = None
+    _lazy_fields = ("username", "group_info")
+    # Types of update the message understands, the rest are not even requested to Telegram
+    update_types = ("message", "edited_message", "edited_channel_post")
+
+    def _message(self, update):
+        """Return the message (or edited message, or channel post) contained in the update"""
+        message = None
+        for msg_type in self.update_types:
+            if msg_type in update:
+                message = update[msg_type]
+        return message
 
     def _parse_update(self, update):
         """Receives an update in the form of a dictionary (that came from a json)
         and fills the message attributes
         """
-        keys = update.keys()
         # First check whether this is a message, edited message or a channel post
-        msg_types = ["message", "edited_message", "edited_channel_post"]
-        msg = None
-        for msg_type in msg_types:
-            if msg_type in keys:
-                msg = msg_type
-        if msg is None:
-            logger.warning(f"Message not in {msg_types}, ignoring")
+        message = self._message(update)
+        if message is None:
+            logger.warning(f"Message not in {self.update_types}, ignoring")
             logger.warning(update)
             self.ignore = True
             return
-        message = update[msg]
         # Get the keys of the message (and check whether it should be ignored)
-        msg_keys = message.keys()
-        if set(msg_keys) & IGNOREKEYS:
+        if not IGNOREKEYS.isdisjoint(message):
             self.ignore = True
             return
         # Now get the chat data and id
-        chat_data = message["chat"]
-        self._chat_id = chat_data["id"]
-        # I believe from and chat_data are only different when using a group
-        # but the pybliotecario has not really been tested (or used) in groups...
-        from_data = message.get("from", chat_data)
-
-        # Populate the user (in the list, last has more priority)
-        username = "unknown_user"
-        for user_naming in ["last_name", "first_name", "username"]:
-            username = from_data.get(user_naming, username)
-        self._username = username
+        self._chat_id = message["chat"]["id"]
+        # The username and group information are parsed from the message if needed
+        self._source = message
 
         # Check the filetype
         text = None
@@ -86,18 +116,41 @@ class TelegramMessage(Message):
             # Normal text message
             text = message.get("text", "")
 
-        # In Telegram we can also have groups
-        if "group" in chat_data:
-            self._group_info = chat_data
-
         # Finally, with the piece of text left, parse the possible command
         # _parse_command will fill both text and command
         self._parse_command(text)
 
+    def _lazy_source(self, message):
+        # Keep only the names of the user and the chat data of groups
+        chat_data = message["chat"]
+        from_data = message.get("from", chat_data)
+        source = {"from": {key: from_data[key] for key in USER_NAMING if key in from_data}}
+        if "group" in chat_data:
+            source["chat"] = chat_data
+        return source
+
+    def _parse_username(self, message):
+        # I believe from and chat_data are only different when using a group
+        # but the pybliotecario has not really been tested (or used) in groups...
+        from_data = message["from"] if "from" in message else message["chat"]
+
+        # Populate the user
+        username = "unknown_user"
+        for user_naming in USER_NAMING:
+            username = from_data.get(user_naming, username)
+        return username
+
+    def _parse_group_info(self, message):
+        # In Telegram we can also have groups
+        chat_data = message.get("chat", {})
+        if "group" in chat_data:
+            return chat_data
+        return None
+
     @property
     def is_group(self):
         """Returns true if the message was from a group"""
-        return self._group_info is not None
+        return self._lazy("group_info") is not None
 
 
 class TelegramUtil(Backend):
@@ -105,14 +158,23 @@ class TelegramUtil(Backend):
     Telegram"""
 
     _message_class = TelegramMessage
-
-    def __init__(self, config=None, token=None, timeout=300, **kwargs):
+    _prefetch = True
+    _journaled = True
+    # Telegram counts the length of the messages in UTF-16 code units
+    _max_size = 4096
+    _size_unit = UTF16
+    # Files sent by bots can be of up to 50 MB
+    _max_upload = 50 * 1000 * 1000
+
+    def __init__(self, config=None, token=None, timeout=300, webhook=None, **kwargs):
         super().__init__(config, **kwargs)
         if token is None:
             if config is None:
                 raise ValueError("Either a config or a token must be provided for Telegram")
             token = config.defaults().get("token")
 
+        # Offset of the next getUpdates request, updates are acknowledged by Telegram
+        # when they are fetched, the offset of the processed updates is ``committed_offset``
         self.offset = None
         self.timeout = timeout
         # Build app the API urls
@@ -123,19 +185,51 @@ class TelegramUtil(Backend):
         self.send_doc = base_URL + "sendDocument"
         self.get_msg = base_URL + "getUpdates"
         self.get_file = base_URL + "getFile"
+        self.set_webhook = base_URL + "setWebhook"
+        self.delete_webhook = base_URL + "deleteWebhook"
+        self.poll_stats = polling.PollStats()
+        self._backoff = polling.Backoff()
+        self.allowed_updates, self.updates_limit = self._update_filter()
+        self._file_cache = None
+        self._file_cache_lock = threading.Lock()
+
+        # In webhook mode the updates are pushed by Telegram to a local server
+        if webhook is None:
+            webhook = self._config.getboolean("DEFAULT", "webhook", fallback=False)
+        self.webhook = webhook
+        self.webhook_server = None
+        self._webhook_updates = None
+        self._webhook_registered = False
+        if webhook:
+            # the updates are already waiting in a queue, no need to prefetch them
+            self._prefetch = False
+
+    def _update_filter(self):
+        """Read the types of update to ask for and the maximum number of updates per request
+        from the ``allowed_updates`` (comma separated) and ``updates_limit`` options
+        By default only the updates the message class can act upon are requested"""
+        allowed = self._config.get("DEFAULT", "allowed_updates", fallback=None)
+        if allowed is None:
+            allowed_updates = list(self._message_class.update_types)
+        else:
+            allowed_updates = [i.strip() for i in allowed.split(",") if i.strip()]
+        limit = self._config.getint("DEFAULT", "updates_limit", fallback=MAX_UPDATES_LIMIT)
+        if not 1 <= limit <= MAX_UPDATES_LIMIT:
+            raise ValueError(f"updates_limit must be between 1 and {MAX_UPDATES_LIMIT}")
+        return allowed_updates, limit
 
     def __make_request(self, url):
         """Returns the response for a given url
-        In case of timeout, emulate an empty response
+        In case of timeout or connection error, emulate an empty response
         """
-        content = '{ "ok": true, "result": [] }'
+        content = EMPTY_RESPONSE
+        method = url.rsplit("/", 1)[-1].split("?")[0]
         try:
-            response = requests.get(url, timeout=self.timeout)
+            with REQUEST_SECONDS.time("telegram", method):
+                response = self.transport.get(url, endpoint=method)
             content = response.content.decode("utf-8")
         except requests.exceptions.Timeout:
-            logger.warning("Timeout. Sleeping for 2 minutes...")
-            # After a timeout, sleep for 1 minute
-            sleep(60)
+            logger.warning("Timeout while waiting for Telegram")
         except requests.exceptions.ConnectionError as e:
             logger.error(e)
         return content
@@ -157,6 +251,19 @@ class TelegramUtil(Backend):
             li.append(int(update["update_id"]))
         self.offset = max(li) + 1
 
+    def _update_id(self, update):
+        return int(update["update_id"])
+
+    def _resume_from(self, update_id):
+        self.offset = max(self.offset or 0, update_id + 1)
+
+    def _is_droppable(self, update):
+        """Only updates which are not commands can be dropped"""
+        for msg_type in ("message", "edited_message", "edited_channel_post"):
+            if msg_type in update:
+                return not update[msg_type].get("text", "").startswith("/")
+        return True
+
     def _get_filepath(self, file_id):
         """Given a file id, retrieve the URI of the file
         in the remote server
@@ -174,86 +281,267 @@ class TelegramUtil(Backend):
             logger.info(url)
             return None
 
-    def _get_updates(self, not_empty=False):
-        """
-        Returns a json with the last messages the bot has received
-        when an offset is found, previous msg are not retrieved
-        We use longpolling to keep the connection open for timeout seconds
-
-        If not_empty = True, this function will only return when a message arrives
+    def _poll(self):
+        """Do one long-poll request for updates
+        Returns the outcome of the poll (see ``polling.OUTCOMES``) and the list of updates
         """
-        url = f"{self.get_msg}?timeout={self.timeout}"
+        url = f"{self.get_msg}?timeout={self.timeout}&limit={self.updates_limit}"
+        # An empty list means every type of update for Telegram
+        if self.allowed_updates:
+            allowed = urllib.parse.quote(json.dumps(self.allowed_updates))
+            url += f"&allowed_updates={allowed}"
         if self.offset:
             url += f"&offset={self.offset}"
-        updates = self.__get_json_from_url(url)
 
-        if not updates and not_empty:
-            return self._get_updates(not_empty=True)
+        result = []
+        start = monotonic()
+        try:
+            # Give the server some margin to answer an empty long-poll
+            # failed polls are not retried here but in _get_updates
+            response = self.transport.get(
+                url, endpoint="getUpdates", timeout=self.timeout + _POLL_MARGIN, retries=0
+            )
+            updates = response.json()
+            if updates.get("ok"):
+                result = updates["result"]
+                outcome = polling.OK if result else polling.EMPTY
+            else:
+                logger.error("Telegram returned an error: %s", updates.get("description"))
+                outcome = polling.BAD_RESPONSE
+        except requests.exceptions.Timeout:
+            logger.warning("Timeout while waiting for updates")
+            outcome = polling.TIMEOUT
+        except requests.exceptions.ConnectionError as e:
+            logger.error(e)
+            outcome = polling.CONNECTION_ERROR
+        except (ValueError, AttributeError, KeyError) as e:
+            # in case of a response we don't understand, log it and let the program run
+            logger.error("Error reading the updates: %s", e)
+            outcome = polling.BAD_RESPONSE
+        latency = monotonic() - start
+        self.poll_stats.record(outcome, latency)
+        POLLS.inc("telegram", outcome)
+        REQUEST_SECONDS.observe(latency, "telegram", "getUpdates")
 
         if self._debug:
             logger.info("Request url: %s", url)
-            logger.info("Obtained updates: %s", updates)
-
-        try:
-            result = updates["result"]
-        except Exception as e:
-            # in case of ANY exception, just logger.info it out and let the program run
-            logger.error("Error: ")
-            logger.error(str(e))
-            logger.error("List of updates: ")
-            logger.error(updates)
-            return []
+            logger.info("Obtained updates: %s", result)
 
         self.__re_offset(result)
-        return result
+        return outcome, result
+
+    def _start_webhook(self):
+        """Start the local server for the webhook and, if ``webhook_url`` is given,
+        tell Telegram to send the updates there
+
+        The options are read from the DEFAULT section of the configuration:
+            - webhook_url: public url of the webhook, its path is the path served locally
+            - webhook_host, webhook_port: where to listen (by default 127.0.0.1:8443,
+              i.e., behind a reverse proxy)
+            - webhook_secret: secret that Telegram includes in every request,
+              if not given a random one is used for every run
+
+        Telegram considers the updates delivered once they are answered,
+        so they are written to the journal (if any) before answering
+        """
+        # Only needed in webhook mode, not to slow down the command line
+        from pybliotecario.backend.webhook import WebhookServer
+
+        options = self._config.defaults()
+        url = options.get("webhook_url")
+        secret = options.get("webhook_secret")
+        if url and not secret:
+            secret = secrets.token_urlsafe(32)
+        if secret is None:
+            logger.warning("No webhook_secret given, the webhook requests are not authenticated")
+        path = (urllib.parse.urlparse(url).path or "/") if url else "/"
+        capacity = self._queue_size if self._queue_size > 0 else 100
+        self._webhook_updates = polling.UpdatePipeline(
+            None, capacity=capacity, policy=self._queue_policy, is_droppable=self._is_droppable
+        )
+        address = (
+            options.get("webhook_host", "127.0.0.1"),
+            self._config.getint("DEFAULT", "webhook_port", fallback=8443),
+        )
+        self.webhook_server = WebhookServer(
+            address, self._webhook_received, secret=secret, path=path
+        )
+        self.webhook_server.start()
+        if url:
+            self._register_webhook(url, secret)
+        else:
+            logger.warning("No webhook_url given, the webhook must be registered with setWebhook")
+
+    def _webhook_received(self, update):
+        """Write the update received by the webhook to the journal and queue it"""
+        if self._journal is not None:
+            self._journal.received(self._update_id(update), update)
+        self._webhook_updates.put(update)
+
+    def _register_webhook(self, url, secret):
+        data = {"url": url, "secret_token": secret}
+        if self.allowed_updates:
+            data["allowed_updates"] = json.dumps(self.allowed_updates)
+        response = self.transport.post(self.set_webhook, endpoint="setWebhook", data=data)
+        answer = response.json()
+        if not answer.get("ok"):
+            raise ValueError(f"Telegram rejected the webhook: {answer.get('description')}")
+        self._webhook_registered = True
+        logger.info("Webhook registered at %s", url)
+
+    def _start_receiving(self):
+        # The journal is opened first, so that all updates of the webhook are written to it
+        recovered = super()._start_receiving()
+        if self.webhook and self.webhook_server is None:
+            self._start_webhook()
+        return recovered
+
+    def _receive_updates(self, not_empty=False):
+        if self._webhook_updates is not None:
+            # Already written to the journal when they were received by the webhook
+            return self._webhook_updates.get_batch(block=not_empty)
+        return super()._receive_updates(not_empty=not_empty)
+
+    def _can_prefetch(self):
+        # Polling with a new offset confirms the previous updates to Telegram,
+        # without a journal they would be lost if the program stopped before acting upon them
+        return super()._can_prefetch() and self._journal is not None
+
+    def _interrupt(self):
+        if self._webhook_updates is not None:
+            self._webhook_updates.interrupt()
+        super()._interrupt()
+
+    def close(self):
+        """Stop the webhook (if any), so that updates can be polled again, and close the backend"""
+        if self.webhook_server is not None:
+            self.webhook_server.close()
+            self.webhook_server = None
+            self._webhook_updates.stop()
+        if self._webhook_registered:
+            try:
+                self.transport.post(self.delete_webhook, endpoint="deleteWebhook")
+            except requests.exceptions.RequestException as e:
+                logger.error("Could not remove the webhook: %s", e)
+            self._webhook_registered = False
+        super().close()
+
+    def _get_updates(self, not_empty=False):
+        """
+        Returns a json with the last messages the bot has received
+        when an offset is found, previous msg are not retrieved
+        We use longpolling to keep the connection open for timeout seconds
+
+        After a failed poll, wait for an exponentially growing time before trying again.
+        If not_empty = True, this function will only return when a message arrives
+
+        Since polling confirms the previous updates to Telegram, without a journal
+        wait until they have been processed before polling again
 
-    def send_message(self, text, chat, markdown=False, **kwargs):
+        In webhook mode, return the updates received by the webhook instead
+        """
+        if self._webhook_updates is not None:
+            return self._webhook_updates.get_batch(block=not_empty)
+        if self._journal is None:
+            self._offsets.wait_processed()
+            self._raise_failure()
+        while True:
+            outcome, result = self._poll()
+            if outcome in (polling.OK, polling.EMPTY):
+                self._backoff.reset()
+            else:
+                delay = self._backoff.wait()
+                logger.info("Polling failed (%s), waited %.1f seconds", outcome, delay)
+            if result or not not_empty:
+                return result
+
+    def _send_message(self, text, chat, markdown=False, **kwargs):
         """Send a message to a given chat"""
-        text = urllib.parse.quote_plus(text)
-        url = f"{self.send_msg}?text={text}&chat_id={chat}"
+        quoted_text = urllib.parse.quote_plus(text)
+        url = f"{self.send_msg}?text={quoted_text}&chat_id={chat}"
         if markdown:
             url += "&parse_mode=markdown"
         content = self.__make_request(url)
         # Sometimes, when using markdown, the update might fail
         if markdown and not json.loads(content).get("ok"):
             # If that's the case, try to resend without md
-            self.send_message(text, chat, **kwargs)
+            self._send_message(text, chat, **kwargs)
 
-    def send_image(self, img_path, chat):
-        """Send an image to a given chat"""
+    def _get_file_cache(self):
+        """Return the cache of uploaded file ids, None if disabled or if there is no main_folder"""
+        if not self._config.getboolean("DEFAULT", "file_id_cache", fallback=True):
+            return None
+        with self._file_cache_lock:
+            if self._file_cache is None:
+                main_folder = self._config.defaults().get("main_folder")
+                if not main_folder or not Path(main_folder).is_dir():
+                    return None
+                self._file_cache = FileIdCache(Path(main_folder) / CACHE_NAME)
+            return self._file_cache
+
+    def _upload(self, filepath, chat, kind, filename, progress=None):
+        """Send a photo or a document, by reference if the same content was uploaded before
+        If the server rejects the cached reference, forget it and upload the file
+        The file is streamed from disk, see ``multipart.MultipartBody``"""
+        method, field = _UPLOADS[kind]
+        url = self.send_img if kind == "photo" else self.send_doc
         data = {"chat_id": chat}
-        with open(img_path, "rb") as img:
-            files = {"photo": ("picture.jpg", img)}  # Here, the "rb" thing
-            blabla = requests.post(self.send_img, data=data, files=files)
+        # Parts of files (see splitting) are not cached
+        cache = None if isinstance(filepath, FileRange) else self._get_file_cache()
+        digest = None
+        if cache is not None:
+            digest = cache.digest(filepath)
+            file_id = cache.get(digest, kind)
+            if file_id is not None:
+                with REQUEST_SECONDS.time("telegram", method):
+                    response = self.transport.post(
+                        url, endpoint=method, data={**data, field: file_id}
+                    )
+                if response.ok:
+                    return response
+                logger.info("The file id of %s is no longer valid, uploading it", filepath)
+                cache.discard(digest, kind)
+
+        with MultipartBody(data, {field: (filename, filepath)}, progress=progress) as body:
+            headers = {"Content-Type": body.content_type}
+            with REQUEST_SECONDS.time("telegram", method):
+                response = self.transport.post(url, endpoint=method, data=body, headers=headers)
+        if cache is not None and response.ok:
+            file_id = _uploaded_file_id(response)
+            if file_id is not None:
+                cache.put(digest, kind, file_id)
+        return response
+
+    def _send_image(self, img_path, chat, progress=None):
+        """Send an image to a given chat"""
+        blabla = self._upload(img_path, chat, "photo", "picture.jpg", progress=progress)
         log_request(blabla.status_code, blabla.reason, blabla.content)
 
-    def send_file(self, filepath, chat):
-        data = {"chat_id": chat}
-        files = {"document": (filepath.name, filepath.open("rb"))}
-        blabla = requests.post(self.send_doc, data=data, files=files)
+    def _send_file(self, filepath, chat, progress=None):
+        name = filepath.name if isinstance(filepath, FileRange) else Path(filepath).name
+        blabla = self._upload(filepath, chat, "document", name, progress=progress)
         log_request(blabla.status_code, blabla.reason, blabla.content)
 
-    def send_file_by_url(self, file_url, chat):
+    def send_file_by_url(self, file_url, chat, priority=None):
         """
         Sends a file using the telegram api which allows to send by url
         it only works for images/pdf, and not all pdfs
         """
+        self._flush_coalesced(chat)
+        return self._schedule(chat, self._send_file_by_url, file_url, chat, priority=priority)
+
+    def _send_file_by_url(self, file_url, chat):
         data = {"chat_id": chat, "document": file_url}
-        blabla = requests.post(self.send_doc, data=data)
-        logger.info(blabla.status_code, blabla.reason, blabla.content)
+        with REQUEST_SECONDS.time("telegram", "sendDocument"):
+            blabla = self.transport.post(self.send_doc, endpoint="sendDocument", data=data)
+        log_request(blabla.status_code, blabla.reason, blabla.content)
 
-    def download_file(self, file_id, file_path):
-        """Download file defined by file_id to given file_path"""
-        file_url = self._get_filepath(file_id)
-        if not file_url:
-            return None
-        n = 0
-        # If the file already exists, iterate it by adding a nX
-        while file_path.exists():
-            new_name = f"n{n}-{file_path.name}"
-            file_path = file_path.parent / new_name
-            n += 1
-        return urllib.request.urlretrieve(file_url, file_path)
+    def download_file(self, file_id, file_path, finalize=None):
+        """Download file defined by file_id to given file_path in the background
+        Returns a Future with the final path, None if the file could not be found"""
+        return self.downloads.submit(
+            lambda: self._get_filepath(file_id), file_path, finalize=finalize
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+"""
+Shared HTTP transport for the backends
+
+All requests to the APIs of the backends go through a ``Transport``, which owns
+a keep-alive ``requests.Session`` so that the TCP and TLS handshakes are done once
+and the connections are reused by every message, file and download.
+
+The transport also:
+    - uses a timeout per endpoint (uploads and downloads get a longer one)
+    - retries requests which fail with a connection error or a 5xx status with exponential backoff,
+      sends (which must not be repeated) are only retried if the connection could not be opened,
+      a 5xx answer (e.g., from a gateway) does not tell whether the send was done
+    - retries requests rejected with a 429 after the time given by the server
+      (``retry_after`` in the Telegram answer or the ``Retry-After`` header)
+
+By default a single transport is shared by all backends in the process, see ``shared_transport``.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from pybliotecario.backend.polling import Backoff
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 30
+UPLOAD_TIMEOUT = 300
+# Endpoints which move files and need a longer timeout
+_UPLOAD_ENDPOINTS = ("sendPhoto", "sendDocument", "attachment", "download")
+# Endpoints which send something, doing them twice sends it twice
+_SEND_ENDPOINTS = ("sendMessage", "sendPhoto", "sendDocument", "message", "attachment")
+_IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Never wait more than this for a 429 to clear, return the response instead
+MAX_RETRY_AFTER = 120
+
+
+def retry_after(response):
+    """Return the number of seconds the server asks to wait before retrying, None if unknown"""
+    try:
+        parameters = response.json().get("parameters") or {}
+        if "retry_after" in parameters:
+            return float(parameters["retry_after"])
+    except (ValueError, AttributeError):
+        pass
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def is_idempotent(method, endpoint):
+    """Whether repeating the request has the same effect as doing it once"""
+    return method.upper() in _IDEMPOTENT_METHODS and endpoint not in _SEND_ENDPOINTS
+
+
+def _not_sent(error):
+    """Whether the request failed while opening the connection, i.e., it never reached the server
+    A read timeout or a connection dropped afterwards might come after the server acted on it"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.Timeout):
+        return False
+    reason = error.args[0] if error.args else None
+    # requests wraps the error of urllib3 in a MaxRetryError
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _rewind(files):
+    """Rewind the file objects of a multipart request so that it can be sent again"""
+    if not files:
+        return
+    for value in files.values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
+
+
+class Transport:
+    """
+    HTTP client with a pool of keep-alive connections, timeouts per endpoint and retries
+
+    Parameters
+    ----------
+        pool_size: int
+            maximum number of connections kept open per host
+        retries: int
+            number of times a failed request is retried
+        timeout: float
+            default timeout (in seconds) of the requests
+        timeouts: dict
+            timeout for specific endpoints, e.g. ``{"sendDocument": 300}``
+    """
+
+    def __init__(
+        self,
+        pool_size=DEFAULT_POOL_SIZE,
+        retries=DEFAULT_RETRIES,
+        timeout=DEFAULT_TIMEOUT,
+        timeouts=None,
+    ):
+        self.retries = retries
+        self.timeout = timeout
+        self.timeouts = dict.fromkeys(_UPLOAD_ENDPOINTS, UPLOAD_TIMEOUT)
+        self.timeouts.update(timeouts or {})
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def timeout_for(self, endpoint):
+        """Return the timeout of the given endpoint"""
+        return self.timeouts.get(endpoint, self.timeout)
+
+    def request(self, method, url, endpoint=None, timeout=None, retries=None, **kwargs):
+        """Do a request, retrying it if needed, and return the response
+        ``kwargs`` are passed to ``requests.Session.request``.
+        If the request fails with a connection error after all retries, the error is raised.
+        Requests which are not idempotent (see ``is_idempotent``) are only retried after
+        a connection error if the connection could not even be opened and never after a 5xx
+        """
+        if timeout is None:
+            timeout = self.timeout_for(endpoint)
+        if retries is None:
+            retries = self.retries
+        idempotent = is_idempotent(method, endpoint)
+        backoff = Backoff(base=0.5, maximum=10)
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if last_attempt or not (idempotent or _not_sent(e)):
+                    raise
+                delay = backoff.next_delay()
+                logger.warning("Request to %s failed (%s), retrying in %.1fs", endpoint, e, delay)
+            else:
+                if response.status_code == 429:
+                    delay = retry_after(response)
+                    if delay is None:
+                        delay = backoff.next_delay()
+                    if last_attempt or delay > MAX_RETRY_AFTER:
+                        return response
+                    logger.warning("Too many requests to %s, retrying in %.1fs", endpoint, delay)
+                elif response.status_code >= 500 and idempotent and not last_attempt:
+                    delay = backoff.next_delay()
+                    logger.warning("Server error %d at %s", response.status_code, endpoint)
+                else:
+                    return response
+                response.close()
+            _rewind(kwargs.get("files"))
+            if hasattr(kwargs.get("data"), "seek"):
+                # Streamed bodies, see multipart.MultipartBody
+                kwargs["data"].seek(0)
+            time.sleep(delay)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        """Close all open connections"""
+        self.session.close()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_transport(config=None):
+    """Return the transport shared by all backends of the process, creating it if needed
+    The first call configures it with the options of the DEFAULT section of ``config``:
+    ``http_pool_size``, ``http_retries``, ``http_timeout`` and ``http_upload_timeout``
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            options = {}
+            if config is not None:
+                upload_timeout = config.getfloat(
+                    "DEFAULT", "http_upload_timeout", fallback=UPLOAD_TIMEOUT
+                )
+                options = {
+                    "pool_size": config.getint(
+                        "DEFAULT", "http_pool_size", fallback=DEFAULT_POOL_SIZE
+                    ),
+                    "retries": config.getint("DEFAULT", "http_retries", fallback=DEFAULT_RETRIES),
+                    "timeout": config.getfloat("DEFAULT", "http_timeout", fallback=DEFAULT_TIMEOUT),
+                    "timeouts": dict.fromkeys(_UPLOAD_ENDPOINTS, upload_timeout),
+                }
+            _shared = Transport(**options)
+        return _shared
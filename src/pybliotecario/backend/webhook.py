@@ -0,0 +1,197 @@
+"""
+Local HTTP server which receives the updates pushed by the platform to a webhook
+
+Instead of asking for updates with a long-poll request, the platform POSTs every update
+(as json) to the url registered as webhook. Usually a reverse proxy terminates TLS
+and forwards the requests to this server.
+
+Every request must carry the secret given when the webhook was registered
+(in the ``X-Telegram-Bot-Api-Secret-Token`` header), otherwise it is rejected.
+Accepted updates are handed to ``on_update`` and acknowledged immediately,
+they are acted upon by the same code which acts on polled updates.
+
+Backends whose webhook is a WSGI application (e.g., Facebook) can be served with
+``make_wsgi_server``, either with a threaded server of the standard library or with ``waitress``.
+"""
+
+from hmac import compare_digest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from socketserver import ThreadingMixIn
+import threading
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from pybliotecario.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Updates are small, anything bigger than this is not an update
+MAX_BODY = 1 << 20
+_POLL_INTERVAL = 0.1
+
+WEBHOOK_REQUESTS = REGISTRY.counter(
+    "pybliotecario_webhook_requests_total", "Requests received by the webhook", ("outcome",)
+)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    # Keep the connections open, the platform sends many updates through the same one
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, outcome):
+        WEBHOOK_REQUESTS.inc(outcome)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY:
+            self.close_connection = True
+            return self._reply(413, "too_large")
+        body = self.rfile.read(length)
+        if self.path.split("?")[0] != server.path:
+            return self._reply(404, "not_found")
+        if server.secret is not None:
+            secret = self.headers.get(SECRET_HEADER, "")
+            if not compare_digest(secret.encode(), server.secret.encode()):
+                logger.warning("Webhook request with a wrong secret from %s", self.client_address)
+                return self._reply(401, "unauthorized")
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return self._reply(400, "bad_request")
+        server.on_update(update)
+        self._reply(200, "ok")
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP server for the webhook, serves in a background thread once started
+
+    Parameters
+    ----------
+        address: tuple
+            (host, port) in which to listen, with port 0 a free port is chosen
+        on_update: callable
+            called with every update received
+        secret: str
+            secret that the requests must include, None to accept every request
+        path: str
+            path of the webhook
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, on_update, secret=None, path="/"):
+        self.on_update = on_update
+        self.secret = secret
+        self.path = path
+        self._thread = None
+        super().__init__(address, _WebhookHandler)
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(
+            target=self.serve_forever, args=(_POLL_INTERVAL,), name="webhook", daemon=True
+        )
+        self._thread.start()
+        logger.info("Listening for updates at %s:%d%s", *self.server_address[:2], self.path)
+
+    def close(self):
+        """Stop serving"""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+
+class _WSGIHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    WSGI server of the standard library which serves every request in its own thread,
+    serves in a background thread once started
+
+    Parameters
+    ----------
+        address: tuple
+            (host, port) in which to listen, with port 0 a free port is chosen
+        app: callable
+            WSGI application
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, app, threads=None):
+        self._thread = None
+        super().__init__(address, _WSGIHandler)
+        self.set_app(app)
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(
+            target=self.serve_forever, args=(_POLL_INTERVAL,), name="webhook", daemon=True
+        )
+        self._thread.start()
+        logger.info("Listening for updates at %s:%d", *self.server_address[:2])
+
+    def close(self):
+        """Stop serving"""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+
+class WaitressServer:
+    """
+    Serve a WSGI application with ``waitress`` (a production server) in a background thread,
+    ``threads`` is the number of threads of waitress which answer the requests
+    """
+
+    def __init__(self, address, app, threads=None):
+        import waitress
+
+        kwargs = {} if threads is None else {"threads": threads}
+        self._server = waitress.create_server(app, host=address[0], port=address[1], **kwargs)
+        self.server_address = (address[0], self._server.effective_port)
+        self.server_port = self._server.effective_port
+        self._thread = None
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(target=self._server.run, name="webhook", daemon=True)
+        self._thread.start()
+        logger.info("Listening for updates at %s:%d (waitress)", *self.server_address)
+
+    def close(self):
+        """Stop serving"""
+        self._server.close()
+        if self._thread is not None:
+            self._thread.join(1)
+            self._thread = None
+
+
+WSGI_SERVERS = {"threaded": ThreadedWSGIServer, "waitress": WaitressServer}
+
+
+def make_wsgi_server(address, app, server="threaded", threads=None):
+    """Create (without starting it) a server of the kind ``server`` (see ``WSGI_SERVERS``)
+    for the WSGI application ``app``"""
+    try:
+        server_class = WSGI_SERVERS[server]
+    except KeyError:
+        raise ValueError(f"WSGI server {server} not understood, options are: {list(WSGI_SERVERS)}")
+    return server_class(address, app, threads=threads)
@@ -0,0 +1,102 @@
+"""
+Send a stream of messages read from stdin (``--stdin``) with a single backend
+
+Every record of the stream is a message, records are separated by newlines
+or, with ``--null``, by NUL characters (so that messages can span several lines).
+A record can start with a directive to send something else:
+
+    file:/path/to/file      sends the file
+    image:/path/to/image    sends the image
+    text:file: not a file   sends the text after ``text:`` verbatim
+
+The stream is read as it arrives, so the messages are sent while the producer is still running.
+
+    $ tail -f /var/log/alerts | pybliotecario --stdin
+    $ find . -name "*.png" -printf "image:%p\\0" | pybliotecario --stdin --null
+"""
+
+import codecs
+from concurrent.futures import Future
+import logging
+
+logger = logging.getLogger(__name__)
+
+DIRECTIVES = ("file", "image", "text")
+_CHUNK_SIZE = 64 * 1024
+
+
+def read_records(stream, delimiter="\n", chunk_size=_CHUNK_SIZE):
+    """Yield the records of the binary ``stream`` separated by ``delimiter`` as they are read
+    Empty records are skipped"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    remainder = ""
+    while True:
+        # For newlines read line by line, so that each record is sent as soon as it arrives
+        # otherwise take whatever is available without waiting for the whole chunk
+        chunk = stream.readline() if delimiter == "\n" else stream.read1(chunk_size)
+        *records, remainder = (remainder + decoder.decode(chunk, final=not chunk)).split(delimiter)
+        for record in records:
+            if delimiter == "\n":
+                record = record.rstrip("\r")
+            if record:
+                yield record
+        if not chunk:
+            break
+    if delimiter == "\n":
+        remainder = remainder.rstrip("\r")
+    if remainder:
+        yield remainder
+
+
+def parse_record(record):
+    """Return the kind of record (file, image or text) and its content"""
+    directive, sep, content = record.partition(":")
+    if sep and directive in DIRECTIVES:
+        return directive, content
+    return "text", record
+
+
+def send_stream(stream, tele_api, chat_id, null=False):
+    """Send every record of ``stream`` through ``tele_api``
+    A record that can't be sent is logged and skipped
+    Returns the number of records sent and the number of records that failed"""
+    sent = failed = 0
+    # Sends queued by the backend, checked as they finish
+    queued = []
+
+    def count_queued(wait=False):
+        nonlocal sent, failed
+        still_queued = []
+        for future in queued:
+            if not (wait or future.done()):
+                still_queued.append(future)
+            elif future.exception() is None:
+                sent += 1
+            else:
+                failed += 1
+        queued[:] = still_queued
+
+    for record in read_records(stream, delimiter="\0" if null else "\n"):
+        kind, content = parse_record(record)
+        try:
+            if kind == "file":
+                result = tele_api.send_file(content, chat_id)
+            elif kind == "image":
+                result = tele_api.send_image(content, chat_id)
+            else:
+                if not null:
+                    # Unescape newlines, as for messages given as arguments
+                    content = content.replace("\\n", "\n")
+                result = tele_api.send_message(content, chat_id)
+        except Exception as e:
+            logger.error("Could not send %s '%s': %s", kind, content[:50], e)
+            failed += 1
+            continue
+        if isinstance(result, Future):
+            queued.append(result)
+            count_queued()
+        else:
+            sent += 1
+    count_queued(wait=True)
+    logger.info("Sent %d records from stdin (%d failed)", sent, failed)
+    return sent, failed
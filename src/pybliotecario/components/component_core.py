@@ -12,13 +12,25 @@ the class Component will just pass the text of the msg (or the command)
 to the `act_on_command` or `act_on_message` methods.
 """
 
+from concurrent.futures import Future
 import logging
 import os
 import sys
 
+from pybliotecario.backend.downloads import as_future
+
 log = logging.getLogger(__name__)
 
 
+def _remove_when_sent(sent, filepath):
+    """Remove the file once it has been sent, if the send has been queued
+    (the backend returned a Future) wait for it to finish"""
+    if isinstance(sent, Future):
+        sent.add_done_callback(lambda _: os.remove(filepath))
+    else:
+        os.remove(filepath)
+
+
 class Component:
     """
     This is the base class from which all components should inherit
@@ -161,9 +173,9 @@ class Component:
             chat_id = self.interaction_chat
         if not os.path.isfile(imgpath):
             self.send_msg(f"ERROR: failed to send {imgpath}", chat_id)
-        self.telegram.send_image(imgpath, chat_id)
+        sent = self.telegram.send_image(imgpath, chat_id)
         if delete:
-            os.remove(imgpath)
+            _remove_when_sent(sent, imgpath)
 
     def send_file(self, filepath, chat_id=None, delete=False):
         """Wrapper around API send_file, if chat_id is not defined
@@ -174,9 +186,14 @@ class Component:
             chat_id = self.interaction_chat
         if not os.path.isfile(filepath):
             self.send_msg(f"ERROR: failed to send {filepath}", chat_id)
-        self.telegram.send_file(filepath, chat_id)
+        sent = self.telegram.send_file(filepath, chat_id)
         if delete:
-            os.remove(filepath)
+            _remove_when_sent(sent, filepath)
+
+    def download_file(self, file_id, file_path):
+        """Wrapper around API download_file which waits for the download to finish
+        Returns the path of the downloaded file or None if it failed"""
+        return as_future(self.telegram.download_file(file_id, file_path)).result()
 
     def _not_allowed_msg(self, chat_id=None):
         """Tell the calling ID they are not allowed to use this component"""
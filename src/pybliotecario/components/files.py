@@ -0,0 +1,58 @@
+"""
+Look for the files received by the pybliotecario in the catalog of the file store
+(see ``pybliotecario.file_store``)
+"""
+
+from datetime import datetime
+import logging
+
+from pybliotecario.components.component_core import Component
+from pybliotecario.file_store import FileStore
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 10
+
+
+def _human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def format_file(entry):
+    """Format an entry of the catalog as a line of text"""
+    timestamp, name, size, path, _ = entry
+    date = datetime.fromtimestamp(timestamp).strftime("%d/%m/%y %H:%M")
+    return f"[{date}] {name} ({_human_size(size)}): {path}"
+
+
+class Files(Component):
+    """Search the received files"""
+
+    help_text = """ > Files module
+    /files terms: list the received files whose name or caption contain the terms
+    (the last received files if no terms are given) """
+
+    def __init__(self, telegram_object, **kwargs):
+        super().__init__(telegram_object, **kwargs)
+        self.store = FileStore(self.main_folder)
+
+    def search(self, query):
+        """Return the files matching the query as text"""
+        entries = self.store.search(query, limit=MAX_RESULTS)
+        self.store.close()
+        if not entries:
+            return f"No files found for '{query}'" if query else "No files received yet"
+        return "\n".join(format_file(entry) for entry in entries)
+
+    def telegram_message(self, msg):
+        if not self.check_identity(msg):
+            return self._not_allowed_msg()
+        self.send_msg(self.search(msg.text.strip()))
+
+    def cmdline_command(self, args):
+        """Print the files matching the terms of ``--files``"""
+        print(self.search(" ".join(args.files)))
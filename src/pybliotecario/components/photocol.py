@@ -41,7 +41,9 @@ class PhotoCol(Component):
         """Save the picture to the target folder and creates a thumbnail"""
         unique_name = str(uuid.uuid4())
         file_path = (self._photofol / unique_name).with_suffix(".jpg")
-        self.telegram.download_file(file_id, file_path)
+        file_path = self.download_file(file_id, file_path)
+        if file_path is None:
+            return None
 
         # Create also a thumbnail
         try:
@@ -0,0 +1,49 @@
+"""
+Profile the pybliotecario from Telegram
+
+/profile N wraps the next N messages in cProfile and writes the results to
+main_folder/profiles, /memsnap compares tracemalloc snapshots
+"""
+
+import logging
+from pathlib import Path
+
+from pybliotecario.components.component_core import Component
+from pybliotecario.profiling import MEMORY, PROFILER, PROFILES_FOLDER
+
+logger = logging.getLogger(__name__)
+
+
+class Profiling(Component):
+    """Profiling hooks, only for the accepted chat ids"""
+
+    help_text = """ > Profiling module
+    /profile N: profile the next N messages with cProfile (saved in main_folder/profiles)
+    /memsnap: take a tracemalloc snapshot and compare it with the previous one
+    /memsnap stop: stop tracemalloc """
+
+    def profile(self, text):
+        """Arm the profiler for the given number of messages"""
+        ncalls = text.strip() or "1"
+        if not ncalls.isdigit():
+            self.send_msg(f"{ncalls} is not a number of messages")
+            return
+        folder = Path(self.main_folder) / PROFILES_FOLDER
+        PROFILER.arm(int(ncalls), folder)
+        self.send_msg(f"Profiling the next {ncalls} messages, results in {folder}")
+
+    def memsnap(self, text):
+        """Take a tracemalloc snapshot, or stop tracemalloc"""
+        if text.strip() == "stop":
+            MEMORY.stop()
+            self.send_msg("tracemalloc stopped")
+        else:
+            self.send_msg(MEMORY.snapshot())
+
+    def telegram_message(self, msg):
+        if not self.check_identity(msg):
+            return self._not_allowed_msg()
+        if msg.command == "profile":
+            self.profile(msg.text)
+        elif msg.command == "memsnap":
+            self.memsnap(msg.text)
@@ -64,7 +64,9 @@ class Reactions(Component):
         file_name = msg.text.replace(" ", "")
         file_path = "{0}/{1}".format(self.reaction_folder, file_name)
         file_id = msg.file_id
-        self.telegram.download_file(file_id, file_path)
+        if self.download_file(file_id, file_path) is None:
+            self.send_msg("Error: reaction image {0} could not be saved".format(file_name))
+            return
         self.send_msg("Reaction image {0} correctly saved".format(file_name))
 
     def send_reaction(self, name):
@@ -0,0 +1,69 @@
+"""
+Search the messages saved in the daily logs
+
+The messages are indexed (see ``pybliotecario.log_index``) as they are written to the logs,
+older logs can be added to the index with ``--search_backfill``
+"""
+
+from datetime import datetime
+import logging
+from pathlib import Path
+
+from pybliotecario.components.component_core import Component
+from pybliotecario.log_index import INDEX_NAME, LogIndex
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 10
+
+
+def format_hit(hit):
+    """Format a search result as a line of text"""
+    timestamp, _, username, text = hit
+    date = "unknown date"
+    if timestamp is not None:
+        date = datetime.fromtimestamp(timestamp).strftime("%d/%m/%y %H:%M")
+    if username is None:
+        return f"[{date}] {text}"
+    return f"[{date}] @{username}: {text}"
+
+
+class Search(Component):
+    """Search the daily logs"""
+
+    help_text = """ > Search module
+    /search terms: search the saved messages containing all the given terms """
+
+    def __init__(self, telegram_object, **kwargs):
+        super().__init__(telegram_object, **kwargs)
+        self.index = LogIndex(Path(self.main_folder) / INDEX_NAME)
+
+    def search(self, terms):
+        """Return the best matches for the given terms as text"""
+        hits = self.index.search(terms, limit=MAX_RESULTS)
+        self.index.close()
+        if not hits:
+            return f"Nothing found for '{terms}'"
+        return "\n".join(format_hit(hit) for hit in hits)
+
+    def telegram_message(self, msg):
+        if not self.check_identity(msg):
+            return self._not_allowed_msg()
+        terms = msg.text.strip()
+        if not terms:
+            self.send_msg("Usage: /search terms")
+            return
+        self.send_msg(self.search(terms))
+
+    def cmdline_command(self, args):
+        """Print the best matches for the terms of ``--search``"""
+        print(self.search(" ".join(args.search)))
+
+
+class SearchBackfill(Search):
+    """Add to the search index the messages of all existing daily logs"""
+
+    def cmdline_command(self, args):
+        total = self.index.backfill(self.main_folder)
+        self.index.close()
+        print(f"{total} new messages added to the search index")
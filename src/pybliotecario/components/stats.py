@@ -0,0 +1,26 @@
+"""
+Report the metrics collected by the pybliotecario while running
+(see ``pybliotecario.metrics``)
+"""
+
+import logging
+
+from pybliotecario.components.component_core import Component
+from pybliotecario.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class Stats(Component):
+    """Send a summary of the metrics of the bot"""
+
+    help_text = """ > Stats module
+    /stats: counters and latencies of the messages, commands and backend requests """
+
+    def telegram_message(self, msg):
+        if not self.check_identity(msg):
+            return self._not_allowed_msg()
+        summary = REGISTRY.summary()
+        if not summary:
+            summary = "No metrics have been collected yet"
+        self.send_msg(summary)
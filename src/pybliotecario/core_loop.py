@@ -3,38 +3,70 @@ This module manages the core loop of the pybliotecario
 when it is called with daemon mode -d
 """
 
-from datetime import datetime
+from concurrent.futures import wait
 import logging
 from pathlib import Path
+import threading
+from time import perf_counter
 
+from pybliotecario.backend.downloads import as_future
+from pybliotecario.backend.scheduler import INTERACTIVE, send_priority
+from pybliotecario.daily_log import DailyLogWriter
+from pybliotecario.dispatcher import DEFAULT_WORKERS, ChatDispatcher
+from pybliotecario.file_store import FileStore
+from pybliotecario.log_index import INDEX_NAME, LogIndex, has_fts5
+from pybliotecario.metrics import REGISTRY
 import pybliotecario.on_cmd_message as on_cmd_message
+from pybliotecario.profiling import PROFILER
 
 logger = logging.getLogger(__name__)
 
 # After which number of continuous exceptions do we actually fail
 _FAILTHRESHOLD = 20
+# The exception counter is shared by all workers of the dispatcher
+_except_lock = threading.Lock()
 
+MESSAGE_SECONDS = REGISTRY.histogram(
+    "pybliotecario_message_seconds", "Time spent acting on a message", ("kind",)
+)
+MESSAGE_EXCEPTIONS = REGISTRY.counter(
+    "pybliotecario_message_exceptions_total",
+    "Messages that raised an exception, ignored or raised once the threshold is hit",
+    ("outcome",),
+)
 
-def _monthly_folder(base_main_folder):
-    """Receives a path object with the base main folder
-    and returns the monthly folder (also a Path object)"""
-    main_folder = base_main_folder / "data"
-    ahora = datetime.now()
-    y = str(ahora.year)
-    m = ahora.strftime("%B")
-    folder_name = main_folder / y / m
-    folder_name.mkdir(exist_ok=True, parents=True)
-    return folder_name
 
+def _message_kind(message):
+    """Classify the message for the metrics"""
+    if message.ignore:
+        return "ignored"
+    if message.is_command:
+        return "command"
+    if message.is_file:
+        return "file"
+    return "text"
 
-def _write_to_daily_log(main_folder, msg):
-    """Write the msg to the daily log"""
-    folder = _monthly_folder(main_folder)
-    day = datetime.now().day
-    file_name = folder / f"{day}.log"
-    with file_name.open("a+", encoding="utf-8") as f:
-        f.write(msg)
-        f.write("\n")
+
+def _reset_except_counter():
+    """Reset the number of continuous exceptions"""
+    global except_counter
+    with _except_lock:
+        except_counter = 0
+
+
+def _acknowledge_file(tele_api, message, download):
+    """Tell the user whether the file sent in the message has been saved
+    Called when the download finishes, possibly in a different thread"""
+    chat_id = message.chat_id
+    error = download.exception()
+    with send_priority(INTERACTIVE):
+        if error is None and download.result():
+            tele_api.send_quiet_message("¡Archivo recibido y guardado!", chat_id)
+            logger.info("File saved to %s", download.result())
+        else:
+            tele_api.send_message("There was some problem with this, sorry", chat_id)
+            logger.info(message)
+            logger.warning("There was a problem with this update: %s", error)
 
 
 def still_alive():
@@ -66,7 +98,49 @@ def still_alive():
     return sentences[r]
 
 
-def main_loop(tele_api, config=None, clear=False):
+def create_dispatcher(config, workers=None):
+    """Create the dispatcher that will act on the messages
+    The number of workers is read from the ``workers`` option of the
+    DEFAULT section of the configuration unless explicitly given.
+    At most ``update_queue_size`` messages (but no less than the number of workers)
+    can be waiting in the dispatcher, so that a burst of updates stays in the update queue
+    (where the ``update_queue_policy`` applies)"""
+    if workers is None:
+        workers = config.getint("DEFAULT", "workers", fallback=DEFAULT_WORKERS)
+    queue_size = config.getint("DEFAULT", "update_queue_size", fallback=100)
+    return ChatDispatcher(workers=workers, max_pending=max(queue_size, workers))
+
+
+def create_log_writer(config):
+    """Create the writer for the daily logs using the options of the DEFAULT section:
+    ``daily_log_flush`` (seconds between writes to disk) and ``daily_log_fsync``
+    If ``search_index`` is true (default) the messages are also added to the search index"""
+    main_folder = Path(config["DEFAULT"]["main_folder"])
+    index = None
+    if config.getboolean("DEFAULT", "search_index", fallback=True):
+        if has_fts5():
+            index = LogIndex(main_folder / INDEX_NAME)
+        else:
+            logger.warning("The sqlite3 module does not support FTS5, /search is not available")
+    return DailyLogWriter(
+        main_folder,
+        flush_interval=config.getfloat("DEFAULT", "daily_log_flush", fallback=1.0),
+        fsync=config.getboolean("DEFAULT", "daily_log_fsync", fallback=False),
+        index=index,
+    )
+
+
+def create_file_store(config):
+    """Create the store for the received files, None if ``file_store`` is false
+    in which case the files are saved as they are in the monthly folder"""
+    if not config.getboolean("DEFAULT", "file_store", fallback=True):
+        return None
+    return FileStore(config["DEFAULT"]["main_folder"])
+
+
+def main_loop(
+    tele_api, config=None, clear=False, dispatcher=None, log_writer=None, file_store=None
+):
     """
     This function defines a "listener" which will wait for messages
     in the form of pybliotecario.Message objects and will act on them
@@ -74,25 +148,42 @@ def main_loop(tele_api, config=None, clear=False):
     The task of the tele_api is then to call the generated function with an
     instance of the message as the argument.
     This allows the tele_api to do things asynchronously if needed be
+
+    The messages are acted upon by the ``dispatcher`` so that different chats
+    are served in parallel. If no dispatcher is given, one is created and
+    all messages are guaranteed to have been processed when this function returns.
+    Likewise, if no ``log_writer`` is given, the daily log is closed at the end
+    and if no ``file_store`` is given, the store is closed once the downloads are done.
     """
-    main_folder = Path(config["DEFAULT"]["main_folder"])
     accepted_ids = config.getidlist("DEFAULT", "chat_id")
     main_id = config.getmainid("DEFAULT", "chat_id")
     chivato = config.getboolean("DEFAULT", "chivato", fallback=False)
     ignore_unknown = config.getboolean("DEFAULT", "ignore_unknown", fallback=False)
 
-    global except_counter
-    except_counter = 0
+    _reset_except_counter()
+
+    own_dispatcher = dispatcher is None
+    if own_dispatcher:
+        dispatcher = create_dispatcher(config)
+    own_writer = log_writer is None
+    if own_writer:
+        log_writer = create_log_writer(config)
+    own_store = file_store is None
+    if own_store:
+        file_store = create_file_store(config)
+    # Downloads which store the file when they finish, only tracked if the store is closed here
+    pending_downloads = []
 
     # Generate the function to act on Messages
     def act_on_message(message):
         """This function receives a pybliotecario.Message and
         an actor object and calls act_on_telegram_command as required"""
         global except_counter
+        start = perf_counter()
         # Check whether the message should be ignored
         try:  # Wrap everything on a try-except block which will not crash if clear=True
             if message.ignore:
-                except_counter = 0
+                _reset_except_counter()
                 return
             chat_id = message.chat_id
 
@@ -111,30 +202,73 @@ def main_loop(tele_api, config=None, clear=False):
                 on_cmd_message.act_on_telegram_command(tele_api, message, config)
             elif message.is_file:
                 # If the message is a file, save the file and we are done
+                # the download finishes in the background and the reply is sent then
                 file_name = message.text.replace(" ", "")
-                file_path = _monthly_folder(main_folder) / file_name
-                result = tele_api.download_file(message.file_id, file_path)
-                if result:
-                    tele_api.send_quiet_message("¡Archivo recibido y guardado!", chat_id)
-                    logger.info("File saved to %s", file_path)
-                else:
-                    tele_api.send_message("There was some problem with this, sorry", chat_id)
-                    logger.info(message)
-                    logger.warning("There was a problem with this update")
+                file_path = log_writer.folder / file_name
+                finalize = None
+                if file_store is not None:
+
+                    def finalize(partial, digest, target):
+                        return file_store.store(
+                            partial,
+                            digest,
+                            target,
+                            sender=message.username,
+                            chat_id=chat_id,
+                            caption=message.text,
+                        )
+
+                download = as_future(
+                    tele_api.download_file(message.file_id, file_path, finalize=finalize)
+                )
+                download.add_done_callback(lambda d: _acknowledge_file(tele_api, message, d))
+                if own_store and file_store is not None:
+                    pending_downloads.append(download)
             else:
                 # Otherwise just save the msg to the log and send a funny reply
-                _write_to_daily_log(main_folder, message.text)
+                log_writer.write(message.text, chat_id=chat_id, username=message.username)
                 random_msg = still_alive()
                 tele_api.send_quiet_message(random_msg, chat_id)
-            except_counter = 0
+            _reset_except_counter()
         except Exception as e:
             logger.error(f"This message produced an exception: {e}")
-            if clear and except_counter < _FAILTHRESHOLD:
-                except_counter += 1
-                # Ignore exceptions until we reach the threshold
-                logger.info(message)
-                logger.info("Going for the next message")
-            else:
+            with _except_lock:
+                ignore_exception = clear and except_counter < _FAILTHRESHOLD
+                if ignore_exception:
+                    except_counter += 1
+            if not ignore_exception:
+                MESSAGE_EXCEPTIONS.inc("raised")
                 raise e
+            MESSAGE_EXCEPTIONS.inc("ignored")
+            # Ignore exceptions until we reach the threshold
+            logger.info(message)
+            logger.info("Going for the next message")
+        finally:
+            MESSAGE_SECONDS.observe(perf_counter() - start, _message_kind(message))
+
+    def run_message(message):
+        """Act on the message, unless the profiler is armed
+        wrap returns act_on_message unchanged
+        The replies go ahead of any bulk output waiting in the send queue"""
+        # From now on, the message is not acted upon again if the program stops
+        message.started()
+        with send_priority(INTERACTIVE):
+            return PROFILER.wrap(act_on_message)(message)
+
+    def dispatch_message(message):
+        """Send the message to the dispatcher, messages from the same chat
+        are processed sequentially"""
+        return dispatcher.submit(message.chat_id, run_message, message)
 
-    tele_api.act_on_updates(act_on_message, not_empty=True)
+    try:
+        tele_api.act_on_updates(dispatch_message, not_empty=True)
+        if own_dispatcher:
+            dispatcher.join()
+    finally:
+        if own_dispatcher:
+            dispatcher.shutdown()
+        if own_writer:
+            log_writer.close()
+        if own_store and file_store is not None:
+            wait(pending_downloads)
+            file_store.close()
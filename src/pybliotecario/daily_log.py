@@ -0,0 +1,155 @@
+"""
+Writer for the daily logs of the pybliotecario
+
+Plain text messages received by the bot are saved in
+    main_folder/data/<year>/<Month>/<day>.log
+
+The writer keeps the file of the current day open and buffers the messages,
+writing them to disk every ``flush_interval`` seconds.
+The monthly folder is only resolved (and created) again when the day changes.
+
+If a ``LogIndex`` is given, the messages are also added to the full-text index
+every time they are written to disk.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def monthly_folder(base_main_folder, now=None):
+    """Receives a path object with the base main folder
+    and returns the monthly folder (also a Path object)"""
+    if now is None:
+        now = datetime.now()
+    main_folder = Path(base_main_folder) / "data"
+    y = str(now.year)
+    m = now.strftime("%B")
+    folder_name = main_folder / y / m
+    folder_name.mkdir(exist_ok=True, parents=True)
+    return folder_name
+
+
+class DailyLogWriter:
+    """
+    Buffered writer for the daily logs
+
+    Parameters
+    ----------
+        main_folder: str or Path
+            base folder of the pybliotecario
+        flush_interval: float
+            maximum number of seconds a message stays in memory, if 0 every message
+            is written immediately
+        fsync: bool
+            whether to force the data to disk after every flush
+        index: LogIndex
+            full-text index in which to store the messages
+    """
+
+    def __init__(self, main_folder, flush_interval=1.0, fsync=False, index=None):
+        self.main_folder = Path(main_folder)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.index = index
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._file = None
+        self._folder = None
+        self._next_rollover = 0.0
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="daily-log", daemon=True)
+            self._flusher.start()
+
+    def _rollover(self, now):
+        """Resolve the folder and file for the day of ``now``"""
+        self._folder = monthly_folder(self.main_folder, now)
+        if self._file is not None:
+            self._file.close()
+        file_name = self._folder / f"{now.day}.log"
+        if self.index is not None and file_name.exists():
+            # Make sure the index is up to date before appending to the file
+            self._index_call(self.index.index_file, file_name)
+        self._file = file_name.open("a+", encoding="utf-8")
+        tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        self._next_rollover = tomorrow.timestamp()
+
+    def _check_rollover(self):
+        """Change the current day if needed, must be called with the lock held"""
+        if time.time() >= self._next_rollover:
+            # Messages received during the previous day go to the previous day
+            self._write_buffer()
+            self._rollover(datetime.now())
+
+    @property
+    def folder(self):
+        """Return the monthly folder for the current day"""
+        with self._lock:
+            self._check_rollover()
+            return self._folder
+
+    def write(self, msg, chat_id=None, username=None):
+        """Write the msg to the daily log"""
+        with self._lock:
+            if self._closed.is_set():
+                raise ValueError("Writing to a closed daily log")
+            self._check_rollover()
+            self._buffer.append((msg, chat_id, username, time.time()))
+            if self._flusher is None:
+                self._write_buffer()
+
+    def _index_call(self, function, *args):
+        """Call a method of the index, an index failure should never stop the log"""
+        try:
+            function(*args)
+        except sqlite3.Error as e:
+            logger.error("Could not update the search index: %s", e)
+
+    def _write_buffer(self):
+        """Write down the buffer, must be called with the lock held"""
+        if not self._buffer or self._file is None:
+            return
+        lines = [entry[0] for entry in self._buffer]
+        lines.append("")
+        self._file.write("\n".join(lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if self.index is not None:
+            position = os.fstat(self._file.fileno()).st_size
+            self._index_call(self.index.add, self._buffer, self._file.name, position)
+        self._buffer.clear()
+
+    def flush(self):
+        """Write all buffered messages to the file"""
+        with self._lock:
+            self._write_buffer()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Could not write to the daily log: %s", e)
+
+    def close(self):
+        """Flush all messages and close the file"""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            self._write_buffer()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._next_rollover = 0.0
+            if self.index is not None:
+                self.index.close()
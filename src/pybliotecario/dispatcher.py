@@ -0,0 +1,131 @@
+"""
+Thread pool used by the core loop to act on messages concurrently
+
+Messages are dispatched to a pool of workers keyed by their chat id:
+messages from the same chat are always processed in the order they were received
+while messages coming from different chats can be processed in parallel.
+This way a slow command (downloading a paper, running a script) only blocks
+the chat that requested it.
+"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import threading
+
+from pybliotecario.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+PENDING = REGISTRY.gauge(
+    "pybliotecario_dispatch_pending", "Functions submitted to the dispatcher not yet finished"
+)
+
+
+class ChatDispatcher:
+    """
+    Run functions in a thread pool guaranteeing that all functions
+    submitted with the same key run sequentially and in order.
+
+    Exceptions raised by the functions are set in the Future returned by ``submit``,
+    they are also stored and re-raised in the thread that calls ``join``,
+    so that errors are not silently swallowed by the workers.
+
+    Parameters
+    ----------
+        workers: int
+            maximum number of functions to be run at the same time
+        max_pending: int
+            maximum number of functions submitted and not finished,
+            ``submit`` waits when there are this many (None for no limit)
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=None):
+        if workers < 1:
+            raise ValueError(f"The number of workers must be at least 1, received {workers}")
+        if max_pending is not None and max_pending < 1:
+            raise ValueError(f"max_pending must be at least 1, received {max_pending}")
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatcher")
+        # For each key, the queue of functions waiting to be run
+        # a key is only in the dictionary while there is a worker draining its queue
+        self._queues = {}
+        self._pending = 0
+        self._errors = []
+        self._condition = threading.Condition()
+
+    def submit(self, key, function, *args, **kwargs):
+        """Queue ``function(*args, **kwargs)`` after all previous functions submitted
+        with the same ``key``. Returns a ``concurrent.futures.Future``
+        If there are ``max_pending`` functions not finished yet, wait until one finishes
+        """
+        future = Future()
+        with self._condition:
+            if self.max_pending is not None:
+                self._condition.wait_for(lambda: self._pending < self.max_pending)
+            self._pending += 1
+            PENDING.inc()
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = deque()
+                self._queues[key] = queue
+                queue.append((function, args, kwargs, future))
+                self._executor.submit(self._drain, key)
+            else:
+                queue.append((function, args, kwargs, future))
+        return future
+
+    def _drain(self, key):
+        """Run all functions queued for ``key`` until the queue is empty"""
+        while True:
+            with self._condition:
+                queue = self._queues[key]
+                if not queue:
+                    self._queues.pop(key)
+                    return
+                function, args, kwargs, future = queue.popleft()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = function(*args, **kwargs)
+                except Exception as e:
+                    logger.error("Dispatched function for %s failed: %s", key, e)
+                    future.set_exception(e)
+                    with self._condition:
+                        self._errors.append(e)
+                else:
+                    future.set_result(result)
+
+            PENDING.dec()
+            with self._condition:
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def raise_errors(self):
+        """If any of the dispatched functions failed, raise the first exception"""
+        with self._condition:
+            if not self._errors:
+                return
+            error = self._errors[0]
+            self._errors.clear()
+        raise error
+
+    def join(self):
+        """Wait until all submitted functions have finished
+        and raise any exception they produced"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0)
+        self.raise_errors()
+
+    def shutdown(self):
+        """Wait for all submitted functions and stop the workers
+        Exceptions are logged but not raised"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0)
+            for error in self._errors:
+                logger.error("Unhandled exception in dispatcher: %s", error)
+            self._errors.clear()
+        self._executor.shutdown(wait=True)
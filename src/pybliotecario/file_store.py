@@ -0,0 +1,156 @@
+"""
+Content-addressed store and catalog of the received files
+
+Every file received by the pybliotecario is stored once, named after the sha256 of its content:
+
+    main_folder/files/blobs/<first two characters of the hash>/<hash>
+
+and linked (with a hard link or, if not possible, a symbolic link) into the monthly folder
+under the name it was received with, so that a document sent several times takes the
+disk space of one.
+
+Every reception is recorded in a SQLite catalog (``main_folder/files/catalog.sqlite``)
+with the hash, size, mime type, sender, caption and date of the file,
+which can be searched with ``/files`` or ``--files`` without walking the folders.
+"""
+
+from datetime import datetime
+import logging
+import mimetypes
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+STORE_FOLDER = "files"
+CATALOG_NAME = "catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mime TEXT,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sender TEXT,
+    chat_id INTEGER,
+    caption TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files(hash);
+CREATE INDEX IF NOT EXISTS files_timestamp ON files(timestamp);
+"""
+_SEARCHABLE = ("name", "caption", "sender", "mime")
+
+
+def _link(blob, link_path):
+    """Link ``blob`` at ``link_path``, if the name is taken by a different file
+    a random suffix is added to it. Returns the path of the link"""
+    while True:
+        try:
+            try:
+                os.link(blob, link_path)
+            except FileExistsError:
+                raise
+            except OSError:
+                # Hard links are not supported by the filesystem
+                os.symlink(blob.resolve(), link_path)
+            return link_path
+        except FileExistsError:
+            if os.path.samefile(link_path, blob):
+                return link_path
+            token = uuid.uuid4().hex[:8]
+            link_path = link_path.with_name(f"{link_path.stem}-{token}{link_path.suffix}")
+
+
+class FileStore:
+    """
+    Store of files named by the hash of their content, with a catalog
+
+    The catalog is only opened (and created if needed) the first time it is used.
+
+    Parameters
+    ----------
+        main_folder: str or Path
+            main folder of the pybliotecario, the store lives in ``main_folder/files``
+    """
+
+    def __init__(self, main_folder):
+        self.folder = Path(main_folder) / STORE_FOLDER
+        self.path = self.folder / CATALOG_NAME
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            self.folder.mkdir(exist_ok=True, parents=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+    def blob_path(self, digest):
+        """Path at which the content with the given hash is stored"""
+        return self.folder / "blobs" / digest[:2] / digest
+
+    def store(self, source, digest, link_path, sender=None, chat_id=None, caption=None):
+        """Move ``source`` (whose sha256 is ``digest``) into the store, unless the content
+        is already there, link it at ``link_path`` and add it to the catalog
+        Returns the path of the link"""
+        blob = self.blob_path(digest)
+        blob.parent.mkdir(exist_ok=True, parents=True)
+        if blob.exists():
+            logger.info("%s is already in the store", link_path.name)
+            os.remove(source)
+        else:
+            os.replace(source, blob)
+        link_path = _link(blob, Path(link_path))
+        mime, _ = mimetypes.guess_type(link_path.name)
+        row = (
+            digest,
+            blob.stat().st_size,
+            mime,
+            link_path.name,
+            str(link_path),
+            sender,
+            chat_id,
+            caption,
+            datetime.now().timestamp(),
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO files(hash, size, mime, name, path, sender, chat_id, caption, "
+                "timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+        return link_path
+
+    def search(self, query="", limit=10):
+        """Search the catalog for files whose name, caption, sender or mime type
+        contain all the words of ``query``, newest first. An empty query returns the last files
+        Returns a list of (timestamp, name, size, path, hash)"""
+        sql = "SELECT timestamp, name, size, path, hash FROM files"
+        conditions = []
+        params = []
+        for word in query.split():
+            pattern = "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            fields = " OR ".join(f"{field} LIKE ? ESCAPE '\\'" for field in _SEARCHABLE)
+            conditions.append(f"({fields})")
+            params += [pattern] * len(_SEARCHABLE)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        """Close the connection to the catalog"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
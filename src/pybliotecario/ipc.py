@@ -0,0 +1,247 @@
+"""
+Local socket to hand off command line invocations to a running daemon
+
+While the daemon (``-d``) is running it listens on a Unix domain socket in ``main_folder``
+(one per backend, ``pybliotecario-<backend>.sock``).
+Command line invocations that only send a message, a file or an image
+forward the request through the socket instead of creating their own backend,
+so that the connection of the daemon is reused.
+
+The protocol is one line of JSON per connection::
+
+    {"chat_id": "1234", "file": "/abs/path", "image": null, "message": "Hello"}
+
+The daemon replies ``{"ok": true}`` once everything in the request has been sent
+or ``{"ok": false, "error": "..."}`` if it can't be accepted or the send fails,
+so the files can be removed as soon as the command line invocation returns.
+"""
+
+from concurrent.futures import Future
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import threading
+
+logger = logging.getLogger(__name__)
+
+SOCKET_NAME = "pybliotecario-{backend}.sock"
+# The order in which the different kinds of requests are sent
+SEND_KINDS = ("file", "image", "message")
+_TIMEOUT = 5
+# How often the server checks whether it has been asked to stop
+_POLL_INTERVAL = 0.1
+# Not defined in platforms without Unix sockets, in which the server is never started
+_UnixStreamServer = getattr(socketserver, "UnixStreamServer", socketserver.BaseServer)
+
+
+def socket_path(config, backend):
+    """Return the path of the socket for the given backend
+    or None if it is disabled with ``ipc_socket = false``"""
+    defaults = config.defaults()
+    main_folder = defaults.get("main_folder")
+    if not main_folder or not config.getboolean("DEFAULT", "ipc_socket", fallback=True):
+        return None
+    return Path(main_folder) / SOCKET_NAME.format(backend=backend.lower())
+
+
+def is_supported():
+    """Unix domain sockets are not available in all platforms"""
+    return hasattr(socket, "AF_UNIX")
+
+
+class DaemonError(Exception):
+    """The daemon received the request but could not accept it"""
+
+
+def send_to_daemon(path, request, timeout=_TIMEOUT):
+    """Send the request to the daemon listening at ``path``
+    Returns False if there is no daemon listening, True once the request has been sent
+    ``timeout`` applies to connecting and handing the request, the reply is waited for
+    as long as the sends take"""
+    if path is None or not is_supported():
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(str(path))
+        except OSError:
+            # No socket, or left behind by a daemon which is no longer running
+            return False
+        try:
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            sock.settimeout(None)
+            reply = sock.makefile("rb").readline()
+        except OSError as e:
+            raise DaemonError(f"The request might not have reached the daemon: {e}") from e
+    if not reply:
+        raise DaemonError("The daemon closed the connection without replying")
+    reply = json.loads(reply)
+    if not reply.get("ok"):
+        raise DaemonError(reply.get("error", "unknown error"))
+    return True
+
+
+def _check_request(request):
+    """Raise a ValueError if the request is not valid"""
+    if not isinstance(request, dict) or not request.get("chat_id"):
+        raise ValueError("The request must include a chat_id")
+    for kind in ("file", "image"):
+        filename = request.get(kind)
+        if filename is not None and not Path(filename).is_file():
+            raise ValueError(f"The file '{filename}' can't be found")
+    if not any(request.get(kind) for kind in SEND_KINDS):
+        raise ValueError(f"Nothing to send, include at least one of {SEND_KINDS}")
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Wait for the sends of the request queued by the server and reply"""
+
+    timeout = _TIMEOUT
+
+    def handle(self):
+        error = self.server.pop_queued(self.request).result()
+        reply = {"ok": True} if error is None else {"ok": False, "error": error}
+        self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+class IPCServer(socketserver.ThreadingMixIn, _UnixStreamServer):
+    """
+    Listen on a Unix socket for send requests and run them through the dispatcher of the daemon
+
+    The requests are read and queued in the dispatcher in the order the connections
+    are accepted, so that the sends to a given chat happen in the same order,
+    while the reply, which is only given once the sends are done (or have failed),
+    is waited for in a thread per connection, so that different chats are served in parallel.
+
+    Parameters
+    ----------
+        path: Path
+            path of the socket
+        tele_api: Backend
+            backend used to send the messages
+        dispatcher: ChatDispatcher
+            dispatcher in which the sends are queued, keyed by chat id
+    """
+
+    def __init__(self, path, tele_api, dispatcher):
+        self.path = Path(path)
+        self.tele_api = tele_api
+        self.dispatcher = dispatcher
+        self._thread = None
+        # For each connection, the Future of its request
+        self._queued = {}
+        self._queued_lock = threading.Lock()
+        super().__init__(str(self.path), _RequestHandler, bind_and_activate=False)
+        try:
+            self.server_bind()
+            # Only the user running the daemon can send requests
+            os.chmod(self.path, 0o600)
+            self.server_activate()
+        except OSError:
+            self.server_close()
+            raise
+
+    def process_request(self, request, client_address):
+        """Read and queue the request before accepting the next connection,
+        the reply is then given by a new thread"""
+        queued = self._read_request(request)
+        with self._queued_lock:
+            self._queued[request] = queued
+        super().process_request(request, client_address)
+
+    def pop_queued(self, request):
+        """Return the Future of the request received through the connection"""
+        with self._queued_lock:
+            return self._queued.pop(request)
+
+    def _read_request(self, connection):
+        """Read the request and queue it, returns a Future with the error (if any)"""
+        connection.settimeout(_TIMEOUT)
+        try:
+            with connection.makefile("rb") as rfile:
+                request = json.loads(rfile.readline())
+            _check_request(request)
+        except Exception as e:
+            logger.error("Bad request through the socket: %s", e)
+            refused = Future()
+            refused.set_result(str(e))
+            return refused
+        return self.queue(request)
+
+    def queue(self, request):
+        """Queue the sends of the request in the dispatcher
+        Returns a Future with the error (as a string) if the sends failed, None otherwise"""
+        chat_id = request["chat_id"]
+        key = int(chat_id) if str(chat_id).lstrip("-").isdigit() else chat_id
+        return self.dispatcher.submit(key, self._send, request)
+
+    def _send(self, request):
+        """Send the request and wait until the sends are done"""
+        chat_id = request["chat_id"]
+        try:
+            sends = []
+            if request.get("file"):
+                kwargs = {"split": True} if request.get("split") else {}
+                sends.append(self.tele_api.send_file(request["file"], chat_id, **kwargs))
+            if request.get("image"):
+                sends.append(self.tele_api.send_image(request["image"], chat_id))
+            if request.get("message"):
+                sends.append(self.tele_api.send_message(request["message"], chat_id))
+            for sent in sends:
+                if isinstance(sent, Future):
+                    sent.result()
+        except Exception as e:
+            # The error goes to the client, don't bring down the daemon
+            logger.error("Failed to send a request received through the socket: %s", e)
+            return str(e)
+        return None
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(
+            target=self.serve_forever, args=(_POLL_INTERVAL,), name="ipc", daemon=True
+        )
+        self._thread.start()
+        logger.info("Listening for command line requests at %s", self.path)
+
+    def close(self):
+        """Stop serving, wait for the replies still pending and remove the socket"""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def start_ipc_server(config, backend, tele_api, dispatcher):
+    """Start the IPC server for the daemon, returns None if the socket
+    is disabled or can't be created (e.g., another daemon is already listening)"""
+    path = socket_path(config, backend)
+    if path is None or not is_supported():
+        return None
+    if path.exists():
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(str(path))
+            logger.warning("Another daemon is listening at %s, not creating the socket", path)
+            return None
+        except ConnectionRefusedError:
+            # Left behind by a daemon that did not exit cleanly
+            path.unlink()
+        except OSError as e:
+            logger.warning("Could not check the socket at %s: %s", path, e)
+            return None
+    try:
+        server = IPCServer(path, tele_api, dispatcher)
+    except OSError as e:
+        logger.warning("Could not create the socket at %s: %s", path, e)
+        return None
+    server.start()
+    return server
@@ -0,0 +1,176 @@
+"""
+Full-text index of the daily logs
+
+The messages written to the daily logs (see ``daily_log``) are also stored
+in a SQLite FTS5 table together with the chat id, username and time of the message
+so that they can be searched without reading all log files.
+
+The index remembers up to which byte each log file has been indexed, so that
+log files can be indexed (or re-indexed) incrementally with ``backfill``.
+"""
+
+from datetime import datetime
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "search_index.sqlite"
+_BATCH_SIZE = 500
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    text, username, chat_id UNINDEXED, timestamp UNINDEXED, tokenize="unicode61"
+);
+CREATE TABLE IF NOT EXISTS indexed_files (path TEXT PRIMARY KEY, position INTEGER NOT NULL);
+"""
+
+
+def has_fts5():
+    """Check whether the SQLite library can create FTS5 tables"""
+    try:
+        with sqlite3.connect(":memory:") as conn:
+            conn.execute("CREATE VIRTUAL TABLE t USING fts5(a)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _quote_terms(terms):
+    """Turn free text into a FTS5 query in which all terms must appear"""
+    words = terms.split()
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def _date_from_path(log_path):
+    """Read the date of a log file from its path: data/<year>/<Month>/<day>.log"""
+    log_path = Path(log_path)
+    try:
+        day = int(log_path.stem)
+        month = log_path.parent.name
+        year = log_path.parent.parent.name
+        return datetime.strptime(f"{year} {month} {day}", "%Y %B %d")
+    except ValueError:
+        return None
+
+
+def _key(log_path):
+    """Key used to identify a log file in the index"""
+    return str(Path(log_path).resolve())
+
+
+class LogIndex:
+    """
+    Full-text index of the messages of the daily logs
+
+    The database is only opened (and created if needed) the first time it is used.
+
+    Parameters
+    ----------
+        path: str or Path
+            SQLite database in which the index is stored
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+    def add(self, entries, log_path=None, position=None):
+        """Add entries (text, chat_id, username, timestamp) to the index.
+        If ``log_path`` is given, register that the file has been indexed up to ``position``"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO messages(text, chat_id, username, timestamp) VALUES (?, ?, ?, ?)",
+                entries,
+            )
+            if log_path is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO indexed_files(path, position) VALUES (?, ?)",
+                    (_key(log_path), position),
+                )
+
+    def indexed_position(self, log_path):
+        """Return up to which byte the log file has been indexed"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT position FROM indexed_files WHERE path = ?", (_key(log_path),)
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def index_file(self, log_path):
+        """Index the part of the log file which has not been indexed yet
+        The file is read line by line and added to the index in batches
+        Returns the number of new entries"""
+        log_path = Path(log_path)
+        date = _date_from_path(log_path)
+        timestamp = None if date is None else date.timestamp()
+        position = self.indexed_position(log_path)
+        if log_path.stat().st_size <= position:
+            return 0
+
+        total = 0
+        batch = []
+        with log_path.open("rb") as f:
+            f.seek(position)
+            for raw_line in f:
+                if not raw_line.endswith(b"\n"):
+                    # The last line is still being written
+                    break
+                position += len(raw_line)
+                line = raw_line.decode("utf-8", errors="replace").rstrip("\n")
+                if line:
+                    batch.append((line, None, None, timestamp))
+                if len(batch) >= _BATCH_SIZE:
+                    self.add(batch, log_path, position)
+                    total += len(batch)
+                    batch = []
+        self.add(batch, log_path, position)
+        return total + len(batch)
+
+    def backfill(self, main_folder):
+        """Index all daily logs found in ``main_folder/data``
+        Returns the number of new entries"""
+        data_folder = Path(main_folder) / "data"
+        total = 0
+        for log_path in sorted(data_folder.glob("*/*/*.log")):
+            new_entries = self.index_file(log_path)
+            if new_entries:
+                logger.info("Indexed %d entries from %s", new_entries, log_path)
+            total += new_entries
+        return total
+
+    def search(self, terms, limit=10, chat_id=None):
+        """Search the index for messages containing all ``terms``, best matches first
+        Returns a list of (timestamp, chat_id, username, text)
+        """
+        query = _quote_terms(terms)
+        if not query:
+            return []
+        sql = "SELECT timestamp, chat_id, username, text FROM messages WHERE messages MATCH ?"
+        params = [query]
+        if chat_id is not None:
+            sql += " AND chat_id = ?"
+            params.append(chat_id)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        """Close the connection to the database"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,282 @@
+"""
+Lightweight in-process metrics
+
+Three kinds of metrics are available, all of them can have labels:
+    - Counter: a value that only goes up (number of messages received)
+    - Gauge: a value that can go up and down (number of messages waiting)
+    - Histogram: distribution of values in fixed buckets (latency of a request)
+
+All metrics are registered in a ``Registry`` (by default ``REGISTRY``) which can render
+them in the Prometheus text format or as a short human-readable summary.
+
+    >>> from pybliotecario.metrics import REGISTRY
+    >>> requests = REGISTRY.counter("requests_total", "Requests done", ("method",))
+    >>> requests.inc("sendMessage")
+    >>> with REGISTRY.histogram("request_seconds", "Latency of the requests").time():
+    ...     pass
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Buckets (in seconds) adapted to network requests and commands
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    inside = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + inside + "}"
+
+
+class _Metric:
+    """Base class for all metrics, stores one value per combination of labels"""
+
+    _type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+        return tuple(str(i) for i in labelvalues)
+
+    def value(self, *labelvalues):
+        """Return the current value for the given labels"""
+        with self._lock:
+            return self._values.get(self._key(labelvalues), 0)
+
+    def _samples(self):
+        """Return a list of (suffix, labels, value) for the Prometheus format"""
+        with self._lock:
+            return [("", key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        """Render the metric in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self._type}"]
+        for suffix, labelvalues, value, *extra in self._samples():
+            labels = _format_labels(self.labelnames, labelvalues, *extra)
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+        return "\n".join(lines)
+
+    def summary(self):
+        """Return a list of human-readable lines"""
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)}: {value:g}" for key, value in items
+        ]
+
+
+class Counter(_Metric):
+    """A value that can only increase"""
+
+    _type = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        """Increase the counter for the given labels"""
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can increase and decrease"""
+
+    _type = "gauge"
+
+    def set(self, value, *labelvalues):
+        """Set the gauge for the given labels to ``value``"""
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labelvalues, amount=1):
+        """Increase the gauge"""
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        """Decrease the gauge"""
+        self.inc(*labelvalues, amount=-amount)
+
+
+class _HistogramValue:
+    """Observations of a histogram for one combination of labels"""
+
+    def __init__(self, nbuckets):
+        self.buckets = [0] * nbuckets
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    """Count observations in fixed buckets"""
+
+    _type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        """Add an observation"""
+        key = self._key(labelvalues)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = _HistogramValue(len(self.buckets))
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    data.buckets[i] += 1
+                    break
+            data.count += 1
+            data.sum += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Context manager that observes the time spent inside"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def value(self, *labelvalues):
+        """Return the number of observations for the given labels"""
+        with self._lock:
+            data = self._values.get(self._key(labelvalues))
+            return 0 if data is None else data.count
+
+    def quantile(self, q, *labelvalues):
+        """Estimate the quantile ``q`` as the upper limit of the bucket where it falls"""
+        with self._lock:
+            data = self._values.get(self._key(labelvalues))
+            if data is None or data.count == 0:
+                return None
+            target = q * data.count
+            accumulated = 0
+            for upper, count in zip(self.buckets, data.buckets):
+                accumulated += count
+                if accumulated >= target:
+                    return upper
+            return float("inf")
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                accumulated = 0
+                for upper, count in zip(self.buckets, data.buckets):
+                    accumulated += count
+                    samples.append(("_bucket", key, accumulated, ("le", f"{upper:g}")))
+                samples.append(("_bucket", key, data.count, ("le", "+Inf")))
+                samples.append(("_sum", key, data.sum))
+                samples.append(("_count", key, data.count))
+        return samples
+
+    def summary(self):
+        with self._lock:
+            keys = sorted(self._values)
+        lines = []
+        for key in keys:
+            with self._lock:
+                data = self._values[key]
+                count, mean = data.count, data.sum / data.count
+            p50 = self.quantile(0.5, *key)
+            p95 = self.quantile(0.95, *key)
+            labels = _format_labels(self.labelnames, key)
+            lines.append(
+                f"{self.name}{labels}: n={count} mean={mean:.3f}s p50<={p50:g}s p95<={p95:g}s"
+            )
+        return lines
+
+
+class Registry:
+    """Collection of metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as {metric._type}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Get (or create) a counter"""
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Get (or create) a gauge"""
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Get (or create) a histogram"""
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def _all(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text format"""
+        return "\n".join(metric.render() for metric in self._all()) + "\n"
+
+    def summary(self):
+        """Human-readable summary of all metrics"""
+        lines = []
+        for metric in self._all():
+            lines += metric.summary()
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve the metrics in the Prometheus text format at http://host:port/metrics
+    The server runs in a daemon thread, returns the server object"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Serving metrics at http://%s:%d/metrics", host, server.server_port)
+    return server
@@ -9,10 +9,15 @@ if you want to run only some submodules of the pybliotecario.
 
 import logging
 
+from .metrics import REGISTRY
 from .utils import import_component
 
 log = logging.getLogger(__name__)
 
+COMMAND_SECONDS = REGISTRY.histogram(
+    "pybliotecario_command_seconds", "Time spent by the components on a command", ("component",)
+)
+
 EXACT_COMMAND_MAPPING = {
     "ip": ("ip_lookup", "IpLookup"),
     # PID
@@ -36,6 +41,15 @@ EXACT_COMMAND_MAPPING = {
     "system": ("system", "System"),
     # stocks
     "stock_value": ("stocks", "Stocks"),
+    # search
+    "search": ("search", "Search"),
+    # received files
+    "files": ("files", "Files"),
+    # metrics
+    "stats": ("stats", "Stats"),
+    # profiling
+    "profile": ("profiling", "Profiling"),
+    "memsnap": ("profiling", "Profiling"),
 }
 
 PREFIX_COMMAND_MAPPING = {
@@ -88,11 +102,12 @@ def act_on_telegram_command(tele_api, message_obj, config):
         log.error(f"The component {tg_command} raised the following error: {e}")
         return tele_api.send_message(f"Dependencies for {tg_command} are missing", chat_id)
 
-    actor_instance = Actor(
-        tele_api,
-        chat_id=chat_id,
-        configuration=config,
-        interaction_chat=message_obj.chat_id,
-        running_in_loop=True,
-    )
-    return actor_instance.telegram_message(message_obj)
+    with COMMAND_SECONDS.time(class_name):
+        actor_instance = Actor(
+            tele_api,
+            chat_id=chat_id,
+            configuration=config,
+            interaction_chat=message_obj.chat_id,
+            running_in_loop=True,
+        )
+        return actor_instance.telegram_message(message_obj)
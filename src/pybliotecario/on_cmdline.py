@@ -9,7 +9,10 @@ if you want to run only some submodules of the pybliotecario.
 The most obvious example is running the program just to send msgs and files to Telegram
 """
 
+from concurrent.futures import Future
 import logging
+from pathlib import Path
+import sys
 
 from .utils import import_component
 
@@ -25,13 +28,14 @@ CMDLINE_MAPPING = {
     "check_github_issues": ("github_component", "Github"),
     "arxiv_new": ("arxiv_mod", "Arxiv"),
     "stock_watcher": ("stocks", "Stocks"),
+    "search_backfill": ("search", "SearchBackfill"),
+    "search": ("search", "Search"),
+    "files": ("files", "Files"),
 }
 
 
-def run_command(args, tele_api, config):
-    """
-    Receives the whole batch of arguments and acts accordingly
-    """
+def resolve_chat_id(args, config):
+    """Return the chat id given by --chat_id (or its alias) or the default one"""
     chat_id = args.chat_id
     if not chat_id.isnumeric():
         # If the id is not numeric maybe is an alias that we have
@@ -42,6 +46,49 @@ def run_command(args, tele_api, config):
     # If after everything, chat_id is still empty:
     if not chat_id:
         chat_id = config["DEFAULT"]["chat_id"]
+    return chat_id
+
+
+def _message_text(args):
+    message_text = " ".join(args.message)
+    # Unescape certain characters that we know to be fine
+    return message_text.replace("\\n", "\n")
+
+
+def _wait(sent):
+    """Wait until a send queued by the backend is done, raising its exception if it failed"""
+    if isinstance(sent, Future):
+        return sent.result()
+    return sent
+
+
+def hand_off(args, config):
+    """If only a message, file or image are to be sent and there is a daemon running,
+    send them through the daemon. Returns whether the daemon took care of them"""
+    if args.stdin or args.join or any(getattr(args, name, None) for name in CMDLINE_MAPPING):
+        return False
+    if not (args.file or args.image or args.message):
+        return False
+    from .ipc import send_to_daemon, socket_path
+
+    request = {
+        "chat_id": resolve_chat_id(args, config),
+        "file": str(Path(args.file).resolve()) if args.file else None,
+        "split": args.split,
+        "image": str(Path(args.image).resolve()) if args.image else None,
+        "message": _message_text(args) if args.message else None,
+    }
+    if send_to_daemon(socket_path(config, args.backend), request):
+        log.info("Request sent by the daemon")
+        return True
+    return False
+
+
+def run_command(args, tele_api, config):
+    """
+    Receives the whole batch of arguments and acts accordingly
+    """
+    chat_id = resolve_chat_id(args, config)
 
     # Loop over the possible command line arguments
     actors = []
@@ -57,17 +104,28 @@ def run_command(args, tele_api, config):
 
     # These three are the basic commands:
     # send file, send image, send text
+    if args.join:
+        from .backend.splitting import join_parts
+
+        output, digest = join_parts(args.join)
+        print(f"{digest}  {output}")
+
     if args.file:
-        tele_api.send_file(args.file, chat_id)
+        # Only ask for a split when explicitly requested, so that the option of the configuration
+        # is used otherwise (and so that backends which don't split files work)
+        kwargs = {"split": True} if args.split else {}
+        _wait(tele_api.send_file(args.file, chat_id, **kwargs))
         log.info("File sent")
 
     if args.image:
-        tele_api.send_image(args.image, chat_id)
+        _wait(tele_api.send_image(args.image, chat_id))
         log.info("Image sent")
 
     if args.message:
-        message_text = " ".join(args.message)
-        # Unescape certain characters that we know to be fine
-        message_text = message_text.replace("\\n", "\n")
-        tele_api.send_message(message_text, chat_id)
+        _wait(tele_api.send_message(_message_text(args), chat_id))
         log.info("Message sent")
+
+    if args.stdin:
+        from .batch import send_stream
+
+        send_stream(sys.stdin.buffer, tele_api, chat_id, null=args.null)
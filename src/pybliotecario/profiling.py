@@ -0,0 +1,117 @@
+"""
+Profiling hooks for the daemon
+
+- Profiler: wraps the next N messages in cProfile and dumps the stats
+  as ``.prof`` files (to be read with ``pstats`` or ``snakeviz``)
+- MemorySnapshots: takes tracemalloc snapshots and compares them with the previous one
+
+Both are off by default. When the profiler is not armed ``wrap`` returns
+the very same function it receives, so that it has no overhead.
+"""
+
+import cProfile
+from datetime import datetime
+import functools
+import logging
+from pathlib import Path
+import threading
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+PROFILES_FOLDER = "profiles"
+
+
+class Profiler:
+    """Profile a given number of function calls with cProfile"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # cProfile can only profile one thread at a time
+        self._run_lock = threading.Lock()
+        self._remaining = 0
+        self._folder = None
+        self._counter = 0
+
+    @property
+    def active(self):
+        """Whether there are calls left to profile"""
+        return self._remaining > 0
+
+    def arm(self, ncalls, folder):
+        """Profile the next ``ncalls`` calls and dump the results in ``folder``"""
+        folder = Path(folder)
+        folder.mkdir(exist_ok=True, parents=True)
+        with self._lock:
+            self._remaining = ncalls
+            self._folder = folder
+        logger.info("Profiling the next %d messages into %s", ncalls, folder)
+
+    def wrap(self, function):
+        """If the profiler is armed return a profiled version of the function,
+        otherwise return the function itself"""
+        if not self.active:
+            return function
+        with self._lock:
+            if self._remaining <= 0:
+                return function
+            self._remaining -= 1
+            self._counter += 1
+            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            output = self._folder / f"{timestamp}-{self._counter}.prof"
+
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            with self._run_lock:
+                try:
+                    return profile.runcall(function, *args, **kwargs)
+                finally:
+                    profile.dump_stats(output)
+                    logger.info("Profile written to %s", output)
+
+        return profiled
+
+
+class MemorySnapshots:
+    """Compare tracemalloc snapshots to look for memory growth"""
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._previous = None
+
+    @property
+    def tracing(self):
+        """Whether tracemalloc is running"""
+        return tracemalloc.is_tracing()
+
+    def snapshot(self, top=10):
+        """Take a snapshot and return the ``top`` differences with the previous one as text.
+        The first call starts tracemalloc"""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._previous = tracemalloc.take_snapshot()
+                return "tracemalloc started, take another snapshot to see the differences"
+            current = tracemalloc.take_snapshot()
+            previous, self._previous = self._previous, current
+
+        if previous is None:
+            return "Snapshot taken, take another one to see the differences"
+        stats = current.compare_to(previous, "lineno")[:top]
+        size, peak = tracemalloc.get_traced_memory()
+        lines = [f"Traced memory: {size / 1024:.1f} KiB (peak {peak / 1024:.1f} KiB)"]
+        lines += [str(stat) for stat in stats]
+        return "\n".join(lines)
+
+    def stop(self):
+        """Stop tracemalloc and forget the snapshots"""
+        with self._lock:
+            self._previous = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+
+PROFILER = Profiler()
+MEMORY = MemorySnapshots()
@@ -5,12 +5,14 @@ for command line invocation
 """
 import logging
 from pathlib import Path
+import signal
 import sys
+import threading
 
 # Modify argument_parser.py to read new arguments
+# Only what is needed to parse the arguments is imported here, the backends and
+# the daemon machinery are imported when used so that the command line starts fast
 from pybliotecario.argument_parser import parse_args
-from pybliotecario.backend import FacebookUtil, TelegramUtil, TestUtil
-from pybliotecario.core_loop import main_loop
 from pybliotecario.customconf import CustomConfigParser, default_config_path
 import pybliotecario.on_cmdline as on_cmdline
 
@@ -97,9 +99,15 @@ def main(cmdline_arg=None, tele_api=None, config=None):
 
     logger.info("Initializing the pybliotecario")
 
+    # If a daemon is already running and we only need to send something, let it do it
+    if tele_api is None and not args.daemon and on_cmdline.hand_off(args, config):
+        return
+
     # Check the backend the pybliotecario should be using
     if tele_api is None:
         if args.backend.lower() == "telegram":
+            from pybliotecario.backend import TelegramUtil
+
             api_token = config.defaults().get("token")
             if not api_token:
                 logger.error(
@@ -107,27 +115,76 @@ def main(cmdline_arg=None, tele_api=None, config=None):
                 )
                 sys.exit(-1)
 
-            tele_api = TelegramUtil(config=config, debug=args.debug)
+            # Without --webhook, the webhook option of the configuration decides
+            webhook = args.webhook or None
+            tele_api = TelegramUtil(config=config, debug=args.debug, webhook=webhook)
         elif args.backend.lower() == "test":
+            from pybliotecario.backend import TestUtil
+
             tele_api = TestUtil("/tmp/test_file.txt")
         elif args.backend.lower() == "facebook":
+            from pybliotecario.backend import FacebookUtil
+
             tele_api = FacebookUtil(config=config, debug=args.debug)
             # Check whether we have chat id
             chat_id = config["FACEBOOK"].get("chat_id")
             if chat_id is not None:
                 config.set("DEFAULT", "chat_id", chat_id)
 
+    file_store = None
     try:
-        on_cmdline.run_command(args, tele_api, config)
-    except ModuleNotFoundError as e:
-        logger.error("In order to use this option you need to install the module '%s'", e.name)
-
-    if args.daemon:
-        logger.info("Activating main loop")
-        while True:
-            main_loop(tele_api, config=config, clear=args.clear_incoming)
-            if args.exit_on_msg:
-                break
+        try:
+            on_cmdline.run_command(args, tele_api, config)
+        except ModuleNotFoundError as e:
+            logger.error("In order to use this option you need to install the module '%s'", e.name)
+
+        if args.daemon:
+            from pybliotecario.core_loop import (
+                create_dispatcher,
+                create_file_store,
+                create_log_writer,
+                main_loop,
+            )
+            from pybliotecario.ipc import start_ipc_server
+            from pybliotecario.metrics import start_http_server
+            from pybliotecario.profiling import PROFILER, PROFILES_FOLDER
+
+            logger.info("Activating main loop")
+            # Make sure a SIGTERM (e.g., from systemd) closes everything cleanly
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            if args.profile:
+                PROFILER.arm(args.profile, Path(config["DEFAULT"]["main_folder"]) / PROFILES_FOLDER)
+            metrics_port = config.getint("DEFAULT", "metrics_port", fallback=None)
+            if metrics_port is not None:
+                start_http_server(metrics_port)
+            dispatcher = create_dispatcher(config, workers=args.workers)
+            log_writer = create_log_writer(config)
+            file_store = create_file_store(config)
+            ipc_server = start_ipc_server(config, args.backend, tele_api, dispatcher)
+            try:
+                while True:
+                    main_loop(
+                        tele_api,
+                        config=config,
+                        clear=args.clear_incoming,
+                        dispatcher=dispatcher,
+                        log_writer=log_writer,
+                        file_store=file_store,
+                    )
+                    if args.exit_on_msg:
+                        dispatcher.join()
+                        break
+            finally:
+                if ipc_server is not None:
+                    ipc_server.close()
+                dispatcher.shutdown()
+                log_writer.close()
+    finally:
+        tele_api.close()
+        # Only once the downloads, which add the files to the store, are done
+        if file_store is not None:
+            file_store.close()
 
 
 if __name__ == "__main__":
@@ -2,7 +2,13 @@
 Tests the test backend
 """
 
+import logging
+
+import pytest
+
 from pybliotecario.backend import TestUtil
+from pybliotecario.backend.backend_test import _TESTUSER, TESTID, TestMessage, _create_fake_msg
+from pybliotecario.backend.basic_backend import _UNPARSED
 
 _FAKEMSGS = ["This is only a test", "Hola, caracola"]
 
@@ -69,3 +75,23 @@ def test_send_msg_tmpfile(tmpfile):
     # test util does not take a chat id for now
     test_util.send_message(msg, None)
     assert test_util.is_msg_in_file(msg)
+
+
+@pytest.mark.parametrize("release", [False, True])
+def test_message_release(release, caplog):
+    """The lazy fields are the same whether the update is kept or released"""
+    update = _create_fake_msg("/test command")
+    with caplog.at_level(logging.INFO):
+        msg = TestMessage(update, release=release)
+    assert (msg.update is None) == release
+    # Neither logging nor releasing the update parse the lazy fields
+    assert "New message" in caplog.text
+    assert msg._username is _UNPARSED
+    assert msg.chat_id == TESTID and msg.command == "test" and msg.text == "command"
+    assert msg.username == _TESTUSER
+    assert not msg.is_group
+    # No attributes can be added to a message
+    with pytest.raises(AttributeError):
+        msg.something = None
+    # Ignored messages have no username
+    assert TestMessage({"update_id": 1}, release=release).username is None
@@ -0,0 +1,52 @@
+"""
+Tests sending a stream of messages read from stdin
+"""
+
+import io
+import sys
+
+from pybliotecario.backend import TestUtil
+from pybliotecario.batch import parse_record, read_records, send_stream
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+
+def test_read_records():
+    """Records are split by the delimiter, empty records are skipped"""
+    stream = io.BytesIO("uno\r\n\ndos\ntrès".encode())
+    assert list(read_records(stream)) == ["uno", "dos", "très"]
+    # Multibyte characters split between chunks are decoded correctly
+    stream = io.BytesIO("first\nline\0ñandú\0".encode())
+    assert list(read_records(stream, "\0", chunk_size=8)) == ["first\nline", "ñandú"]
+
+
+def test_parse_record():
+    assert parse_record("file:/tmp/a.txt") == ("file", "/tmp/a.txt")
+    assert parse_record("image:b.png") == ("image", "b.png")
+    assert parse_record("text:file: not a file") == ("text", "file: not a file")
+    assert parse_record("Alert: disk full") == ("text", "Alert: disk full")
+
+
+def test_send_stream(tmpfile, tmp_path):
+    """All records are sent, failures don't stop the stream"""
+
+    class FailingUtil(TestUtil):
+        def send_image(self, *args):
+            raise FileNotFoundError("no image")
+
+    attachment = tmp_path / "attachment.txt"
+    stream = io.BytesIO(f"one\nfile:{attachment}\nimage:nope.png\ntwo\\nlines\n".encode())
+    sent, failed = send_stream(stream, FailingUtil(communication_file=tmpfile), 1234)
+    assert (sent, failed) == (3, 1)
+    assert tmpfile.read_text() == f"one\n{attachment}\ntwo\nlines\n"
+
+
+def test_stdin_cmdline(tmpfile, tmp_path, monkeypatch):
+    """--stdin sends everything through the same backend"""
+    lines = [f"Alert number {i}" for i in range(100)]
+    fake_stdin = io.TextIOWrapper(io.BytesIO("\0".join(lines).encode()))
+    monkeypatch.setattr(sys, "stdin", fake_stdin)
+    tele_api = TestUtil(communication_file=tmpfile)
+    main(["--stdin", "-0"], tele_api=tele_api, config=generate_fake_config(tmp_path))
+    assert tmpfile.read_text().splitlines() == lines
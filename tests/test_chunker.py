@@ -0,0 +1,83 @@
+"""
+Tests the chunking of long messages
+"""
+
+from configparser import ConfigParser
+
+import pytest
+
+from pybliotecario.backend.basic_backend import Backend
+from pybliotecario.backend.chunker import CODEPOINT, UTF16, chunk_message, message_size
+
+
+def test_no_whitespace():
+    """Text without any whitespace is cut at the maximum size"""
+    text = "a" * 25
+    assert list(chunk_message(text, 10)) == ["a" * 10, "a" * 10, "a" * 5]
+
+
+def test_boundaries():
+    """Paragraphs are preferred to lines and lines to words"""
+    text = "first paragraph here\n\nsecond line\nthird"
+    assert list(chunk_message(text, 30)) == ["first paragraph here", "second line\nthird"]
+    text = "one two three four"
+    assert list(chunk_message(text, 10)) == ["one two", "three four"]
+    # A boundary too close to the start of the chunk is ignored
+    text = "a " + "b" * 20
+    assert list(chunk_message(text, 10)) == ["a " + "b" * 8, "b" * 10, "bb"]
+
+
+def test_utf16():
+    """Emoji count as two UTF-16 code units and are never split"""
+    text = "\U0001f600" * 5
+    assert message_size(text, CODEPOINT) == 5
+    assert message_size(text, UTF16) == 10
+    chunks = list(chunk_message(text, 3, unit=UTF16))
+    assert chunks == ["\U0001f600"] * 5
+    assert all(message_size(chunk, UTF16) <= 3 for chunk in chunks)
+
+
+def test_markdown():
+    """Entities open at the end of a chunk are closed and reopened in the next one"""
+    text = "*" + "bold words " * 5 + "*"
+    chunks = list(chunk_message(text, 40, markdown=True))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.startswith("*")
+        assert chunk.endswith("*")
+        assert len(chunk) <= 40
+    # Markers inside code are not entities
+    chunks = list(chunk_message("`" + "a_b " * 10 + "`", 30, markdown=True))
+    assert chunks[0] == "`a_b a_b a_b a_b`"
+    assert chunks[1].startswith("`a_b")
+    with pytest.raises(ValueError):
+        list(chunk_message("text", 10, markdown=True))
+
+
+def test_lazy():
+    """The chunks are generated only when requested"""
+    chunks = chunk_message("x" * 10**6, 10)
+    assert next(chunks) == "x" * 10
+    with pytest.raises(ValueError):
+        next(chunk_message("text", 10, unit="bytes"))
+
+
+def test_backend_chunks():
+    """Long messages are sent by the backends in several chunks"""
+
+    class SmallBackend(Backend):
+        _message_class = None
+        _max_size = 10
+
+        def _get_updates(self, not_empty=False):
+            return []
+
+        def _send_message(self, text, chat, **kwargs):
+            sent.append(text)
+            return len(sent)
+
+    sent = []
+    config = ConfigParser()
+    config["DEFAULT"] = {"send_queue": "false"}
+    assert SmallBackend(config).send_message("one two three four", 1) == 2
+    assert sent == ["one two", "three four"]
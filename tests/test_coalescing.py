@@ -0,0 +1,57 @@
+"""
+Tests the coalescing of text messages sent to the same chat
+"""
+
+from configparser import ConfigParser
+
+from pybliotecario.backend.basic_backend import Backend
+
+
+class RecordingBackend(Backend):
+    _message_class = None
+    _max_size = 31
+
+    def __init__(self):
+        config = ConfigParser()
+        config["DEFAULT"] = {"coalesce_window": "0.05", "send_rate_chat": "1000"}
+        super().__init__(config)
+        self.sent = []
+
+    def _get_updates(self, not_empty=False):
+        return []
+
+    def _send_message(self, text, chat, **kwargs):
+        self.sent.append((chat, text, kwargs))
+        return len(self.sent)
+
+    def _send_file(self, filepath, chat):
+        self.sent.append((chat, filepath, "file"))
+
+
+def test_merge_messages():
+    """Messages to the same chat are merged, up to the size limit"""
+    backend = RecordingBackend()
+    futures = [backend.send_message(f"alert {i}", 1) for i in range(5)]
+    other = backend.send_message("other chat", 2)
+    backend.flush()
+    # Each alert is 7 characters, 4 of them (with separators) fit in 31
+    assert sorted(backend.sent) == [
+        (1, "alert 0\nalert 1\nalert 2\nalert 3", {}),
+        (1, "alert 4", {}),
+        (2, "other chat", {}),
+    ]
+    assert len({future.result() for future in futures[:4]}) == 1
+    assert other.result() != futures[0].result()
+    backend.close()
+
+
+def test_order_is_kept():
+    """Messages that can't be merged flush the pending ones first"""
+    backend = RecordingBackend()
+    backend.send_message("first", 1)
+    backend.send_message("*second*", 1, markdown=True)
+    backend.send_message("third", 1)
+    backend.send_file("fourth.txt", 1)
+    backend.send_message("fifth", 1)
+    backend.close()
+    assert [i[1] for i in backend.sent] == ["first", "*second*", "third", "fourth.txt", "fifth"]
@@ -0,0 +1,34 @@
+"""
+Tests the writer of the daily logs
+"""
+
+from datetime import datetime
+
+from pybliotecario.daily_log import DailyLogWriter, monthly_folder
+
+
+def _today_log(main_folder):
+    return monthly_folder(main_folder) / f"{datetime.now().day}.log"
+
+
+def test_buffered_writes(tmp_path):
+    """Messages are kept in memory until flushed"""
+    writer = DailyLogWriter(tmp_path, flush_interval=3600)
+    writer.write("Hola")
+    writer.write("caracola")
+    log_file = _today_log(tmp_path)
+    assert log_file.read_text() == ""
+    writer.flush()
+    assert log_file.read_text() == "Hola\ncaracola\n"
+    writer.write("Adios")
+    writer.close()
+    assert log_file.read_text() == "Hola\ncaracola\nAdios\n"
+
+
+def test_unbuffered_writes(tmp_path):
+    """With a flush interval of 0 every message is written immediately"""
+    writer = DailyLogWriter(tmp_path, flush_interval=0)
+    writer.write("Hola")
+    assert _today_log(tmp_path).read_text() == "Hola\n"
+    assert writer.folder == monthly_folder(tmp_path)
+    writer.close()
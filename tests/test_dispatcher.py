@@ -0,0 +1,133 @@
+"""
+Tests the dispatcher used by the core loop
+"""
+
+import threading
+import time
+
+import pytest
+
+from pybliotecario.backend.backend_test import TestMessage, TestUtil, _create_fake_msg
+from pybliotecario.core_loop import _FAILTHRESHOLD, main_loop
+from pybliotecario.dispatcher import ChatDispatcher
+import pybliotecario.on_cmd_message as on_cmd_message
+
+from .conftest import generate_fake_config
+
+
+def test_same_chat_in_order():
+    """Functions submitted for the same chat run sequentially and in order"""
+    dispatcher = ChatDispatcher(workers=4)
+    results = []
+
+    def work(i):
+        time.sleep(0.01 * (5 - i))
+        results.append(i)
+
+    for i in range(5):
+        dispatcher.submit("chat", work, i)
+    dispatcher.join()
+    dispatcher.shutdown()
+    assert results == list(range(5))
+
+
+def test_different_chats_in_parallel():
+    """A blocked chat does not prevent other chats from being served"""
+    dispatcher = ChatDispatcher(workers=2)
+    release = threading.Event()
+    dispatcher.submit("slow", release.wait, 5)
+    future = dispatcher.submit("fast", lambda: "done")
+    assert future.result(timeout=1) == "done"
+    release.set()
+    dispatcher.join()
+    dispatcher.shutdown()
+
+
+def test_errors_are_raised():
+    """Exceptions in the workers are raised back in the caller"""
+    dispatcher = ChatDispatcher(workers=2)
+
+    def fail():
+        raise ValueError("Failed")
+
+    dispatcher.submit("chat", fail)
+    with pytest.raises(ValueError):
+        dispatcher.join()
+    dispatcher.shutdown()
+
+
+def test_max_pending():
+    """submit waits while there are max_pending functions not finished"""
+    dispatcher = ChatDispatcher(workers=2, max_pending=2)
+    release = threading.Event()
+    dispatcher.submit("a", release.wait, 5)
+    dispatcher.submit("b", release.wait, 5)
+    submitted = threading.Event()
+    threading.Thread(target=lambda: (dispatcher.submit("c", lambda: None), submitted.set())).start()
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(1)
+    dispatcher.join()
+    dispatcher.shutdown()
+
+
+CHATS = 4
+
+
+class ChatsUtil(TestUtil):
+    """Test backend whose messages come from several chats"""
+
+    def __init__(self, texts, chats=CHATS):
+        super().__init__()
+        self.texts = texts
+        self.chats = chats
+
+    def act_on_updates(self, action_function, not_empty=False):
+        for i, text in enumerate(self.texts):
+            update = _create_fake_msg(text)
+            update["message"]["chat"]["id"] = i % self.chats
+            action_function(TestMessage(update))
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Commands acted upon by the core loop, /fail raises an exception"""
+    acted = []
+    lock = threading.Lock()
+
+    def act_on_command(tele_api, message, config):
+        with lock:
+            acted.append((message.chat_id, message.command))
+        if message.command == "fail":
+            raise RuntimeError("Failed")
+
+    monkeypatch.setattr(on_cmd_message, "act_on_telegram_command", act_on_command)
+    return acted
+
+
+def test_main_loop_clear(tmp_path, commands):
+    """With clear, the exceptions raised in all workers are counted together
+    and the loop only fails once there are more than _FAILTHRESHOLD in a row"""
+    config = generate_fake_config(str(tmp_path))
+    texts = ["/fail"] * _FAILTHRESHOLD
+    main_loop(ChatsUtil(texts), config=config, clear=True)
+    assert len(commands) == _FAILTHRESHOLD
+
+    # A command which does not fail resets the counter (in one chat, so that the order is known)
+    main_loop(ChatsUtil(texts + ["/ok"] + texts, chats=1), config=config, clear=True)
+
+    commands.clear()
+    with pytest.raises(RuntimeError):
+        main_loop(ChatsUtil(texts + ["/fail"]), config=config, clear=True)
+    # All messages were acted upon before the exception was raised
+    assert len(commands) == _FAILTHRESHOLD + 1
+
+
+def test_main_loop_no_clear(tmp_path, commands):
+    """Without clear, an exception in any worker is raised by the loop"""
+    config = generate_fake_config(str(tmp_path))
+    texts = ["/ok"] * CHATS + ["/fail"] + ["/ok"] * CHATS
+    with pytest.raises(RuntimeError):
+        main_loop(ChatsUtil(texts), config=config, clear=False)
+    # The other chats are still served
+    assert {chat for chat, command in commands if command == "ok"} == set(range(CHATS))
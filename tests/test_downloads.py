@@ -0,0 +1,117 @@
+"""
+Tests the background downloads
+"""
+
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+import pytest
+
+from pybliotecario.backend.downloads import DownloadManager, claim_path, part_path
+from pybliotecario.backend.transport import Transport
+
+CONTENT = bytes(range(256)) * 400
+
+
+class FileServer(ThreadingHTTPServer):
+    """Serves CONTENT with support for Range requests
+    The first ``drop`` responses are cut in half"""
+
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.ranges = []
+        super().__init__(("127.0.0.1", 0), FileHandler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/file.bin"
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        requested = self.headers.get("Range")
+        self.server.ranges.append(requested)
+        start = int(requested[len("bytes=") : -1]) if requested else 0
+        body = CONTENT[start:]
+        self.send_response(206 if requested else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.drop:
+            self.server.drop -= 1
+            body = body[: len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def manager():
+    manager = DownloadManager(Transport(retries=0), chunk_size=1024)
+    yield manager
+    manager.close()
+
+
+def test_download(file_server, manager, tmp_path):
+    target = tmp_path / "file.bin"
+    assert manager.submit(file_server.url, target).result() == target
+    assert target.read_bytes() == CONTENT
+    # The name is taken, the second download gets a different one
+    second = manager.submit(lambda: file_server.url, target).result()
+    assert second != target
+    assert second.read_bytes() == CONTENT
+    assert second.name.startswith("file-") and second.suffix == ".bin"
+    assert not list(tmp_path.glob("*.part"))
+    # No url, no download
+    assert manager.submit(lambda: None, tmp_path / "none").result() is None
+
+
+def test_resume(file_server, manager, tmp_path):
+    """An interrupted download continues from where it stopped"""
+    file_server.drop = 1
+    target = tmp_path / "file.bin"
+    assert manager.submit(file_server.url, target).result() == target
+    assert target.read_bytes() == CONTENT
+    assert file_server.ranges[0] is None
+    assert file_server.ranges[1] == f"bytes={len(CONTENT) // 2}-"
+
+    # A partial file left by a previous run is resumed too
+    file_server.ranges.clear()
+    target = tmp_path / "again.bin"
+    part_path(file_server.url, target).write_bytes(CONTENT[:1000])
+    assert manager.submit(file_server.url, target).result().read_bytes() == CONTENT
+    assert file_server.ranges == ["bytes=1000-"]
+
+
+def test_claim_path(tmp_path):
+    target = tmp_path / "name.txt"
+    assert claim_path(target) == target
+    other = claim_path(target)
+    assert other != target and other.exists()
+
+
+def test_finalize(file_server, manager, tmp_path):
+    """The hash of the content is computed while downloading, also when resuming"""
+    file_server.drop = 1
+    received = []
+
+    def finalize(partial, digest, target):
+        received.append((partial.read_bytes(), digest, target))
+        return "stored"
+
+    target = tmp_path / "file.bin"
+    assert manager.submit(file_server.url, target, finalize=finalize).result() == "stored"
+    assert received == [(CONTENT, hashlib.sha256(CONTENT).hexdigest(), target)]
+    assert not target.exists()
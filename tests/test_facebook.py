@@ -0,0 +1,164 @@
+"""
+Tests the webhook of the Facebook backend
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+import requests
+
+from pybliotecario.backend.facebook_util import FacebookUtil
+from pybliotecario.dispatcher import ChatDispatcher
+
+VERIFY = "verify_token"
+UPDATES = 200
+CLIENTS = 4
+# Time that acting on every message takes
+ACTION_SECONDS = 0.5
+ATTACHMENTS = 3
+
+
+def _event(sender, text):
+    return {"sender": {"id": str(sender)}, "message": {"text": text}}
+
+
+def _update(sender, text):
+    return {"object": "page", "entry": [{"messaging": [_event(sender, text)]}]}
+
+
+@pytest.fixture
+def backend():
+    config = ConfigParser()
+    config["DEFAULT"] = {"send_queue": "false", "download_workers": str(ATTACHMENTS)}
+    config["FACEBOOK"] = {"verify": VERIFY, "app_token": "fake"}
+    backend = FacebookUtil(config, host="127.0.0.1", port=0)
+    received = []
+    # Start the webhook, no updates yet
+    backend.act_on_updates(received.append)
+    assert received == []
+    yield backend
+    backend.close()
+
+
+def _url(backend):
+    return "http://127.0.0.1:{}/webhook".format(backend.server.server_port)
+
+
+def test_webhook(backend):
+    url = _url(backend)
+    challenge = {"hub.verify_token": VERIFY, "hub.challenge": "1234"}
+    assert requests.get(url, params=challenge).text == "1234"
+    challenge["hub.verify_token"] = "wrong"
+    assert requests.get(url, params=challenge).text == "incorrect"
+    assert requests.post(url, data="not json").status_code == 400
+    assert requests.post(url + "/other", json=_update(1, "hi")).status_code == 404
+    assert requests.post(url, json=_update(1, "hi")).status_code == 200
+    received = []
+    backend.act_on_updates(received.append, not_empty=True)
+    assert [(message.chat_id, message.text) for message in received] == [("1", "hi")]
+
+
+def test_ack_latency(backend):
+    """The webhook answers before the (slow) message is acted upon"""
+    url = _url(backend)
+    latencies = []
+    lock = threading.Lock()
+
+    def replay(first):
+        with requests.Session() as session:
+            for i in range(first, UPDATES, CLIENTS):
+                start = time.perf_counter()
+                assert session.post(url, json=_update(i, f"message {i}")).status_code == 200
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+    acted = []
+
+    def slow_action(message):
+        time.sleep(ACTION_SECONDS)
+        acted.append(message.text)
+
+    dispatcher = ChatDispatcher(workers=8)
+    received = []
+
+    def dispatch_message(message):
+        received.append(message)
+        return dispatcher.submit(message.chat_id, slow_action, message)
+
+    with ThreadPoolExecutor(CLIENTS) as clients:
+        replays = [clients.submit(replay, first) for first in range(CLIENTS)]
+        while len(received) < UPDATES:
+            backend.act_on_updates(dispatch_message, not_empty=True)
+    for finished in replays:
+        finished.result()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"Acknowledged {UPDATES} updates, p50 {latencies[len(latencies) // 2] * 1e3:.1f} ms, "
+        f"p99 {p99 * 1e3:.1f} ms"
+    )
+    # Had the messages been acted upon before answering, every request would take ACTION_SECONDS
+    assert p99 < ACTION_SECONDS
+    dispatcher.join()
+    dispatcher.shutdown()
+    assert sorted(acted) == sorted(f"message {i}" for i in range(UPDATES))
+
+
+class BarrierHandler(BaseHTTPRequestHandler):
+    """Only answers once ATTACHMENTS requests are waiting at the same time"""
+
+    def do_GET(self):
+        try:
+            self.server.barrier.wait()
+        except threading.BrokenBarrierError:
+            self.send_error(500)
+            return
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_batched_payload(backend, tmp_path):
+    """Every event and every attachment of a batched payload becomes a message
+    and the attachments are downloaded concurrently"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BarrierHandler)
+    server.barrier = threading.Barrier(ATTACHMENTS, timeout=10)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    attachments = [
+        {"type": "image", "payload": {"url": f"{base}/image_{i}.png?token=1"}}
+        for i in range(ATTACHMENTS)
+    ]
+    with_files = {"sender": {"id": "1"}, "message": {"attachments": attachments}}
+    delivery = {"sender": {"id": "2"}, "delivery": {"mids": ["mid"]}}
+    payload = {
+        "object": "page",
+        "entry": [
+            {"id": "page", "messaging": [_event(1, "first"), with_files]},
+            {"id": "page", "messaging": [delivery, _event(2, "/cmd second")]},
+        ],
+    }
+    assert requests.post(_url(backend), json=payload).status_code == 200
+    received = []
+    while len(received) < 2 + ATTACHMENTS + 1:
+        backend.act_on_updates(received.append, not_empty=True)
+    messages = [(m.chat_id, m.command, m.text) for m in received if not m.ignore]
+    files = [("1", None, f"image_{i}.png") for i in range(ATTACHMENTS)]
+    assert messages == [("1", None, "first")] + files + [("2", "cmd", "second")]
+
+    # All downloads must be in flight at the same time for the server to answer
+    downloads = [backend.download_file(m.file_id, tmp_path / m.text) for m in received if m.is_file]
+    for i, download in enumerate(downloads):
+        assert download.result(timeout=20).read_text() == f"/image_{i}.png?token=1"
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,57 @@
+"""
+Tests the content-addressed store of received files
+"""
+
+import os
+
+from pybliotecario.backend import TestUtil
+from pybliotecario.file_store import FileStore
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+DIGEST = "ab" * 32
+
+
+def _received(folder, name, content):
+    source = folder / f".{name}.part"
+    source.write_bytes(content)
+    return source
+
+
+def test_duplicates_stored_once(tmp_path):
+    store = FileStore(tmp_path)
+    month = tmp_path / "data"
+    month.mkdir()
+    first = store.store(_received(tmp_path, "a", b"report"), DIGEST, month / "report.pdf")
+    second = store.store(
+        _received(tmp_path, "b", b"report"), DIGEST, month / "report.pdf", caption="again"
+    )
+    renamed = store.store(_received(tmp_path, "c", b"report"), DIGEST, month / "copy.pdf")
+    blob = store.blob_path(DIGEST)
+    assert blob.read_bytes() == b"report"
+    # The same content with the same name is not linked twice
+    assert first == second == month / "report.pdf"
+    assert os.path.samefile(renamed, blob)
+    assert not list(tmp_path.glob(".*.part"))
+
+    entries = store.search("")
+    assert len(entries) == 3
+    assert {entry[4] for entry in entries} == {DIGEST}
+    assert [entry[1] for entry in store.search("again")] == ["report.pdf"]
+    assert [entry[1] for entry in store.search("pdf copy")] == ["copy.pdf"]
+    assert store.search("nothing") == []
+    store.close()
+
+
+def test_files_command(tmp_path, tmpfile):
+    store = FileStore(tmp_path)
+    store.store(_received(tmp_path, "a", b"data"), DIGEST, tmp_path / "results.csv", sender="me")
+    store.close()
+    test_util = TestUtil(communication_file=tmpfile, fake_msgs=["/files results"])
+    main(
+        cmdline_arg=["-d", "--exit_on_msg"],
+        tele_api=test_util,
+        config=generate_fake_config(tmp_path),
+    )
+    assert "results.csv (4 B)" in tmpfile.read_text()
@@ -0,0 +1,40 @@
+"""
+Check that the command line does not import more than it needs
+"""
+
+import subprocess
+import sys
+
+
+def _imported_modules(code):
+    """Run ``code`` in a fresh interpreter and return the modules it imported"""
+    script = f"import sys\n{code}\nprint('\\n'.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return set(result.stdout.split())
+
+
+def test_cmdline_deferred_imports():
+    """Parsing the arguments should import neither the backends, the components nor the daemon"""
+    modules = _imported_modules(
+        "from pybliotecario.pybliotecario import parse_args; parse_args(['msg'])"
+    )
+    assert "requests" not in modules
+    assert "pybliotecario.components" not in modules
+    assert "pybliotecario.backend.telegram_util" not in modules
+    assert "pybliotecario.core_loop" not in modules
+
+
+def test_lazy_backend():
+    """Importing one backend should not import the others"""
+    modules = _imported_modules("from pybliotecario.backend import FacebookUtil")
+    assert "pybliotecario.backend.facebook_util" in modules
+    assert "pybliotecario.backend.telegram_util" not in modules
+
+
+def test_telegram_without_webhook():
+    """The server for the webhook is only imported when the webhook is used"""
+    modules = _imported_modules("from pybliotecario.backend import TelegramUtil")
+    assert "pybliotecario.backend.telegram_util" in modules
+    assert "pybliotecario.backend.webhook" not in modules
+    assert "http.server" not in modules
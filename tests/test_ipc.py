@@ -0,0 +1,122 @@
+"""
+Tests the socket used to hand off command line invocations to the daemon
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import time
+
+import pytest
+
+from pybliotecario.argument_parser import parse_args
+from pybliotecario.backend import TestUtil
+from pybliotecario.dispatcher import ChatDispatcher
+from pybliotecario.ipc import (
+    DaemonError,
+    is_supported,
+    send_to_daemon,
+    socket_path,
+    start_ipc_server,
+)
+from pybliotecario.on_cmdline import hand_off
+
+from .conftest import generate_fake_config
+
+SEND_SECONDS = 0.5
+
+pytestmark = pytest.mark.skipif(not is_supported(), reason="Unix sockets not available")
+
+
+@pytest.fixture
+def daemon(tmp_path, tmpfile):
+    """Start the socket of a daemon using the test backend"""
+    config = generate_fake_config(tmp_path)
+    tele_api = TestUtil(communication_file=tmpfile)
+    dispatcher = ChatDispatcher(workers=6)
+    server = start_ipc_server(config, "telegram", tele_api, dispatcher)
+    assert server is not None
+    yield config, tele_api, dispatcher
+    server.close()
+    dispatcher.shutdown()
+
+
+def test_hand_off(daemon, tmp_path):
+    """Messages and files are sent by the daemon, in order"""
+    config, tele_api, dispatcher = daemon
+    attachment = tmp_path / "attachment.txt"
+    attachment.write_text("nothing to see here")
+
+    assert hand_off(parse_args(["First", "message"]), config)
+    assert hand_off(parse_args(["-f", str(attachment), "Second\\nmessage"]), config)
+    dispatcher.join()
+    assert tele_api.comm_file.read_text().split("\n") == [
+        "First message",
+        str(attachment),
+        "Second",
+        "message",
+        "",
+    ]
+
+
+def test_bad_request(daemon):
+    """Requests that can't be sent are refused without bringing down the daemon"""
+    config, _, _ = daemon
+    path = socket_path(config, "telegram")
+    with pytest.raises(DaemonError, match="can't be found"):
+        send_to_daemon(path, {"chat_id": "1", "image": "/does/not/exist.png"})
+    assert send_to_daemon(path, {"chat_id": "1", "message": "Still here"})
+
+
+def test_failed_send(daemon, tmp_path, monkeypatch):
+    """The reply waits for the send, so the client learns that it failed"""
+    config, tele_api, _ = daemon
+    attachment = tmp_path / "report.txt"
+    attachment.write_text("report")
+
+    def send_file(*args, **kwargs):
+        failed = Future()
+        failed.set_exception(FileNotFoundError("report.txt was removed"))
+        return failed
+
+    monkeypatch.setattr(tele_api, "send_file", send_file)
+    with pytest.raises(DaemonError, match="was removed"):
+        hand_off(parse_args(["-f", str(attachment)]), config)
+
+
+def test_no_daemon(tmp_path):
+    """Without a daemon, or for other backends or commands, the hand off does not happen"""
+    config = generate_fake_config(tmp_path)
+    assert not hand_off(parse_args(["Nobody listening"]), config)
+    # A socket left behind by a dead daemon is ignored and replaced
+    stale = socket_path(config, "telegram")
+    stale.touch()
+    assert not hand_off(parse_args(["Nobody listening"]), config)
+
+
+def test_only_sends(daemon):
+    """Other commands are never handed off"""
+    config, _, _ = daemon
+    assert not hand_off(parse_args(["--backend", "facebook", "Hello"]), config)
+    assert not hand_off(parse_args(["--search", "Hello"]), config)
+    assert hand_off(parse_args(["Hello"]), config)
+
+
+def test_concurrent_clients(daemon, monkeypatch):
+    """Requests to different chats are sent in parallel"""
+    config, tele_api, dispatcher = daemon
+    path = socket_path(config, "telegram")
+    sent = []
+
+    def slow_send(text, chat, **kwargs):
+        time.sleep(SEND_SECONDS)
+        sent.append(text)
+
+    monkeypatch.setattr(tele_api, "send_message", slow_send)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(dispatcher.workers) as clients:
+        requests = [
+            clients.submit(send_to_daemon, path, {"chat_id": str(chat), "message": f"to {chat}"})
+            for chat in range(dispatcher.workers)
+        ]
+        assert all(request.result() for request in requests)
+    assert time.perf_counter() - start < 2 * SEND_SECONDS
+    assert sorted(sent) == sorted(f"to {chat}" for chat in range(dispatcher.workers))
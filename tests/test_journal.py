@@ -0,0 +1,161 @@
+"""
+Tests the journal of updates
+"""
+
+from concurrent.futures import Future
+import threading
+import time
+
+import pytest
+
+from pybliotecario.backend.journal import LOG_NAME, STATE_NAME, UpdateJournal
+from pybliotecario.backend.telegram_util import TelegramUtil
+from pybliotecario.dispatcher import ChatDispatcher
+
+from .conftest import generate_fake_config
+
+
+def _update(update_id, text):
+    return {"update_id": update_id, "message": {"chat": {"id": 1}, "text": text}}
+
+
+def test_recover_after_crash(tmp_path):
+    """Updates received but not started are recovered,
+    updates which were interrupted are not repeated"""
+    journal = UpdateJournal(tmp_path)
+    for i in (1, 2, 3):
+        journal.received(i, _update(i, f"msg {i}"))
+    journal.started(1)
+    journal.processed(1, committed_offset=2)
+    journal.started(2)
+    # crash!
+    journal.close()
+
+    journal = UpdateJournal(tmp_path)
+    recovered = journal.recover()
+    assert [i["update_id"] for i in recovered] == [3]
+    assert journal.is_processed(1)
+    assert journal.is_processed(2)
+    assert not journal.is_processed(3)
+    assert journal.last_received == 3
+
+
+def test_processed_in_log(tmp_path):
+    """Processed updates are appended to the log,
+    the state is only written when the log is compacted"""
+    journal = UpdateJournal(tmp_path, retention=10)
+    journal.received_many([(i, _update(i, f"msg {i}")) for i in (1, 2, 3)])
+    for i in (1, 2):
+        journal.started(i)
+        journal.processed(i, committed_offset=i + 1)
+    assert not (tmp_path / STATE_NAME).exists()
+    journal.close()
+
+    journal = UpdateJournal(tmp_path, retention=2)
+    assert [i["update_id"] for i in journal.recover()] == [3]
+    assert journal.committed_offset == 3
+    assert journal.last_received == 3
+    # The log is over twice the retention, the next processed update compacts it
+    journal.started(3)
+    journal.processed(3, committed_offset=4)
+    assert (tmp_path / STATE_NAME).exists()
+    assert (tmp_path / LOG_NAME).read_text() == ""
+    journal.close()
+
+    journal = UpdateJournal(tmp_path, retention=2)
+    assert journal.recover() == []
+    assert journal.committed_offset == 4
+    assert journal.is_processed(3)
+
+
+def test_backend_restart(tmp_path):
+    """A restarted backend neither repeats nor loses updates"""
+    config = generate_fake_config(tmp_path)
+    config["DEFAULT"]["update_queue_size"] = "0"
+    batches = [[_update(10, "a"), _update(11, "b")], [_update(11, "b"), _update(12, "c")]]
+
+    class FakeTelegram(TelegramUtil):
+        def _get_updates(self, not_empty=False):
+            return batches.pop(0)
+
+    received = []
+    backend = FakeTelegram(config=config)
+    backend.act_on_updates(lambda msg: received.append(msg.text))
+    backend.close()
+
+    backend = FakeTelegram(config=config)
+    backend.act_on_updates(lambda msg: received.append(msg.text))
+    assert backend.offset == 12
+    assert backend.committed_offset == 13
+    backend.close()
+    assert received == ["a", "b", "c"]
+
+
+def test_failure_does_not_lose_updates(tmp_path):
+    """When acting on an update fails, the updates after it are not started
+    and they are recovered after the restart"""
+    config = generate_fake_config(tmp_path)
+    config["DEFAULT"]["update_queue_size"] = "0"
+    batches = [[_update(20, "fail"), _update(21, "hello")]]
+
+    class FakeTelegram(TelegramUtil):
+        def _get_updates(self, not_empty=False):
+            return batches.pop(0) if batches else []
+
+    received = []
+
+    def action(msg):
+        future = Future()
+        if msg.text == "fail":
+            future.set_exception(ValueError("Failed"))
+        else:
+            received.append(msg.text)
+            future.set_result(None)
+        return future
+
+    backend = FakeTelegram(config=config)
+    with pytest.raises(ValueError):
+        backend.act_on_updates(action)
+    backend.close()
+    assert received == []
+
+    backend = FakeTelegram(config=config)
+    backend.act_on_updates(action)
+    backend.close()
+    assert received == ["hello"]
+
+
+def test_crash_with_queued_messages(tmp_path):
+    """Messages waiting in the dispatcher when the program crashes are acted upon
+    after the restart, the one which had started is not repeated"""
+    config = generate_fake_config(tmp_path)
+    config["DEFAULT"]["update_queue_size"] = "0"
+    batches = [[_update(i, f"msg {i}") for i in (10, 11, 12, 13)]]
+
+    class FakeTelegram(TelegramUtil):
+        def _get_updates(self, not_empty=False):
+            return batches.pop(0) if batches else []
+
+    dispatcher = ChatDispatcher(workers=1)
+    release = threading.Event()
+    acted = []
+
+    def act(message):
+        message.started()
+        acted.append(message.text)
+        release.wait(5)
+
+    backend = FakeTelegram(config=config)
+    backend.act_on_updates(lambda message: dispatcher.submit(message.chat_id, act, message))
+    # crash! while the first message is being acted upon and the rest are queued
+    while not acted:
+        time.sleep(0.01)
+
+    received = []
+    restarted = FakeTelegram(config=config)
+    restarted.act_on_updates(lambda message: received.append(message.text))
+    restarted.close()
+    assert acted == ["msg 10"]
+    assert received == ["msg 11", "msg 12", "msg 13"]
+    release.set()
+    dispatcher.shutdown()
@@ -0,0 +1,53 @@
+"""
+Tests the metrics registry and the /stats command
+"""
+
+import urllib.request
+
+from pybliotecario.backend import TestUtil
+from pybliotecario.metrics import Registry, start_http_server
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+
+def test_registry():
+    """Counters, gauges and histograms are rendered in the Prometheus format"""
+    registry = Registry()
+    counter = registry.counter("test_total", "A counter", ("kind",))
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    registry.gauge("test_gauge", "A gauge").set(5)
+    histogram = registry.histogram("test_seconds", "A histogram", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 2.0):
+        histogram.observe(value)
+
+    assert counter.value("a") == 3
+    assert histogram.value() == 4
+    assert histogram.quantile(0.5) == 1.0
+    text = registry.render_prometheus()
+    assert 'test_total{kind="a"} 3' in text
+    assert "test_gauge 5" in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="1"} 3' in text
+    assert 'test_seconds_bucket{le="+Inf"} 4' in text
+    assert "test_seconds_count 4" in text
+
+    server = start_http_server(0, registry=registry)
+    url = f"http://127.0.0.1:{server.server_port}/metrics"
+    with urllib.request.urlopen(url) as response:
+        assert response.read().decode() == text
+    server.shutdown()
+
+
+def test_stats_command(tmp_path, tmpfile):
+    """/stats reports the commands that have been run"""
+    fake_msg = ["/r 1d20", "/stats"]
+    test_util = TestUtil(communication_file=tmpfile, fake_msgs=fake_msg)
+    main(
+        cmdline_arg=["-d", "--exit_on_msg"],
+        tele_api=test_util,
+        config=generate_fake_config(tmp_path),
+    )
+    messages = tmpfile.read_text()
+    assert 'pybliotecario_command_seconds{component="DnD"}' in messages
@@ -0,0 +1,72 @@
+"""
+Tests the streaming multipart bodies used for the uploads
+"""
+
+from email.parser import BytesParser
+from email.policy import HTTP
+
+import pytest
+
+from pybliotecario.backend.multipart import FileRange, MultipartBody
+
+
+def _parse(body, content):
+    message = f"Content-Type: {body.content_type}\r\n\r\n".encode() + content
+    parts = BytesParser(policy=HTTP).parsebytes(message).iter_parts()
+    return {part.get_param("name", header="content-disposition"): part for part in parts}
+
+
+def test_body(tmp_path):
+    upload = tmp_path / "report.txt"
+    upload.write_bytes(b"0123456789" * 1000)
+    progress = []
+    body = MultipartBody(
+        {"chat_id": 1234},
+        {"document": ("report.txt", upload)},
+        progress=lambda *p: progress.append(p),
+        chunk_size=512,
+    )
+    chunks = list(iter(lambda: body.read(4096), b""))
+    content = b"".join(chunks)
+    assert len(content) == len(body)
+    assert max(len(chunk) for chunk in chunks) <= 512
+    # The file is closed once it has been read
+    assert body._file is None
+    assert progress[-1] == (len(body), len(body))
+
+    parts = _parse(body, content)
+    assert parts["chat_id"].get_content() == "1234"
+    document = parts["document"]
+    assert document.get_filename() == "report.txt"
+    assert document.get_content_type() == "text/plain"
+    assert document.get_payload(decode=True) == upload.read_bytes()
+
+    # The body can be sent again
+    body.seek(0)
+    assert b"".join(iter(lambda: body.read(4096), b"")) == content
+    with pytest.raises(OSError):
+        body.seek(10)
+
+
+def test_close(tmp_path):
+    upload = tmp_path / "data.bin"
+    upload.write_bytes(b"x" * 10000)
+    with MultipartBody(files={"file": ("data.bin", upload)}, chunk_size=100) as body:
+        while body._file is None:
+            body.read()
+        assert not body._file.closed
+        opened = body._file
+    assert opened.closed
+
+
+def test_file_range(tmp_path):
+    """Only the range of the file is uploaded"""
+    upload = tmp_path / "big.bin"
+    upload.write_bytes(bytes(range(256)) * 100)
+    part = FileRange(upload, 1000, 3000, "big.bin.002")
+    body = MultipartBody(files={"document": (part.name, part)}, chunk_size=256)
+    content = b"".join(iter(body.read, b""))
+    assert len(content) == len(body)
+    document = _parse(body, content)["document"]
+    assert document.get_filename() == "big.bin.002"
+    assert document.get_payload(decode=True) == upload.read_bytes()[1000:4000]
@@ -0,0 +1,197 @@
+"""
+Tests the background polling of updates
+"""
+
+from concurrent.futures import Future
+import threading
+
+import pytest
+
+from pybliotecario.backend.polling import DROP_OLDEST, OffsetTracker, UpdatePipeline
+
+
+def _fetch_from(batches):
+    """Returns a fetch function that returns the given batches and then blocks"""
+    batches = list(batches)
+    done = threading.Event()
+
+    def fetch():
+        if batches:
+            return batches.pop(0)
+        done.set()
+        threading.Event().wait(0.05)
+        return []
+
+    return fetch, done
+
+
+def test_pipeline_prefetch():
+    """The poller fills the queue while nobody consumes it"""
+    fetch, done = _fetch_from([[1, 2], [3]])
+    pipeline = UpdatePipeline(fetch, capacity=10)
+    pipeline.start()
+    assert done.wait(1)
+    assert pipeline.get_batch() == [1, 2, 3]
+    pipeline.stop()
+
+
+def test_pipeline_drop_oldest():
+    """When the queue is full, the oldest droppable update is removed"""
+    updates = ["/cmd", "a", "b", "c"]
+    fetch, done = _fetch_from([updates])
+    pipeline = UpdatePipeline(
+        fetch, capacity=3, policy=DROP_OLDEST, is_droppable=lambda u: not u.startswith("/")
+    )
+    pipeline.start()
+    assert done.wait(1)
+    assert pipeline.get_batch() == ["/cmd", "b", "c"]
+    assert pipeline.dropped == 1
+    pipeline.stop()
+
+
+def test_offset_tracker():
+    """The offset only advances past updates which have been processed"""
+    tracker = OffsetTracker()
+    for i in (10, 11, 12):
+        tracker.received(i)
+    tracker.processed(11)
+    assert tracker.committed == 10
+    tracker.processed(10)
+    assert tracker.committed == 12
+    tracker.processed(12)
+    assert tracker.committed == 13
+
+
+def test_backend_commits_after_processing():
+    """Updates acted upon asynchronously are only committed when finished"""
+    from pybliotecario.backend.telegram_util import TelegramUtil
+
+    class FakeTelegram(TelegramUtil):
+        _prefetch = False
+
+        def _get_updates(self, not_empty=False):
+            return [{"update_id": 5, "message": {"chat": {"id": 1}, "text": "hi"}}]
+
+    backend = FakeTelegram(token="fake")
+    future = Future()
+    backend.act_on_updates(lambda msg: future)
+    assert backend.committed_offset == 5
+    future.set_result(None)
+    assert backend.committed_offset == 6
+
+
+def test_backoff_grows_and_resets():
+    """The backoff grows exponentially up to the maximum and is reset after success"""
+    from pybliotecario.backend.polling import Backoff
+
+    backoff = Backoff(base=1, factor=2, maximum=8, jitter=0)
+    assert [backoff.next_delay() for _ in range(5)] == [1, 2, 4, 8, 8]
+    backoff.reset()
+    assert backoff.next_delay() == 1
+
+
+def test_get_updates_recovers(monkeypatch):
+    """Connection errors are retried iteratively (with backoff) until updates arrive"""
+    import requests
+
+    from pybliotecario.backend import polling, telegram_util
+
+    class FakeResponse:
+        def __init__(self, result):
+            self._result = result
+
+        def json(self):
+            return {"ok": True, "result": self._result}
+
+    answers = [requests.exceptions.ConnectionError("down")] * 3
+    answers += [FakeResponse([])] * 50 + [FakeResponse([{"update_id": 7}])]
+
+    def fake_get(url, **kwargs):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    slept = []
+    backend = telegram_util.TelegramUtil(token="fake")
+    monkeypatch.setattr(backend.transport, "get", fake_get)
+    monkeypatch.setattr(polling.time, "sleep", slept.append)
+
+    assert backend._get_updates(not_empty=True) == [{"update_id": 7}]
+    assert backend.offset == 8
+    # Only the failed polls wait, empty polls are repeated immediately
+    assert len(slept) == 3
+    stats = backend.poll_stats.as_dict()
+    assert stats["connection_error"] == 3
+    assert stats["empty"] == 50
+    assert stats["ok"] == 1
+
+
+def test_update_filter(monkeypatch):
+    """Only the types of update the messages understand are requested, in batches of limit"""
+    from configparser import ConfigParser
+    import json
+    from urllib.parse import parse_qs, urlparse
+
+    from pybliotecario.backend import telegram_util
+
+    urls = []
+
+    class FakeResponse:
+        def json(self):
+            return {"ok": True, "result": []}
+
+    def fake_get(url, **kwargs):
+        urls.append(url)
+        return FakeResponse()
+
+    backend = telegram_util.TelegramUtil(token="fake")
+    monkeypatch.setattr(backend.transport, "get", fake_get)
+    backend._get_updates()
+    query = parse_qs(urlparse(urls[-1]).query)
+    assert json.loads(query["allowed_updates"][0]) == list(
+        telegram_util.TelegramMessage.update_types
+    )
+    assert query["limit"] == ["100"]
+
+    config = ConfigParser()
+    config["DEFAULT"] = {"allowed_updates": "message, callback_query", "updates_limit": "20"}
+    backend = telegram_util.TelegramUtil(config, token="fake")
+    backend._get_updates()
+    query = parse_qs(urlparse(urls[-1]).query)
+    assert json.loads(query["allowed_updates"][0]) == ["message", "callback_query"]
+    assert query["limit"] == ["20"]
+
+    config["DEFAULT"]["updates_limit"] = "500"
+    with pytest.raises(ValueError):
+        telegram_util.TelegramUtil(config, token="fake")
+
+
+def test_no_journal_confirms_after_processing(monkeypatch):
+    """Without a journal the updates are not prefetched and Telegram is only polled again
+    (which confirms the previous updates) once they have been processed"""
+    from pybliotecario.backend import polling, telegram_util
+
+    backend = telegram_util.TelegramUtil(token="fake")
+    polls = []
+    batches = [[{"update_id": 5, "message": {"chat": {"id": 1}, "text": "hi"}}], []]
+
+    def fake_poll():
+        polls.append(backend.committed_offset)
+        return polling.OK, batches.pop(0)
+
+    monkeypatch.setattr(backend, "_poll", fake_poll)
+    future = Future()
+    backend.act_on_updates(lambda msg: future)
+    assert backend._pipeline is None
+    assert polls == [None]
+
+    second = threading.Thread(target=backend.act_on_updates, args=(lambda msg: None,))
+    second.start()
+    second.join(0.2)
+    # The second poll waits for the first update
+    assert polls == [None]
+    future.set_result(None)
+    second.join(1)
+    assert polls == [None, 6]
+    backend.close()
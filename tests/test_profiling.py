@@ -0,0 +1,49 @@
+"""
+Tests the profiling hooks
+"""
+
+import pstats
+
+from pybliotecario.backend import TestUtil
+from pybliotecario.profiling import MemorySnapshots, Profiler
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+
+def test_profiler_wrap(tmp_path):
+    """Only the armed number of calls are profiled"""
+    profiler = Profiler()
+
+    def function(x):
+        return 2 * x
+
+    assert profiler.wrap(function) is function
+    profiler.arm(1, tmp_path)
+    wrapped = profiler.wrap(function)
+    assert wrapped is not function
+    assert wrapped(2) == 4
+    assert profiler.wrap(function) is function
+    profiles = list(tmp_path.glob("*.prof"))
+    assert len(profiles) == 1
+    pstats.Stats(str(profiles[0]))
+
+
+def test_memory_snapshots():
+    """Two snapshots produce a report"""
+    memory = MemorySnapshots()
+    assert "started" in memory.snapshot()
+    leak = [bytearray(1024) for _ in range(100)]
+    assert "Traced memory" in memory.snapshot()
+    memory.stop()
+    assert not memory.tracing
+    del leak
+
+
+def test_profile_command(tmp_path, tmpfile):
+    """/profile profiles the messages that come after it"""
+    fake_msg = ["/profile 1", "/r 1d20", "/r 1d20"]
+    test_util = TestUtil(communication_file=tmpfile, fake_msgs=fake_msg)
+    config = generate_fake_config(tmp_path)
+    main(cmdline_arg=["-d", "--exit_on_msg"], tele_api=test_util, config=config)
+    assert len(list((tmp_path / "profiles").glob("*.prof"))) == 1
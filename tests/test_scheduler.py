@@ -0,0 +1,171 @@
+"""
+Tests the outbound send queue
+"""
+
+from concurrent.futures import Future
+from configparser import ConfigParser
+import threading
+import time
+
+import pytest
+
+from pybliotecario.backend.basic_backend import Backend
+from pybliotecario.backend.scheduler import (
+    BULK,
+    INTERACTIVE,
+    SendScheduler,
+    TokenBucket,
+    send_priority,
+)
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == 0.5
+    clock.now = 0.5
+    assert bucket.delay() == 0
+    # The bucket never holds more than its capacity
+    clock.now = 100
+    bucket.take()
+    bucket.take()
+    bucket.take()
+    assert bucket.delay() > 0
+
+
+def test_interactive_first():
+    """Interactive sends jump ahead of bulk sends, each chat keeps its order"""
+    scheduler = SendScheduler(chat_rate=1000, global_rate=1000, workers=1)
+    sent = []
+    release = threading.Event()
+    scheduler.submit("blocker", release.wait)
+    for i in range(3):
+        scheduler.submit("chat", sent.append, f"bulk {i}", priority=BULK)
+    with send_priority(INTERACTIVE):
+        scheduler.submit("chat", sent.append, "reply 0")
+        scheduler.submit("chat", sent.append, "reply 1")
+    release.set()
+    scheduler.close()
+    assert sent == ["reply 0", "reply 1", "bulk 0", "bulk 1", "bulk 2"]
+
+
+def test_next_ready():
+    """The next send is the first (by priority and order) of the chats with tokens left"""
+    clock = FakeClock()
+    scheduler = SendScheduler(chat_rate=1, chat_burst=1, global_rate=1000, workers=0, clock=clock)
+    for i in range(3):
+        scheduler.submit("a", print, f"a{i}", priority=BULK)
+    scheduler.submit("b", print, "b0", priority=BULK)
+    scheduler.submit("a", print, "reply", priority=INTERACTIVE)
+
+    def take():
+        """Take the next send as a worker would, return its argument or the time to wait"""
+        item, wait = scheduler._next_ready()
+        if item is None:
+            return wait
+        scheduler._bucket(item[2]).take()
+        # The send is done
+        scheduler._make_ready(item[2])
+        return item[4][0]
+
+    assert take() == "reply"
+    # a has to wait for a token
+    assert take() == "b0"
+    assert take() == 1.0
+    clock.now = 1.0
+    assert take() == "a0"
+    clock.now = 3.0
+    assert take() == "a1"
+    assert take() == 1.0
+
+
+def test_rate_limits():
+    """A chat is limited to chat_rate sends per second, the other chats are not"""
+    scheduler = SendScheduler(chat_rate=20, chat_burst=1, global_rate=1000)
+    times = {}
+
+    def send(chat):
+        times.setdefault(chat, []).append(time.monotonic())
+
+    for _ in range(5):
+        scheduler.submit("slow", send, "slow")
+    for i in range(5):
+        scheduler.submit(i, send, "fast")
+    assert scheduler.flush(timeout=5)
+    scheduler.close()
+    slow = times["slow"]
+    assert slow[-1] - slow[0] >= 4 / 20 * 0.9
+    fast = times["fast"]
+    assert fast[-1] - fast[0] < 4 / 20
+
+
+def test_global_limit():
+    scheduler = SendScheduler(chat_rate=1000, global_rate=10)
+    start = time.monotonic()
+    futures = [scheduler.submit(i, lambda: None) for i in range(15)]
+    scheduler.close()
+    assert all(future.done() for future in futures)
+    # The first 10 go in a burst, the next 5 at 10 per second
+    assert time.monotonic() - start >= 0.4
+
+
+class RecordingBackend(Backend):
+    _message_class = None
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.sent = []
+
+    def _get_updates(self, not_empty=False):
+        return []
+
+    def _send_message(self, text, chat, **kwargs):
+        self.sent.append((chat, text))
+        if text == "fail":
+            raise ValueError("failed")
+        return len(text)
+
+
+def test_backend_queue():
+    """The sends of the backend are queued and done when the backend is closed"""
+    backend = RecordingBackend()
+    futures = [backend.send_message(f"message {i}", 1) for i in range(3)]
+    failure = backend.send_message("fail", 1)
+    assert all(isinstance(future, Future) for future in futures)
+    backend.close()
+    assert [future.result() for future in futures] == [9, 9, 9]
+    assert isinstance(failure.exception(), ValueError)
+    assert backend.sent == [(1, f"message {i}") for i in range(3)] + [(1, "fail")]
+
+
+def test_backend_no_queue():
+    config = ConfigParser()
+    config["DEFAULT"] = {"send_queue": "false"}
+    backend = RecordingBackend(config)
+    assert backend.send_message("now", 1) == 3
+    assert backend.sent == [(1, "now")]
+
+
+def test_cmdline_failed_send(tmp_path):
+    """A send from the command line which fails in the send queue is raised"""
+    backend = RecordingBackend()
+    main(cmdline_arg=["sent"], tele_api=backend, config=generate_fake_config(tmp_path))
+    with pytest.raises(ValueError):
+        main(
+            cmdline_arg=["fail"], tele_api=RecordingBackend(), config=generate_fake_config(tmp_path)
+        )
+    assert backend.sent == [("1234", "sent")]
@@ -0,0 +1,46 @@
+"""
+Tests the search index of the daily logs
+"""
+
+from pybliotecario.backend import TestUtil
+from pybliotecario.daily_log import DailyLogWriter, monthly_folder
+from pybliotecario.log_index import INDEX_NAME, LogIndex
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+
+def test_live_index(tmp_path):
+    """Messages written to the daily log can be searched"""
+    index = LogIndex(tmp_path / INDEX_NAME)
+    writer = DailyLogWriter(tmp_path, flush_interval=0, index=index)
+    writer.write("The cake is a lie", chat_id=1, username="glados")
+    writer.write("Still alive", chat_id=2, username="chell")
+    writer.close()
+
+    index = LogIndex(tmp_path / INDEX_NAME)
+    hits = index.search("cake")
+    assert len(hits) == 1
+    _, chat_id, username, text = hits[0]
+    assert (chat_id, username, text) == (1, "glados", "The cake is a lie")
+    assert index.search("nothing") == []
+    # The live entries are not indexed again by the backfill
+    assert index.backfill(tmp_path) == 0
+    index.close()
+
+
+def test_backfill_and_command(tmp_path, tmpfile):
+    """Old logs can be indexed and searched with /search"""
+    old_log = monthly_folder(tmp_path) / "1.log"
+    old_log.write_text("Hola caracola\nAdios caracola\nAlgo distinto\n")
+    index = LogIndex(tmp_path / INDEX_NAME)
+    assert index.backfill(tmp_path) == 3
+    assert index.backfill(tmp_path) == 0
+    index.close()
+
+    test_util = TestUtil(communication_file=tmpfile, fake_msgs=["/search caracola"])
+    fake_config = generate_fake_config(tmp_path)
+    main(cmdline_arg=["-d", "--exit_on_msg"], tele_api=test_util, config=fake_config)
+    messages = tmpfile.read_text().strip().split("\n")
+    assert len(messages) == 2
+    assert all("caracola" in i for i in messages)
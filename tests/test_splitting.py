@@ -0,0 +1,104 @@
+"""
+Tests sending files in parts and joining them back
+"""
+
+from configparser import ConfigParser
+import hashlib
+
+import pytest
+
+from pybliotecario.backend import TestUtil
+from pybliotecario.backend.basic_backend import Backend
+from pybliotecario.backend.multipart import FileRange
+from pybliotecario.backend.splitting import join_parts, split_file
+from pybliotecario.pybliotecario import main
+
+from .conftest import generate_fake_config
+
+CONTENT = bytes(range(256)) * 41
+
+
+class SplittingBackend(Backend):
+    _message_class = None
+    _max_upload = 4000
+
+    def __init__(self):
+        config = ConfigParser()
+        config["DEFAULT"] = {"send_queue": "false"}
+        super().__init__(config)
+        self.sent = []
+
+    def _get_updates(self, not_empty=False):
+        return []
+
+    def _send_message(self, text, chat, **kwargs):
+        self.sent.append(text)
+
+    def _send_file(self, filepath, chat):
+        if not isinstance(filepath, FileRange):
+            filepath = FileRange(filepath, 0, filepath.stat().st_size, filepath.name)
+        with open(filepath.path, "rb") as f:
+            f.seek(filepath.offset)
+            self.sent.append((filepath.name, f.read(filepath.size)))
+
+
+def test_split_file(tmp_path):
+    big = tmp_path / "big.bin"
+    big.write_bytes(CONTENT)
+    parts, manifest = split_file(big, 4000)
+    assert [part.name for part in parts] == ["big.bin.001", "big.bin.002", "big.bin.003"]
+    assert [part.size for part in parts] == [4000, 4000, len(CONTENT) - 8000]
+    assert all(isinstance(part, FileRange) for part in parts)
+    assert manifest.splitlines()[-1] == f"{hashlib.sha256(CONTENT).hexdigest()}  big.bin"
+    assert "--join big.bin.001" in manifest
+
+
+def test_send_and_join(tmp_path):
+    big = tmp_path / "big.bin"
+    big.write_bytes(CONTENT)
+    backend = SplittingBackend()
+    # Without split the file is sent as it is
+    backend.send_file(big, 1)
+    assert backend.sent == [("big.bin", CONTENT)]
+
+    backend.sent = []
+    backend.send_file(big, 1, split=True)
+    names = [name for name, _ in backend.sent[:-1]]
+    assert names == ["big.bin.001", "big.bin.002", "big.bin.003"]
+    manifest = backend.sent[-1]
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    for name, content in backend.sent[:-1]:
+        (downloads / name).write_bytes(content)
+    (downloads / "big.bin.sha256").write_text(manifest)
+    output, digest = join_parts(downloads / "big.bin.001")
+    assert output.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+
+    # A corrupted part is detected
+    output.unlink()
+    (downloads / "big.bin.002").write_bytes(b"corrupted")
+    with pytest.raises(ValueError):
+        join_parts(downloads / "big.bin.001")
+    assert list(downloads.glob("big.bin")) == []
+
+
+def test_join_cmdline(tmp_path, capsys):
+    for i, chunk in enumerate((b"first ", b"second"), 1):
+        (tmp_path / f"file.txt.00{i}").write_bytes(chunk)
+    test_util = TestUtil(communication_file=tmp_path / "sent.txt")
+    arguments = ["--join", str(tmp_path / "file.txt.001")]
+    main(cmdline_arg=arguments, tele_api=test_util, config=generate_fake_config(tmp_path))
+    assert (tmp_path / "file.txt").read_bytes() == b"first second"
+    assert str(tmp_path / "file.txt") in capsys.readouterr().out
+
+
+def test_split_cmdline_test_backend(tmp_path):
+    """The test backend accepts --split like the other backends"""
+    attachment = tmp_path / "attachment.txt"
+    attachment.write_text("small file")
+    test_util = TestUtil(communication_file=tmp_path / "sent.txt")
+    arguments = ["-f", str(attachment), "--split"]
+    main(cmdline_arg=arguments, tele_api=test_util, config=generate_fake_config(tmp_path))
+    assert test_util.is_msg_in_file(str(attachment))
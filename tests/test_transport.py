@@ -0,0 +1,233 @@
+"""
+Tests the shared HTTP transport against a local stand-in for the Telegram API
+"""
+
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import socket
+import threading
+
+import pytest
+import requests
+
+from pybliotecario.backend import telegram_util, transport
+from pybliotecario.backend.file_cache import CACHE_NAME, FileIdCache
+from pybliotecario.backend.transport import Transport, retry_after
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """Answers every request with ``ok``, unless a different answer is queued
+    Stores the path, body and client port of every request"""
+
+    def __init__(self):
+        self.requests = []
+        self.answers = []
+        # Seconds to wait before answering
+        self.delay = 0
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = "HTTP/1.1"
+
+    def _answer(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.server.requests.append((self.path, body, self.client_address[1]))
+        if self.server.delay:
+            # Not time.sleep, which the tests replace
+            threading.Event().wait(self.server.delay)
+        status, answer = (200, {"ok": True, "result": []})
+        if self.server.answers:
+            status, answer = self.server.answers.pop(0)
+        content = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _answer
+    do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    server = FakeTelegram()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(telegram_util, "TELEGRAM_URL", server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(fake_telegram):
+    # Send immediately, the send queue is tested in test_scheduler
+    config = ConfigParser()
+    config["DEFAULT"] = {"send_queue": "false"}
+    backend = telegram_util.TelegramUtil(config, token="fake")
+    backend.transport = Transport()
+    yield backend
+    backend.transport.close()
+
+
+def test_connection_reuse(fake_telegram, backend, tmp_path):
+    """Messages, files and images are sent through the same connection"""
+    attachment = tmp_path / "attachment.txt"
+    attachment.write_text("attached")
+    for i in range(5):
+        backend.send_message(f"message {i}", 1234)
+    backend.send_file(attachment, 1234)
+    backend.send_image(attachment, 1234)
+    assert len(fake_telegram.requests) == 7
+    ports = {port for _, _, port in fake_telegram.requests}
+    assert len(ports) == 1
+
+
+def test_retry_after(fake_telegram, backend, tmp_path, monkeypatch):
+    """A 429 is retried after the time given by Telegram, files are sent again in full"""
+    from pybliotecario.backend import transport
+
+    slept = []
+    monkeypatch.setattr(transport.time, "sleep", slept.append)
+    too_many = {"ok": False, "error_code": 429, "parameters": {"retry_after": 3}}
+    fake_telegram.answers = [(429, too_many), (429, too_many)]
+
+    attachment = tmp_path / "attachment.txt"
+    attachment.write_text("attached content")
+    backend.send_file(attachment, 1234)
+    assert slept == [3, 3]
+    assert len(fake_telegram.requests) == 3
+    assert all(b"attached content" in body for _, body, _ in fake_telegram.requests)
+
+
+def test_no_repeated_sends(fake_telegram, monkeypatch):
+    """Sends which timed out waiting for the answer are not retried, they might have been done"""
+    monkeypatch.setattr(transport.time, "sleep", lambda _: None)
+    client = Transport(retries=2, timeout=0.1)
+    fake_telegram.delay = 0.3
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post(fake_telegram.url + "sendMessage", endpoint="sendMessage", data={"a": 1})
+    assert len(fake_telegram.requests) == 1
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.get(fake_telegram.url + "sendMessage?text=hi", endpoint="sendMessage")
+    assert len(fake_telegram.requests) == 2
+    # Other requests are retried
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.get(fake_telegram.url + "getMe", endpoint="getMe")
+    assert len(fake_telegram.requests) == 5
+
+    # Sends which could not connect are retried
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        closed_url = "http://127.0.0.1:{}/sendMessage".format(sock.getsockname()[1])
+    attempts = []
+    request = client.session.request
+    monkeypatch.setattr(
+        client.session, "request", lambda *a, **k: attempts.append(a) or request(*a, **k)
+    )
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(closed_url, endpoint="sendMessage")
+    assert len(attempts) == 3
+    client.close()
+
+
+def test_no_repeated_sends_server_error(fake_telegram, monkeypatch):
+    """A 5xx to a send is returned without retrying, the send might have been done"""
+    monkeypatch.setattr(transport.time, "sleep", lambda _: None)
+    client = Transport(retries=2)
+    bad_gateway = (502, {"ok": False, "error_code": 502})
+    fake_telegram.answers = [bad_gateway] * 3
+    response = client.post(fake_telegram.url + "sendDocument", endpoint="sendDocument")
+    assert response.status_code == 502
+    assert len(fake_telegram.requests) == 1
+    # Other requests are retried
+    response = client.get(fake_telegram.url + "getUpdates", endpoint="getUpdates")
+    assert response.status_code == 200
+    assert len(fake_telegram.requests) == 4
+    client.close()
+
+
+def test_retry_after_parsing():
+    class FakeResponse:
+        def __init__(self, answer, headers):
+            self._answer = answer
+            self.headers = headers
+
+        def json(self):
+            if self._answer is None:
+                raise ValueError("no json")
+            return self._answer
+
+    assert retry_after(FakeResponse({"parameters": {"retry_after": 5}}, {})) == 5
+    assert retry_after(FakeResponse(None, {"Retry-After": "7"})) == 7
+    assert retry_after(FakeResponse({"ok": False}, {})) is None
+
+
+def test_file_id_cache(fake_telegram, tmp_path):
+    """Files already uploaded are sent by reference, stale references are uploaded again"""
+    config = ConfigParser()
+    config["DEFAULT"] = {"send_queue": "false", "main_folder": str(tmp_path)}
+    backend = telegram_util.TelegramUtil(config, token="fake")
+    backend.transport = Transport()
+    picture = tmp_path / "reaction.jpg"
+    picture.write_bytes(b"picture content")
+
+    def uploaded(file_id):
+        return (
+            200,
+            {"ok": True, "result": {"photo": [{"file_id": "small"}, {"file_id": file_id}]}},
+        )
+
+    fake_telegram.answers = [uploaded("first_id")]
+    backend.send_image(picture, 1234)
+    backend.send_image(picture, 1234)
+    first, second = fake_telegram.requests
+    assert b"picture content" in first[1]
+    assert b"picture content" not in second[1]
+    assert b"first_id" in second[1]
+    assert (tmp_path / "file_ids.json").exists()
+
+    # The server no longer knows the id, the picture is uploaded and the new id stored
+    fake_telegram.requests.clear()
+    fake_telegram.answers = [(400, {"ok": False, "description": "wrong file identifier"})]
+    fake_telegram.answers.append(uploaded("second_id"))
+    backend.send_image(picture, 1234)
+    rejected, upload = fake_telegram.requests
+    assert b"first_id" in rejected[1]
+    assert b"picture content" in upload[1]
+
+    # A new backend reads the cache from disk
+    fake_telegram.requests.clear()
+    other = telegram_util.TelegramUtil(config, token="fake")
+    other.transport = backend.transport
+    other.send_image(picture, 1234)
+    assert b"second_id" in fake_telegram.requests[0][1]
+    backend.transport.close()
+
+
+def test_digests_are_bounded(tmp_path):
+    """Only the digests of the max_entries most recently used files are remembered"""
+    cache = FileIdCache(tmp_path / CACHE_NAME, max_entries=2)
+    files = []
+    for i in range(3):
+        files.append(tmp_path / f"file_{i}.txt")
+        files[-1].write_text(f"content {i}")
+    first = cache.digest(files[0])
+    cache.digest(files[1])
+    assert cache.digest(files[0]) == first
+    cache.digest(files[2])
+    remembered = {Path(key[0]).name for key in cache._digests}
+    assert remembered == {"file_0.txt", "file_2.txt"}
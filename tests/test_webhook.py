@@ -0,0 +1,121 @@
+"""
+Tests receiving Telegram updates through the webhook
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import time
+
+import pytest
+import requests
+
+from pybliotecario.backend.telegram_util import TelegramUtil
+from pybliotecario.backend.webhook import SECRET_HEADER
+
+SECRET = "webhook_secret"
+UPDATES = 400
+CLIENTS = 4
+
+
+def _update(update_id):
+    chat = {"id": 1234, "username": "user"}
+    message = {"message_id": update_id, "chat": chat, "text": f"message {update_id}"}
+    return {"update_id": update_id, "message": message}
+
+
+@pytest.fixture
+def backend():
+    config = ConfigParser()
+    config["DEFAULT"] = {"webhook_port": "0", "webhook_secret": SECRET, "send_queue": "false"}
+    backend = TelegramUtil(config, token="fake", webhook=True)
+    received = []
+    # Start the webhook, no updates yet
+    backend.act_on_updates(received.append)
+    assert received == []
+    yield backend
+    backend.close()
+
+
+def test_secret(backend):
+    url = "http://127.0.0.1:{}/".format(backend.webhook_server.server_port)
+    assert requests.post(url, json=_update(1)).status_code == 401
+    wrong = {SECRET_HEADER: "wrong"}
+    assert requests.post(url, json=_update(1), headers=wrong).status_code == 401
+    good = {SECRET_HEADER: SECRET}
+    assert requests.post(url, data="not json", headers=good).status_code == 400
+    assert requests.post(url, json=_update(2), headers=good).status_code == 200
+    received = []
+    backend.act_on_updates(received.append, not_empty=True)
+    assert [message.text for message in received] == ["message 2"]
+
+
+def test_journal_before_reply(tmp_path):
+    """Updates answered by the webhook are in the journal, even if they were never acted upon"""
+    config = ConfigParser()
+    config["DEFAULT"] = {"webhook_port": "0", "webhook_secret": SECRET, "main_folder": tmp_path}
+    backend = TelegramUtil(config, token="fake", webhook=True)
+    backend.act_on_updates(lambda message: None)
+    url = "http://127.0.0.1:{}/".format(backend.webhook_server.server_port)
+    assert requests.post(url, json=_update(7), headers={SECRET_HEADER: SECRET}).status_code == 200
+
+    # crash! before acting on the update
+    received = []
+    restarted = TelegramUtil(config, token="fake", webhook=True)
+    restarted.act_on_updates(lambda message: received.append(message.text))
+    restarted.close()
+    backend.close()
+    assert received == ["message 7"]
+
+
+def test_ingest_throughput(backend):
+    """Replay updates from several keep-alive clients and check that all of them are acted upon"""
+    url = "http://127.0.0.1:{}/".format(backend.webhook_server.server_port)
+
+    def replay(first):
+        with requests.Session() as session:
+            session.headers[SECRET_HEADER] = SECRET
+            for update_id in range(first, UPDATES, CLIENTS):
+                assert session.post(url, json=_update(update_id)).status_code == 200
+
+    # The clients wait when the update queue is full, act on the updates as they arrive
+    start = time.perf_counter()
+    with ThreadPoolExecutor(CLIENTS) as clients:
+        replays = [clients.submit(replay, first) for first in range(CLIENTS)]
+        received = []
+        while len(received) < UPDATES:
+            backend.act_on_updates(received.append, not_empty=True)
+    elapsed = time.perf_counter() - start
+    for finished in replays:
+        finished.result()
+    print(f"Ingested {UPDATES} updates in {elapsed:.2f}s ({UPDATES / elapsed:.0f} updates/s)")
+    assert sorted(int(message.text.split()[1]) for message in received) == list(range(UPDATES))
+    assert backend.committed_offset == UPDATES
+
+
+def test_registration():
+    """With webhook_url, the webhook is registered with a random secret and removed at the end"""
+
+    class FakeResponse:
+        def json(self):
+            return {"ok": True}
+
+    class FakeTransport:
+        def __init__(self):
+            self.requests = []
+
+        def post(self, url, endpoint=None, data=None):
+            self.requests.append((endpoint, data))
+            return FakeResponse()
+
+    config = ConfigParser()
+    config["DEFAULT"] = {"webhook_port": "0", "webhook_url": "https://example.com/bot/hook"}
+    backend = TelegramUtil(config, token="fake", webhook=True)
+    backend.transport = FakeTransport()
+    backend.act_on_updates(lambda message: None)
+    assert backend.webhook_server.path == "/bot/hook"
+    ((endpoint, data),) = backend.transport.requests
+    assert endpoint == "setWebhook"
+    assert data["url"] == "https://example.com/bot/hook"
+    assert data["secret_token"] == backend.webhook_server.secret
+    backend.close()
+    assert backend.transport.requests[-1][0] == "deleteWebhook"